@@ -0,0 +1,224 @@
+import hashlib
+import math
+import os
+import pickle
+from collections import OrderedDict
+
+from shasta.ast_node import AstNode, VArgChar
+
+import config
+import ir_serialization
+from definitions.ir.resource import TemporaryFileResource
+from util import log
+
+##
+## A cache of compiled scripts that is used by the daemon to avoid
+## recompiling a df_region that has already been compiled with the same
+## variables and configuration (e.g., a region in the body of a loop).
+##
+
+## The compiled scripts refer to fifos (and temporary files) in PASH_TMP_PREFIX,
+## which is different for every run. We store the scripts with a placeholder instead
+## so that they can be persisted and reused across runs.
+TMP_PREFIX_PLACEHOLDER = "__PASH_TMP_PREFIX__/"
+
+## These are not referenced by a region syntactically, but they affect its expansion
+##   (field splitting, tilde expansion, and the `set -u` state respectively).
+IMPLICIT_EXPANSION_VARIABLES = ["IFS", "HOME", "-"]
+
+
+## Returns a digest of the serialized df_region that is stored in the file
+def df_region_digest(input_ir_file):
+    with open(input_ir_file, "rb") as f:
+        data = f.read()
+    return hashlib.sha256(data).hexdigest()
+
+## Returns the names of all variables that are referenced in the df_region
+def referenced_variables(df_region):
+    variables = set(IMPLICIT_EXPANSION_VARIABLES)
+    workset = [df_region]
+    while len(workset) > 0:
+        curr = workset.pop()
+        if isinstance(curr, VArgChar):
+            variables.add(curr.var)
+            workset.append(curr.arg)
+        elif isinstance(curr, AstNode):
+            workset.extend(vars(curr).values())
+        elif isinstance(curr, (list, tuple)):
+            workset.extend(curr)
+    return variables
+
+## Returns whether the compiled script depends on the sizes of the input files
+##   (and on the measured throughputs of commands), not only on the region and the variables
+def is_size_dependent(args):
+    return args.parallelizer_cost_model == "throughput"
+
+## Returns the (size, modification time) of every input file of a region (None if it cannot be stat'ed)
+def input_fingerprint(input_resources, cwd):
+    fingerprint = []
+    for resource in sorted(resource for resource in input_resources if isinstance(resource, str)):
+        try:
+            stat = os.stat(os.path.join(cwd, resource))
+            fingerprint.append((resource, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            fingerprint.append((resource, None))
+    return fingerprint
+
+## The measured throughputs change a bit after every run, so only their order of magnitude
+##   (in powers of 2) is part of the key, which is what changes the choices of the cost model
+def throughput_buckets(command_throughputs):
+    if command_throughputs is None:
+        return []
+    return sorted((command, round(math.log2(throughput)))
+                  for command, throughput in command_throughputs.items() if throughput > 0)
+
+## Returns the directories (relative to PASH_TMP_PREFIX) that the fifos
+## and temporary files of a compiled IR live in.
+def ir_tmp_dirs(ir):
+    tmp_dirs = set()
+    for fid in ir.all_fids():
+        if fid.is_ephemeral() or isinstance(fid.get_resource(), TemporaryFileResource):
+            tmp_dirs.add(os.path.dirname(fid.prefix))
+    return tmp_dirs
+
+
+class CachedCompilation:
+    ## Entries that were stored before these were kept do not have them
+    command_counts = {}
+    input_size = None
+    input_fingerprint = None
+
+    def __init__(self, script, tmp_dirs, input_resources, output_resources, command_counts, input_size,
+                 input_fingerprint):
+        self.script = script.replace(config.PASH_TMP_PREFIX, TMP_PREFIX_PLACEHOLDER)
+        self.tmp_dirs = tmp_dirs
+        self.input_resources = input_resources
+        self.output_resources = output_resources
+        self.command_counts = command_counts
+        self.input_size = input_size
+        ## The input files when the region was compiled (see input_fingerprint)
+        self.input_fingerprint = input_fingerprint
+
+    ## Writes the compiled script in the given file, making sure that
+    ## the directories that its fifos live in exist.
+    def write_script(self, compiled_script_file):
+        for tmp_dir in self.tmp_dirs:
+            os.makedirs(os.path.join(config.PASH_TMP_PREFIX, tmp_dir), exist_ok=True)
+        script = self.script.replace(TMP_PREFIX_PLACEHOLDER, config.PASH_TMP_PREFIX)
+        with open(compiled_script_file, "w") as f:
+            f.write(script)
+
+    def __repr__(self):
+        return f'CachedCompilation(TmpDirs:{self.tmp_dirs}, Inputs:{self.input_resources}, Outputs:{self.output_resources})'
+
+
+class CompilationCache:
+    """ An LRU cache from compilation keys to compiled scripts.
+
+    The key of a compilation is a hash of the df_region, the values of the variables that
+    the region references, the width, and all flags that affect the compiled script.
+    If the compiled script depends on the sizes of the input files (see is_size_dependent),
+    the key also has the measured throughputs of commands, and an entry is only used if
+    its input files have the same size and modification time as when it was compiled.
+    The input files are only known after the region is compiled, so they are not in the key.
+    If a cache directory is given, entries are also stored there (one file per entry)
+    and are loaded when the cache is initialized, so that they survive across runs.
+    """
+
+    def __init__(self, max_size, cache_dir=""):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        ## A map from df_region digests to the variables that they reference.
+        ##   This allows us to not decode the df_region on a cache hit.
+        self.region_variables = {}
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir != "":
+            self.load_from_dir()
+
+    def key(self, input_ir_file, vars_dict, compiler_config, args):
+        region_digest = df_region_digest(input_ir_file)
+        if not region_digest in self.region_variables:
+            with open(input_ir_file, "rb") as f:
+                df_region = ir_serialization.load_df_region(f)
+            self.region_variables[region_digest] = sorted(referenced_variables(df_region))
+        variable_values = [(name, vars_dict.get(name)) for name in self.region_variables[region_digest]]
+
+        runtime_config = config.config['distr_planner']
+        key_components = [region_digest,
+                          variable_values,
+                          compiler_config.width,
+                          args.no_optimize,
+                          args.no_eager,
+                          args.r_split_batch_size,
+                          args.parallelizer_cost_model,
+                          args.cost_model_cores,
+                          args.termination,
+                          args.log_file,
+                          runtime_config['batch_size'],
+                          config.PASH_TOP]
+        if is_size_dependent(args):
+            key_components.append(throughput_buckets(compiler_config.command_throughputs))
+        return hashlib.sha256(repr(key_components).encode('utf-8')).hexdigest()
+
+    ## The cwd is given if the entry depends on its input files (the PWD that their paths are relative to)
+    def get(self, key, cwd=None):
+        if (key in self.entries and cwd is not None
+            and self.entries[key].input_fingerprint != input_fingerprint(self.entries[key].input_resources, cwd)):
+            log("Compilation cache: The input files of:", key, "changed")
+            self.misses += 1
+            return None
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            if self.cache_dir != "":
+                ## The modification time is used to restore the LRU order across runs
+                os.utime(self.entry_path(key))
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def add(self, key, cached_compilation):
+        self.entries[key] = cached_compilation
+        self.entries.move_to_end(key)
+        if self.cache_dir != "":
+            self.store_entry(key, cached_compilation)
+        while len(self.entries) > self.max_size:
+            evicted_key, _ = self.entries.popitem(last=False)
+            log("Compilation cache: Evicting:", evicted_key)
+            if self.cache_dir != "":
+                self.remove_entry(evicted_key)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def store_entry(self, key, cached_compilation):
+        ## Write to a temporary file and rename so that a concurrent run never reads a partial entry
+        tmp_path = f'{self.entry_path(key)}.{os.getpid()}'
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cached_compilation, f)
+        os.replace(tmp_path, self.entry_path(key))
+
+    def remove_entry(self, key):
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    ## Loads the most recently used entries from the cache directory
+    def load_from_dir(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry_paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                       if not '.' in name]
+        entry_paths.sort(key=os.path.getmtime)
+        for entry_path in entry_paths[-self.max_size:]:
+            try:
+                with open(entry_path, "rb") as f:
+                    self.entries[os.path.basename(entry_path)] = pickle.load(f)
+            except Exception as e:
+                log("Compilation cache: Could not load entry:", entry_path, "Exception:", e)
+        log("Compilation cache: Loaded", len(self.entries), "entries from:", self.cache_dir)
+
+    def __repr__(self):
+        return f'CompilationCache(Entries:{len(self.entries)}, Hits:{self.hits}, Misses:{self.misses})'
@@ -131,6 +131,9 @@ def add_common_arguments(parser):
     parser.add_argument("--profile_driven",
                         help="(experimental) use profiling information when optimizing",
                         action="store_true")
+    parser.add_argument("--profile_store",
+                        help="(experimental) persist the profiling information of --profile_driven in this file so that it is reused across runs",
+                        default="")
     parser.add_argument("-p", "--output_optimized", # FIXME: --print
                         help="output the parallel shell script for inspection",
                         action="store_true")
@@ -156,6 +159,29 @@ def add_common_arguments(parser):
                         help="Run multiple pipelines in parallel if they are safe to run",
                         action="store_true",
                         default=False)
+    parser.add_argument("--compilation_cache",
+                        help="(experimental) reuse the compiled script of a region if it is compiled again with the same variables and configuration",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--compilation_cache_size",
+                        type=int,
+                        help="configure the maximum number of compiled scripts kept in the compilation cache (default: 128)",
+                        default=128)
+    parser.add_argument("--compilation_cache_dir",
+                        help="(experimental) persist the compilation cache in this directory so that it is reused across runs",
+                        default="")
+    parser.add_argument("--compilation_workers",
+                        type=int,
+                        help="(experimental) compile up to this many regions concurrently in worker processes of the daemon (default: 0, i.e., compile in the daemon itself). Not supported with --daemon_communicates_through_unix_pipes",
+                        default=0)
+    parser.add_argument("--parallelizer_cost_model",
+                        help="(experimental) the cost model that chooses the parallelizer of each node. 'priority' always chooses the first available one, 'throughput' estimates the cost of each one from the size of the input files",
+                        choices=["priority", "throughput"],
+                        default="priority")
+    parser.add_argument("--cost_model_cores",
+                        type=int,
+                        help="(experimental) the number of cores that the throughput cost model assumes the mappers of a node run on (default: 0, i.e., as many as the width)",
+                        default=0)
     parser.add_argument("--r_split_batch_size",
                         type=int,
                         help="configure the batch size of r_split (default: 1MB)",
@@ -186,6 +212,22 @@ def add_common_arguments(parser):
                         help="(experimental) execute the script in a distributed environment. Remote machines should be configured and ready",
                         action="store_true",
                         default=False)
+    parser.add_argument("--dspash_data_plane",
+                        help="(experimental) with --distributed_exec, move the data between machines through a data plane service on each machine instead of a pair of remote pipe processes per edge",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--dspash_speculation",
+                        help="(experimental) with --distributed_exec and --dspash_data_plane, start a backup copy of the subgraphs that are much slower than their siblings (if they only read replayable inputs, e.g., HDFS blocks) on another worker and take the output of whichever copy gets ahead",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--dspash_fault_tolerance",
+                        help="(experimental) with --distributed_exec and --dspash_data_plane, retry the subgraphs of a worker that fails on the other workers (and replay the edges that they were reading with copies of their writers, down to the subgraphs that only read files)",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--dspash_cluster_subgraphs",
+                        help="(experimental) with --distributed_exec, run the subgraphs that exchange the most data on the same worker (while balancing the processes between workers) so that less data crosses the network",
+                        action="store_true",
+                        default=False)
     parser.add_argument("--serverless_exec",
                         help="(experimental) execute the script in a serverless environment. Serverless env (e.g., AWS account) should be configured and ready",
                         action="store_true",
@@ -193,6 +235,30 @@ def add_common_arguments(parser):
     parser.add_argument("--sls_output",
                         help="(experimental) output the serverless execution result to a named file in s3",
                         default = "")
+    parser.add_argument("--sls_provider",
+                        help="(experimental) the cloud services of --serverless_exec: 'aws' (Lambda, S3 and SQS) or 'local', which emulates them on this machine with processes and directories (see runtime/serverless/local.json)",
+                        choices=["aws", "local"],
+                        default="aws")
+    parser.add_argument("--sls_fanout",
+                        help="(experimental) invoke all the lambdas of a --serverless_exec script concurrently from the main shell, instead of every lambda invoking the ones that read its outputs",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--sls_ship_scripts",
+                        help="(experimental) store the scripts of the lambdas of a --serverless_exec script once in the bucket and invoke every lambda with the id of its script, instead of sending all the scripts with every invocation",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--sls_timeout",
+                        type=float,
+                        help="(experimental) fail a --serverless_exec script if its outputs are not written within this many seconds (default: 1800, 0 waits forever)",
+                        default=1800)
+    parser.add_argument("--edge_compression",
+                        help="(experimental) compress the data of the edges between machines with --distributed_exec (not --serverless_exec). 'auto' chooses a codec (or none) for every edge from a sample of its input and --edge_bandwidth. Codecs whose command (lz4 or zstd) is not installed are not used",
+                        choices=["no", "auto", "lz4", "zstd", "zstd-3"],
+                        default="no")
+    parser.add_argument("--edge_bandwidth",
+                        type=float,
+                        help="(experimental) the bandwidth of the links between machines in MB/s that --edge_compression=auto assumes (default: 125MB/s)",
+                        default=125)
     parser.add_argument("--config_path",
                         help="determines the config file path. By default it is 'PASH_TOP/compiler/config.yaml'.",
                         default="")
@@ -213,6 +279,9 @@ def pass_common_arguments(pash_arguments):
         arguments.append("--avoid_pash_runtime_completion")
     if (pash_arguments.profile_driven):
         arguments.append("--profile_driven")
+    if(not pash_arguments.profile_store == ""):
+        arguments.append("--profile_store")
+        arguments.append(pash_arguments.profile_store)
     if (pash_arguments.output_time):
         arguments.append("--output_time")
     if (pash_arguments.output_optimized):
@@ -228,12 +297,45 @@ def pass_common_arguments(pash_arguments):
         arguments.append("--no_eager")
     if (pash_arguments.distributed_exec):
         arguments.append("--distributed_exec")
+    if (pash_arguments.dspash_data_plane):
+        arguments.append("--dspash_data_plane")
+    if (pash_arguments.dspash_speculation):
+        arguments.append("--dspash_speculation")
+    if (pash_arguments.dspash_fault_tolerance):
+        arguments.append("--dspash_fault_tolerance")
+    if (pash_arguments.dspash_cluster_subgraphs):
+        arguments.append("--dspash_cluster_subgraphs")
     if (pash_arguments.speculative):
         arguments.append("--speculative")
     if (pash_arguments.parallel_pipelines):
         arguments.append("--parallel_pipelines")
     if (pash_arguments.daemon_communicates_through_unix_pipes):
         arguments.append("--daemon_communicates_through_unix_pipes")
+    if (pash_arguments.compilation_cache):
+        arguments.append("--compilation_cache")
+    arguments.append("--compilation_cache_size")
+    arguments.append(str(pash_arguments.compilation_cache_size))
+    if(not pash_arguments.compilation_cache_dir == ""):
+        arguments.append("--compilation_cache_dir")
+        arguments.append(pash_arguments.compilation_cache_dir)
+    arguments.append("--compilation_workers")
+    arguments.append(str(pash_arguments.compilation_workers))
+    arguments.append("--sls_provider")
+    arguments.append(pash_arguments.sls_provider)
+    if (pash_arguments.sls_fanout):
+        arguments.append("--sls_fanout")
+    if (pash_arguments.sls_ship_scripts):
+        arguments.append("--sls_ship_scripts")
+    arguments.append("--sls_timeout")
+    arguments.append(str(pash_arguments.sls_timeout))
+    arguments.append("--edge_compression")
+    arguments.append(pash_arguments.edge_compression)
+    arguments.append("--edge_bandwidth")
+    arguments.append(str(pash_arguments.edge_bandwidth))
+    arguments.append("--parallelizer_cost_model")
+    arguments.append(pash_arguments.parallelizer_cost_model)
+    arguments.append("--cost_model_cores")
+    arguments.append(str(pash_arguments.cost_model_cores))
     arguments.append("--r_split_batch_size")
     arguments.append(str(pash_arguments.r_split_batch_size))
     arguments.append("--debug")
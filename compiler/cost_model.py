@@ -0,0 +1,292 @@
+import math
+import os
+
+import config
+from definitions.ir.resource import FileResource
+from util import log
+
+##
+## Cost models that choose which parallelizer (if any) to apply to each node of an IR,
+## and with how many mappers (the width of the node).
+##
+## A cost model scores each implemented parallelizer of a node with each candidate width
+## (and `None`, i.e., not parallelizing the node) and the cheapest one is chosen. The nodes
+## are visited in topological order, so the choices of all previous nodes are known when
+## a node is scored.
+##
+
+## The priority of each splitter when there is no better information:
+## 1. The round robin
+## 2. The round robin after having performed unwrap (not sure why this is the second priority)
+## 3. The consecutive chunks
+def priority_cost(parallelizer):
+    if parallelizer is None:
+        return math.inf
+    splitter = parallelizer.get_splitter()
+    if splitter.is_splitter_round_robin():
+        return 0
+    elif splitter.is_splitter_round_robin_with_unwrap_flag():
+        return 1
+    else:
+        assert(splitter.is_splitter_consec_chunks())
+        return 2
+
+def implemented_parallelizers(node):
+    return [parallelizer
+            for parallelizer in [node.get_option_implemented_round_robin_parallelizer(),
+                                 node.get_option_implemented_round_robin_with_unwrap_parallelizer(),
+                                 node.get_option_implemented_consecutive_chunks_parallelizer()]
+            if parallelizer is not None]
+
+
+class CostModel:
+    def __init__(self, graph, fan_out, r_split_batch_size):
+        self.graph = graph
+        ## The maximum width of a node
+        self.fan_out = fan_out
+        self.r_split_batch_size = r_split_batch_size
+        ## The width that was chosen for each parallelized node
+        self.width_map = {}
+
+    ## Returns the cost of applying the parallelizer (or None) to the node with the given width.
+    ##   The parallelizer_map contains the choices for all previous nodes.
+    def cost(self, node_id, parallelizer, width, parallelizer_map):
+        raise NotImplementedError()
+
+    def candidate_widths(self, node_id):
+        return [self.fan_out]
+
+    ## Returns the chosen parallelizer and records its width in the width_map
+    def choose(self, node_id, parallelizer_map):
+        node = self.graph.get_node(node_id)
+        candidates = [(parallelizer, width)
+                      for parallelizer in implemented_parallelizers(node)
+                      for width in self.candidate_widths(node_id)]
+        candidates.append((None, 1))
+        costs = [self.cost(node_id, parallelizer, width, parallelizer_map) 
+                 for parallelizer, width in candidates]
+        ## min keeps the first of equal costs, i.e., the highest priority parallelizer
+        best_index = min(range(len(candidates)), key=lambda i: costs[i])
+        parallelizer, width = candidates[best_index]
+        if parallelizer is not None:
+            self.width_map[node_id] = width
+        return parallelizer
+
+
+class PriorityCostModel(CostModel):
+    """ Always chooses the first implemented parallelizer in priority order (with the maximum width). """
+
+    def cost(self, node_id, parallelizer, width, parallelizer_map):
+        return priority_cost(parallelizer)
+
+
+class ThroughputCostModel(CostModel):
+    """ Estimates the time that a node takes to process its input (in seconds).
+
+    The size of the input of a node is known if it reads files (or if all its previous
+    nodes have known input sizes) and it is assumed that every node outputs as much as it reads.
+    The parallel stages are pipelined so their cost is the cost of their slowest stage,
+    plus the cost of starting all the processes. Every power of two up to the maximum width
+    is considered, so cheap nodes get fewer mappers than expensive ones. If the size of
+    the input is not known, the model falls back to the priority order and the maximum width.
+    """
+
+    ## Rough throughputs (in bytes per second) of common commands and runtime primitives.
+    ##   These can be overriden for a specific machine by setting `command_throughputs`.
+    DEFAULT_THROUGHPUT = 200 * 10**6
+    COMMAND_THROUGHPUTS = {"cat": 2000 * 10**6,
+                           "tr": 400 * 10**6,
+                           "grep": 300 * 10**6,
+                           "cut": 200 * 10**6,
+                           "wc": 1000 * 10**6,
+                           "uniq": 300 * 10**6,
+                           "sed": 100 * 10**6,
+                           "awk": 50 * 10**6,
+                           "sort": 20 * 10**6,
+                           "r_split": 1000 * 10**6,
+                           "r_merge": 1000 * 10**6,
+                           "split": 1000 * 10**6,
+                           "aggregator": 300 * 10**6}
+    ## The cost of spawning a process (and creating its fifos) in seconds
+    PROCESS_COST = 0.002
+
+    def __init__(self, graph, fan_out, r_split_batch_size, command_throughputs=None, cores=0):
+        super().__init__(graph, fan_out, r_split_batch_size)
+        self.command_throughputs = merged_throughputs(command_throughputs)
+        ## The daemon might not run on the machine (or with the cores) that the script runs with,
+        ##   so its own core count is not used.
+        self.cores = cores if cores > 0 else fan_out
+        ## A map from edge ids to the estimated size of their data
+        self.edge_sizes = {}
+        self.cwd = shell_cwd()
+
+    def throughput(self, command_name):
+        return command_throughput(self.command_throughputs, command_name)
+
+    def file_size(self, resource):
+        return file_size(self.cwd, resource)
+
+    def edge_size(self, edge_id):
+        if edge_id in self.edge_sizes:
+            return self.edge_sizes[edge_id]
+        fid = self.graph.get_edge_fid(edge_id)
+        resource = fid.get_resource()
+        size = None
+        if isinstance(resource, FileResource):
+            size = self.file_size(resource)
+        self.edge_sizes[edge_id] = size
+        return size
+
+    def input_size(self, node):
+        sizes = [self.edge_size(edge_id) for edge_id in node.get_input_list()]
+        if len(sizes) == 0 or None in sizes:
+            return None
+        return sum(sizes)
+
+    def candidate_widths(self, node_id):
+        if self.input_size(self.graph.get_node(node_id)) is None:
+            return [self.fan_out]
+        widths = []
+        width = 2
+        while width < self.fan_out:
+            widths.append(width)
+            width *= 2
+        widths.append(self.fan_out)
+        return widths
+
+    ## Returns whether the node can reuse the split of the previous node, i.e., if the previous node
+    ##   was parallelized in the same way, with the same width, and its aggregator is a concatenation.
+    def can_fuse_with_previous(self, node_id, parallelizer, width, parallelizer_map):
+        prev_ids = self.graph.get_previous_nodes(node_id)
+        if len(prev_ids) != 1:
+            return False
+        prev_parallelizer = parallelizer_map.get(prev_ids[0])
+        if prev_parallelizer is None or self.width_map[prev_ids[0]] != width:
+            return False
+        if not prev_parallelizer.get_aggregator_spec().is_aggregator_spec_concatenate():
+            return False
+        splitter = parallelizer.get_splitter()
+        prev_splitter = prev_parallelizer.get_splitter()
+        if splitter.is_splitter_consec_chunks():
+            return prev_splitter.is_splitter_consec_chunks()
+        return prev_splitter.is_splitter_round_robin() or prev_splitter.is_splitter_round_robin_with_unwrap_flag()
+
+    def aggregator_cost(self, parallelizer, width, size):
+        aggregator_spec = parallelizer.get_aggregator_spec()
+        if aggregator_spec.is_aggregator_spec_concatenate():
+            return size / self.command_throughputs["r_merge"], 1
+        elif aggregator_spec.is_aggregator_spec_custom_2_ary():
+            ## A tree of aggregators, every level of which processes all the data
+            levels = math.ceil(math.log2(width)) if width > 1 else 1
+            return levels * size / self.command_throughputs["aggregator"], width - 1
+        else:
+            return size / self.command_throughputs["aggregator"], 1
+
+    def parallel_cost(self, node_id, parallelizer, width, parallelizer_map, size, mapper_time):
+        splitter = parallelizer.get_splitter()
+        processes = width
+        if self.can_fuse_with_previous(node_id, parallelizer, width, parallelizer_map):
+            split_time = 0
+        elif splitter.is_splitter_consec_chunks():
+            split_time = size / self.command_throughputs["split"]
+            processes += 1
+        else:
+            split_time = size / self.command_throughputs["r_split"]
+            processes += 1
+
+        ## Mappers cannot run faster than the number of cores
+        parallelism = max(1, min(width, self.cores))
+        map_time = mapper_time / parallelism
+        if splitter.is_splitter_round_robin():
+            ## r_wrap starts the command for every batch
+            batches = math.ceil(size / self.r_split_batch_size)
+            map_time += batches * self.PROCESS_COST / parallelism
+
+        aggregate_time, aggregators = self.aggregator_cost(parallelizer, width, size)
+        processes += aggregators
+        return max(split_time, map_time, aggregate_time) + processes * self.PROCESS_COST
+
+    def cost(self, node_id, parallelizer, width, parallelizer_map):
+        node = self.graph.get_node(node_id)
+        size = self.input_size(node)
+        if size is None:
+            return priority_cost(parallelizer)
+
+        mapper_time = size / self.throughput(str(node.cmd_invocation_with_io_vars.cmd_name))
+        if parallelizer is None:
+            return mapper_time + self.PROCESS_COST
+        return self.parallel_cost(node_id, parallelizer, width, parallelizer_map, size, mapper_time)
+
+    def choose(self, node_id, parallelizer_map):
+        choice = super().choose(node_id, parallelizer_map)
+        node = self.graph.get_node(node_id)
+        size = self.input_size(node)
+        log("Cost model: Node:", node_id, "Input size:", size, "Chose:", choice, 
+            "Width:", self.width_map.get(node_id))
+        ## We assume that the output is as big as the input
+        for edge_id in node.get_output_list():
+            self.edge_sizes[edge_id] = size
+        return choice
+
+
+COST_MODELS = {"priority": PriorityCostModel,
+               "throughput": ThroughputCostModel}
+
+## Only the throughput cost model uses measurements and the cores
+def make_cost_model(name, graph, fan_out, r_split_batch_size, command_throughputs=None, cores=0):
+    if name == "throughput":
+        return ThroughputCostModel(graph, fan_out, r_split_batch_size, command_throughputs, cores)
+    return COST_MODELS[name](graph, fan_out, r_split_batch_size)
+
+
+## The table of throughputs with the measured ones (if any) in place of the table's
+def merged_throughputs(command_throughputs=None):
+    throughputs = dict(ThroughputCostModel.COMMAND_THROUGHPUTS)
+    if command_throughputs is not None:
+        throughputs.update(command_throughputs)
+    return throughputs
+
+def command_throughput(command_throughputs, command_name):
+    return command_throughputs.get(os.path.basename(command_name), ThroughputCostModel.DEFAULT_THROUGHPUT)
+
+def shell_cwd():
+    shell_variables = config.config.get('shell_variables')
+    if shell_variables is None:
+        return os.getcwd()
+    _type, pwd = shell_variables.get('PWD', [None, None])
+    if pwd is None:
+        return os.getcwd()
+    return pwd
+
+def file_size(cwd, resource):
+    path = os.path.join(cwd, str(resource))
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+## Returns the total size of the input files of the IR (None if any of its inputs is not a file)
+def ir_input_size(ir):
+    cwd = shell_cwd()
+    total = 0
+    for fid in ir.all_input_fids():
+        _fid, _from_node, to_node = ir.edges[fid.get_ident()]
+        ## Some edges are left dangling by the transformations
+        if to_node is None:
+            continue
+        resource = fid.get_resource()
+        if not isinstance(resource, FileResource):
+            return None
+        size = file_size(cwd, resource)
+        if size is None:
+            return None
+        total += size
+    return total
+
+## Returns the number of nodes (i.e., processes) of each command of the IR
+def ir_command_counts(ir):
+    counts = {}
+    for node in ir.nodes.values():
+        command = os.path.basename(str(node.cmd_invocation_with_io_vars.cmd_name))
+        counts[command] = counts.get(command, 0) + 1
+    return counts
@@ -145,3 +145,8 @@ class FileId:
             # Currently any other resource types should
             # be part of the main shell graph.
             return False
+
+    def is_preferred_on(self, host):
+        if self.has_remote_file_resource():
+            return self.resource.is_preferred_on(host)
+        return self.is_available_on(host)
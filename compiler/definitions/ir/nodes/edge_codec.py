@@ -0,0 +1,31 @@
+from pash_annotations.datatypes.AccessKind import make_stream_input, make_stream_output
+from pash_annotations.datatypes.BasicDatatypes import Operand
+from pash_annotations.datatypes.CommandInvocationWithIOVars import CommandInvocationWithIOVars
+
+from definitions.ir.dfg_node import *
+
+class EdgeCodec(DFGNode):
+    def __init__(self,
+                 cmd_invocation_with_io_vars,
+                 com_redirs=[],
+                 com_assignments=[],
+                 parallelizer_list=None,
+                 cmd_related_properties=None):
+        super().__init__(cmd_invocation_with_io_vars,
+                         com_redirs=com_redirs,
+                         com_assignments=com_assignments,
+                         parallelizer_list=parallelizer_list,
+                         cmd_related_properties=cmd_related_properties)
+
+## Compresses (or decompresses) the data of an edge that crosses machines (see edge_compression.py)
+def make_edge_codec_node(codec, input_id, output_id, decompress):
+    access_map = {input_id: make_stream_input(), output_id: make_stream_output()}
+    args = codec.decompress_args if decompress else codec.compress_args
+    cmd_inv_with_io_vars = CommandInvocationWithIOVars(
+        cmd_name=codec.command,
+        flag_option_list=[],
+        operand_list=[Operand(Arg.string_to_arg(arg)) for arg in args],
+        implicit_use_of_streaming_input=input_id,
+        implicit_use_of_streaming_output=output_id,
+        access_map=access_map)
+    return EdgeCodec(cmd_inv_with_io_vars)
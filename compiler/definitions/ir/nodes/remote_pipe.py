@@ -1,3 +1,7 @@
+from pash_annotations.datatypes.AccessKind import make_stream_input, make_stream_output
+from pash_annotations.datatypes.BasicDatatypes import Operand
+from pash_annotations.datatypes.CommandInvocationWithIOVars import CommandInvocationWithIOVars
+
 from definitions.ir.dfg_node import *
 
 class RemotePipe(DFGNode):
@@ -28,3 +32,56 @@ def make_remote_pipe(inputs, outputs, host_ip, port, is_remote_read, id):
                com_name, 
                com_category,
                com_options=options)
+
+class DataPlanePipe(DFGNode):
+    def __init__(self,
+                 cmd_invocation_with_io_vars,
+                 com_redirs=[],
+                 com_assignments=[],
+                 parallelizer_list=None,
+                 cmd_related_properties=None):
+        super().__init__(cmd_invocation_with_io_vars,
+                         com_redirs=com_redirs,
+                         com_assignments=com_assignments,
+                         parallelizer_list=parallelizer_list,
+                         cmd_related_properties=cmd_related_properties)
+
+    ## The operands are the direction, the address of the data plane of the writer, and the edge id
+    def is_write(self):
+        return str(self.cmd_invocation_with_io_vars.operand_list[0].get_name()) == "write"
+
+    def get_edge_uid(self):
+        return str(self.cmd_invocation_with_io_vars.operand_list[2].get_name())
+
+    def set_writer(self, host_ip, port, id):
+        self.cmd_invocation_with_io_vars.operand_list[1] = Operand(Arg.string_to_arg(f"{host_ip}:{port}"))
+        self.cmd_invocation_with_io_vars.operand_list[2] = Operand(Arg.string_to_arg(str(id)))
+
+## Same as make_remote_pipe, but the edge goes through the data planes of the two machines
+##   (see dspash/data_plane.py). The node is a shell function (defined in dspash/data_plane_pipe.sh)
+##   so that no process is started for it.
+def make_data_plane_pipe(inputs, outputs, host_ip, port, is_remote_read, id):
+    access_map = {}
+    implicit_use_of_streaming_input = None
+    if is_remote_read:
+        assert(len(inputs) == 0)
+        direction = "read"
+    else:
+        assert(len(inputs) == 1)
+        direction = "write"
+        implicit_use_of_streaming_input = inputs[0]
+        access_map[inputs[0]] = make_stream_input()
+    assert(len(outputs) == 1)
+    access_map[outputs[0]] = make_stream_output()
+
+    operand_list = [Operand(Arg.string_to_arg(direction)),
+                    Operand(Arg.string_to_arg(f"{host_ip}:{port}")),
+                    Operand(Arg.string_to_arg(str(id)))]
+    cmd_inv_with_io_vars = CommandInvocationWithIOVars(
+        cmd_name="pash_data_plane_pipe",
+        flag_option_list=[],
+        operand_list=operand_list,
+        implicit_use_of_streaming_input=implicit_use_of_streaming_input,
+        implicit_use_of_streaming_output=outputs[0],
+        access_map=access_map)
+    return DataPlanePipe(cmd_inv_with_io_vars)
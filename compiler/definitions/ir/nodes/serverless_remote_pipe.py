@@ -3,6 +3,8 @@ from pash_annotations.datatypes.CommandInvocationWithIOVars import CommandInvoca
 from pash_annotations.datatypes.AccessKind import make_stream_input, make_stream_output
 from pash_annotations.datatypes.BasicDatatypes import Operand
 
+import config
+
 class ServerlessRemotePipe(DFGNode):
     def __init__(self,
                  cmd_invocation_with_io_vars,
@@ -16,6 +18,12 @@ class ServerlessRemotePipe(DFGNode):
                          parallelizer_list=parallelizer_list,
                          cmd_related_properties=cmd_related_properties)
 
+## The edges between lambdas go through the fmi library on aws, and through named pipes with the local provider
+def tcp_pipe(direction, remote_key, node_ids):
+    if config.pash_args.sls_provider == "local":
+        return "python aws/local-pipe.py", [Operand(Arg.string_to_arg(direction)), Operand(Arg.string_to_arg(str(remote_key)))]
+    return "/opt/pashlib", [Operand(Arg.string_to_arg(direction+" "+str(remote_key)+" "+node_ids))]
+
 def make_serverless_remote_pipe(local_fifo_id, is_remote_read, remote_key, output_edge=None, is_tcp=False):
     """
     Generate a dfg node for serverless remote communication, now we handle these cases
@@ -37,8 +45,8 @@ def make_serverless_remote_pipe(local_fifo_id, is_remote_read, remote_key, outpu
         access_map[output_edge.get_ident()] = make_stream_output()
     if is_remote_read:
         if is_tcp:
-            remote_pipe_bin = "/opt/pashlib"
-            operand_list.append(Operand(Arg.string_to_arg("recv "+str(remote_key)+" 1 0")))
+            remote_pipe_bin, operands = tcp_pipe("recv", remote_key, "1 0")
+            operand_list.extend(operands)
             implicit_use_of_streaming_output = local_fifo_id
         else:
             remote_pipe_bin = "python aws/s3-get-object.py"
@@ -52,8 +60,8 @@ def make_serverless_remote_pipe(local_fifo_id, is_remote_read, remote_key, outpu
     else:
         implicit_use_of_streaming_output = output_edge.get_ident() # avoid node not found err
         if is_tcp:
-            remote_pipe_bin = "/opt/pashlib"
-            operand_list.append(Operand(Arg.string_to_arg("send "+str(remote_key)+" 0 1")))
+            remote_pipe_bin, operands = tcp_pipe("send", remote_key, "0 1")
+            operand_list.extend(operands)
             implicit_use_of_streaming_input = local_fifo_id
         else:
             remote_pipe_bin = "python aws/s3-put-object.py"
@@ -74,6 +74,10 @@ class RemoteFileResource(Resource):
     def is_available_on(self, host):
         raise NotImplementedError("RemoteFileResource is an interface")
 
+    ## Whether the resource should preferably be read on the host
+    def is_preferred_on(self, host):
+        return self.is_available_on(host)
+
     def _normalize_addr(self, addr):
         """
         Helper, removes port number if supplied in address and normalizes host address
@@ -114,15 +118,22 @@ class HDFSFileResource(RemoteFileResource):
 
 # DFS logical split resource
 class DFSSplitResource(RemoteFileResource):
-    def __init__(self, config, config_path, split_num, hosts):
+    def __init__(self, config, config_path, split_num, hosts, preferred_host=None):
         self.config = config
         self.config_path = config_path
         self.split_num = split_num
         self.hosts = list(map(self._normalize_addr, hosts))
+        ## The replica that the split was assigned to (see hdfs_utils.assign_blocks_to_hosts)
+        self.preferred_host = None if preferred_host is None else self._normalize_addr(preferred_host)
 
     def is_available_on(self, host):
         return host in self.hosts
 
+    def is_preferred_on(self, host):
+        if self.preferred_host is None:
+            return self.is_available_on(host)
+        return host == self.preferred_host
+
     def set_config_path(self, config_path):
         self.config_path = config_path
         
@@ -0,0 +1,694 @@
+import argparse
+import errno
+import fcntl
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import time
+import uuid
+from collections import deque
+from threading import Thread, Lock, Condition, Event, Timer
+
+##
+## The data plane of a machine moves the data of the edges between subgraphs
+## that run on different machines (see make_data_plane_pipe in remote_pipe.py).
+##
+## All edges between two machines are multiplexed over one long-lived tcp connection
+## between their data planes. The data is spliced from the fifos of the edges to the
+## connection (and back) so that it is normally not copied to user space, and every edge
+## has its own buffer with credit-based flow control, so that a slow consumer of one edge
+## never blocks the other edges of the connection.
+##
+## The credit is counted in bytes, but the buffer of a reader is a pipe, which holds fewer
+## bytes than its size if the data arrives in small segments (every segment takes a slot).
+## The receiving thread of a connection never waits for the buffer of an edge: the data
+## that does not fit in it is kept in the (user space) overflow of the edge, which is
+## bounded by the credit, until the consumer reads the buffer.
+##
+## The nodes of a subgraph connect to the data plane of their machine (with a bash
+## /dev/tcp redirection, so that no process is started for them) and send:
+##   WRITE <edge id> <path>              -- send the data of the path to the reader of the edge
+##   READ <edge id> <path> <host:port>   -- write the data of the edge (written on host) to the path
+##   STATS                               -- the throughput of the active and finished edges (json)
+## The data plane answers "DONE <bytes> <seconds>" when the edge is done, "CANCELLED <bytes> <seconds>"
+## if its reader took the data from another writer (or its consumer exited early), and
+## "FAILED <bytes> <seconds>" if the data of the edge is incomplete (e.g., its writer failed).
+## If the consumer of an edge exits before reading all of it (e.g., head), the reader cancels its
+## writers, so that the producers of the edge stop like they would on a local pipe.
+##
+## The worker manager can also give an edge that is read on this machine a backup writer,
+## i.e., a copy of the subgraph that writes it (see speculation.py), with:
+##   BACKUP <edge id> <backup edge id> <host:port>
+## The copy produces the same data, so the reader skips the bytes that it already has
+## from the original writer, and as soon as one of the two writers gets ahead of the
+## other, the other one is cancelled. If the connection to one of them is lost, the
+## edge continues from the other one.
+##
+## If the connection to all the writers of an edge is lost, its reader waits for a while
+## for the worker manager to give it a new writer (i.e., a copy of the failed subgraph,
+## see --dspash_fault_tolerance) with BACKUP, or to give up on it with:
+##   FAIL <edge id>
+##
+
+DATA_PLANE_PORT = 50053
+
+## Frames between data planes: kind, edge id, and length (of the data that follows) or credit
+FRAME_HEADER = struct.Struct('>B16sI')
+DATA, END, SUBSCRIBE, CREDIT, CANCEL = range(5)
+
+## The first line of a connection from another data plane
+PEER_HELLO = b"PEER\n"
+
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+
+## How many finished edges are kept for STATS
+FINISHED_EDGES_KEPT = 1000
+
+def log(*args):
+    print("Data plane:", *args, file=sys.stderr, flush=True)
+
+## Moves up to count bytes from src to dst and returns how many were moved (0 at the end of src).
+##   It falls back to copying if the file descriptors cannot be spliced (e.g., regular files).
+def transfer(src, dst, count):
+    if hasattr(os, "splice"):
+        try:
+            return os.splice(src, dst, count)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    data = os.read(src, count)
+    view = memoryview(data)
+    while len(view) > 0:
+        written = os.write(dst, view)
+        view = view[written:]
+    return len(data)
+
+def transfer_exactly(src, dst, count):
+    while count > 0:
+        moved = transfer(src, dst, count)
+        if moved == 0:
+            raise ConnectionError("unexpected end of stream")
+        count -= moved
+
+## Reads and drops count bytes from src
+def discard(src, count):
+    while count > 0:
+        data = os.read(src, min(count, 64 * 1024))
+        if not data:
+            raise ConnectionError("unexpected end of stream")
+        count -= len(data)
+
+def read_exactly(fd, count):
+    data = bytearray()
+    while len(data) < count:
+        chunk = os.read(fd, count - len(data))
+        if not chunk:
+            raise ConnectionError("unexpected end of stream")
+        data.extend(chunk)
+    return bytes(data)
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        written = os.write(fd, view)
+        view = view[written:]
+
+def recv_exactly(sock, count):
+    data = bytearray()
+    while len(data) < count:
+        packet = sock.recv(count - len(data))
+        if not packet:
+            return None
+        data.extend(packet)
+    return bytes(data)
+
+def make_pipe(size):
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(write_fd, F_SETPIPE_SZ, size)
+    except OSError:
+        ## The size might be over /proc/sys/fs/pipe-max-size
+        pass
+    return read_fd, write_fd, fcntl.fcntl(write_fd, F_GETPIPE_SZ)
+
+
+class EdgeStats:
+    def __init__(self, edge_id, direction):
+        self.edge_id = edge_id
+        self.direction = direction
+        self.bytes = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def seconds(self):
+        end_time = time.time() if self.end_time is None else self.end_time
+        return end_time - self.start_time
+
+    def to_dict(self):
+        seconds = self.seconds()
+        return {'edge': str(uuid.UUID(bytes=self.edge_id)),
+                'direction': self.direction,
+                'bytes': self.bytes,
+                'seconds': seconds,
+                'throughput': self.bytes / seconds if seconds > 0 else 0,
+                'done': self.end_time is not None}
+
+
+class PeerConnection:
+    """ A connection to the data plane of another machine that carries many edges. """
+
+    def __init__(self, plane, sock):
+        self.plane = plane
+        self.sock = sock
+        self.send_lock = Lock()
+        Thread(target=self.receive_frames, daemon=True).start()
+
+    ## Sends a frame, followed by length bytes that are moved from the data_fd
+    def send_frame(self, kind, edge_id, value, data_fd=None):
+        with self.send_lock:
+            self.sock.sendall(FRAME_HEADER.pack(kind, edge_id, value))
+            if data_fd is not None:
+                transfer_exactly(data_fd, self.sock.fileno(), value)
+
+    def receive_frames(self):
+        try:
+            while True:
+                header = recv_exactly(self.sock, FRAME_HEADER.size)
+                if header is None:
+                    break
+                kind, edge_id, value = FRAME_HEADER.unpack(header)
+                ## The frames of an edge can still arrive after it was finished (or cancelled)
+                if kind == DATA:
+                    reader = self.plane.find_edge(self.plane.readers, edge_id)
+                    if reader is None:
+                        discard(self.sock.fileno(), value)
+                    else:
+                        reader.receive(edge_id, self.sock.fileno(), value)
+                elif kind == END:
+                    reader = self.plane.find_edge(self.plane.readers, edge_id)
+                    if reader is not None:
+                        reader.finish(edge_id)
+                elif kind == SUBSCRIBE:
+                    self.plane.subscribe(edge_id, self, value)
+                elif kind == CREDIT:
+                    writer = self.plane.find_edge(self.plane.writers, edge_id)
+                    if writer is not None:
+                        writer.add_credit(value)
+                elif kind == CANCEL:
+                    self.plane.get_writer(edge_id).cancel()
+                else:
+                    raise ValueError(f"unknown frame kind {kind}")
+        except (OSError, ValueError) as e:
+            log("Peer connection failed:", e)
+        finally:
+            self.plane.remove_connection(self)
+            self.sock.close()
+
+
+class EdgeWriter:
+    """ Sends the data of a local path (the input of a write node) to the reader of the edge. """
+
+    def __init__(self, plane, edge_id):
+        self.plane = plane
+        self.edge_id = edge_id
+        self.stats = EdgeStats(edge_id, "write")
+        self.condition = Condition()
+        self.connection = None
+        self.credit = 0
+        ## Set when the reader takes the data of the edge from another writer
+        self.cancelled = False
+        self.done = Event()
+
+    def add_credit(self, credit):
+        with self.condition:
+            self.credit += credit
+            self.condition.notify()
+
+    def subscribe(self, connection, credit):
+        with self.condition:
+            self.connection = connection
+            self.credit += credit
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+    def uses_connection(self, connection):
+        with self.condition:
+            return self.connection is connection
+
+    def status(self):
+        return "CANCELLED" if self.cancelled else "DONE"
+
+    ## Returns no connection if the edge was cancelled
+    def wait_credit(self, credit_needed=True):
+        with self.condition:
+            while not self.cancelled and (self.connection is None or (credit_needed and self.credit == 0)):
+                self.condition.wait()
+            if self.cancelled:
+                return None, 0
+            return self.connection, self.credit
+
+    def run(self, path):
+        stage_read, stage_write, stage_size = make_pipe(self.plane.chunk_size)
+        ## Opening a fifo for reading waits for a writer, which might have already written its
+        ##   data and exited (the data stays in the fifo that the node still has open)
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(fd, True)
+        try:
+            while True:
+                connection, credit = self.wait_credit()
+                if connection is None:
+                    return
+                ## Stage the data in a pipe to know the length of the frame before sending it
+                moved = transfer(fd, stage_write, min(credit, self.plane.chunk_size, stage_size))
+                if moved == 0:
+                    break
+                connection.send_frame(DATA, self.edge_id, moved, stage_read)
+                with self.condition:
+                    self.credit -= moved
+                self.stats.bytes += moved
+            connection, _credit = self.wait_credit(credit_needed=False)
+            if connection is not None:
+                connection.send_frame(END, self.edge_id, 0)
+        finally:
+            os.close(fd)
+            os.close(stage_read)
+            os.close(stage_write)
+            self.stats.end_time = time.time()
+            self.done.set()
+
+
+class EdgeSource:
+    """ A writer of the data of an edge that is read on this machine (the original one or a backup). """
+
+    def __init__(self, edge_id, connection):
+        self.edge_id = edge_id
+        self.connection = connection
+        ## How many bytes of the edge have been received from it
+        self.offset = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        try:
+            self.connection.send_frame(CANCEL, self.edge_id, 0)
+        except OSError:
+            pass
+
+
+class EdgeReader:
+    """ Writes the data of the edge that arrives from its writer to a local path (the output of a read node). """
+
+    def __init__(self, plane, edge_id):
+        self.plane = plane
+        self.edge_id = edge_id
+        self.stats = EdgeStats(edge_id, "read")
+        ## The data is buffered here until the consumer of the path reads it. The receiving thread
+        ##   never blocks on the buffer, and the data that does not fit goes to the overflow (see fill_buffer).
+        self.buffer_read, self.buffer_write, self.buffer_size = make_pipe(plane.buffer_size)
+        os.set_blocking(self.buffer_write, False)
+        self.overflow = deque()
+        self.lock = Lock()
+        ## The writers of the edge by their edge id, and the one whose data goes to the buffer
+        self.sources = {}
+        self.leader = None
+        ## How many bytes have been written to the buffer
+        self.delivered = 0
+        ## Set when a writer sent all the data of the edge
+        self.complete = False
+        ## Set when the consumer of the path exited before the end of the edge
+        self.consumer_closed = False
+        self.done = Event()
+
+    def add_source(self, edge_id, connection, credit):
+        with self.lock:
+            source = EdgeSource(edge_id, connection)
+            self.sources[edge_id] = source
+            ## The other writers first catch up with the data that was delivered (see receive)
+            if len(self.sources) == 1:
+                self.leader = source
+        connection.send_frame(SUBSCRIBE, edge_id, credit)
+
+    ## Runs in the receiving thread of the connection. The buffer (and its overflow) have room for
+    ##   the data of the leader thanks to the credit, and the data that the buffer already has is dropped.
+    def receive(self, edge_id, sock_fd, length):
+        with self.lock:
+            source = self.sources[edge_id]
+            if source.cancelled or self.buffer_write is None:
+                discard(sock_fd, length)
+                return
+            if source is not self.leader:
+                behind = min(length, self.delivered - source.offset)
+                if behind > 0:
+                    discard(sock_fd, behind)
+                    source.offset += behind
+                    length -= behind
+                    source.connection.send_frame(CREDIT, edge_id, behind)
+                if length == 0:
+                    return
+                ## This writer got ahead of the leader, so it takes over
+                if self.leader is not None:
+                    log(f"Edge {uuid.UUID(bytes=self.edge_id)} continues from {uuid.UUID(bytes=edge_id)} after {self.delivered} bytes")
+                    self.leader.cancel()
+                self.leader = source
+            remaining = length
+            try:
+                ## The data goes to the overflow while it is not empty, so that it stays in order
+                while remaining > 0 and len(self.overflow) == 0:
+                    moved = self.fill_buffer(sock_fd, remaining)
+                    if moved == 0:
+                        break
+                    remaining -= moved
+                if remaining > 0:
+                    self.overflow.append(read_exactly(sock_fd, remaining))
+                    remaining = 0
+            except BrokenPipeError:
+                ## The consumer is gone (see run). The socket is spliced to the buffer, so the failed
+                ##   call consumed nothing, and the rest of the frame is dropped to keep the connection.
+                discard(sock_fd, remaining)
+                self.overflow.clear()
+                self.close_buffer()
+            source.offset += length - remaining
+            self.delivered += length - remaining
+
+    ## Moves at most count bytes from the socket to the buffer without waiting for room in it,
+    ##   and returns how many bytes it took from the socket (0 if the buffer is full).
+    def fill_buffer(self, sock_fd, count):
+        ## The buffer is non-blocking, which makes splice non-blocking for the socket too
+        select.select([sock_fd], [], [])
+        if hasattr(os, "splice"):
+            try:
+                moved = os.splice(sock_fd, self.buffer_write, count)
+                if moved == 0:
+                    raise ConnectionError("unexpected end of stream")
+                return moved
+            except BlockingIOError:
+                return 0
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+        data = os.read(sock_fd, count)
+        if not data:
+            raise ConnectionError("unexpected end of stream")
+        try:
+            written = os.write(self.buffer_write, data)
+        except BlockingIOError:
+            written = 0
+        if written < len(data):
+            self.overflow.append(data[written:])
+        return len(data)
+
+    ## Moves the next data of the buffer, or of the overflow once the buffer is empty, to the
+    ##   consumer and returns its length (0 at the end of the edge).
+    def deliver(self, fd):
+        while True:
+            ## The buffer is read only when it is ready (or closed), since splice between pipes is
+            ##   non-blocking for both if either is, and then a full consumer would look like an empty buffer
+            closed = False
+            if select.select([self.buffer_read], [], [], 0)[0]:
+                moved = transfer(self.buffer_read, fd, self.plane.chunk_size)
+                if moved > 0:
+                    return moved
+                closed = True
+            with self.lock:
+                data = self.overflow.popleft() if len(self.overflow) > 0 else None
+            if data is not None:
+                write_all(fd, data)
+                return len(data)
+            if closed:
+                return 0
+            ## The buffer and the overflow are empty, and new data goes to the buffer first
+            select.select([self.buffer_read], [], [])
+
+    ## Called at the end of the data of a writer
+    def finish(self, edge_id):
+        with self.lock:
+            source = self.sources[edge_id]
+            if source.cancelled:
+                return
+            if source.offset < self.delivered:
+                ## It stopped short of the data that we already have (e.g., it failed)
+                source.cancelled = True
+                self.check_sources()
+                return
+            for other in self.sources.values():
+                if other is not source and not other.cancelled:
+                    other.cancel()
+            self.complete = True
+            self.close_buffer()
+
+    ## Called if the connection to some writers fails. The edge continues from its other writers (if any).
+    def lose_connection(self, connection):
+        with self.lock:
+            for source in self.sources.values():
+                if source.connection is connection:
+                    source.cancelled = True
+            self.check_sources()
+
+    ## Called with the lock held. If no writer is left, the edge waits for a new one (see add_backup)
+    ##   until the source timeout, and then the consumer sees a truncated stream (and the edge fails).
+    def check_sources(self):
+        if self.leader is not None and self.leader.cancelled:
+            self.leader = None
+        if self.buffer_write is None:
+            return
+        if all(source.cancelled for source in self.sources.values()):
+            log(f"Edge {uuid.UUID(bytes=self.edge_id)} has no writer, waiting {self.plane.source_timeout}s for a new one")
+            timer = Timer(self.plane.source_timeout, self.give_up_sources, args=[len(self.sources)])
+            timer.daemon = True
+            timer.start()
+
+    ## Fails the edge unless it got a new writer since it lost its writers
+    def give_up_sources(self, sources_count):
+        with self.lock:
+            if len(self.sources) == sources_count:
+                self.fail()
+
+    ## Called with the lock held
+    def fail(self):
+        if self.buffer_write is not None:
+            log(f"Edge {uuid.UUID(bytes=self.edge_id)} failed after {self.delivered} bytes")
+        self.cancel_sources()
+        self.close_buffer()
+
+    def cancel_sources(self):
+        for source in self.sources.values():
+            if not source.cancelled:
+                source.cancel()
+
+    def close_buffer(self):
+        if self.buffer_write is not None:
+            os.close(self.buffer_write)
+            self.buffer_write = None
+
+    def uses_connection(self, connection):
+        with self.lock:
+            return any(source.connection is connection for source in self.sources.values())
+
+    def status(self):
+        if self.consumer_closed:
+            return "CANCELLED"
+        return "DONE" if self.complete else "FAILED"
+
+    def run(self, path, addr):
+        host, port = addr.rsplit(":", 1)
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            self.add_source(self.edge_id, self.plane.get_connection(host, int(port)), self.buffer_size)
+            while True:
+                try:
+                    moved = self.deliver(fd)
+                except BrokenPipeError:
+                    log(f"Edge {uuid.UUID(bytes=self.edge_id)} lost its consumer after {self.stats.bytes} bytes")
+                    self.consumer_closed = True
+                    break
+                if moved == 0:
+                    break
+                self.stats.bytes += moved
+                with self.lock:
+                    leader = self.leader
+                if leader is not None and not leader.cancelled:
+                    leader.connection.send_frame(CREDIT, leader.edge_id, moved)
+        finally:
+            ## Unless the edge is complete, its writers are not needed anymore, and the data
+            ##   that still arrives is dropped (see receive)
+            with self.lock:
+                if not self.complete:
+                    self.cancel_sources()
+                self.close_buffer()
+            os.close(fd)
+            os.close(self.buffer_read)
+            self.stats.end_time = time.time()
+            self.done.set()
+
+    ## The backup gets a small credit, since its data is dropped (and credited back right away)
+    ##   until it gets ahead of the leader
+    def add_backup(self, backup_edge_id, host, port):
+        self.add_source(backup_edge_id, self.plane.get_connection(host, port), self.plane.chunk_size)
+
+
+class DataPlane:
+    def __init__(self, port=DATA_PLANE_PORT, buffer_size=1024 * 1024, chunk_size=64 * 1024, source_timeout=30):
+        self.port = port
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.source_timeout = source_timeout
+        self.lock = Lock()
+        ## Outgoing connections by (host, port)
+        self.connections = {}
+        self.writers = {}
+        self.readers = {}
+        self.finished = []
+
+    def get_connection(self, host, port):
+        with self.lock:
+            connection = self.connections.get((host, port))
+            if connection is None:
+                sock = socket.create_connection((host, port))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall(PEER_HELLO)
+                connection = PeerConnection(self, sock)
+                self.connections[(host, port)] = connection
+            return connection
+
+    def remove_connection(self, connection):
+        with self.lock:
+            for key in [key for key, value in self.connections.items() if value is connection]:
+                del self.connections[key]
+            readers = set(reader for reader in self.readers.values() if reader.uses_connection(connection))
+            writers = [writer for writer in self.writers.values() if writer.uses_connection(connection)]
+        for reader in readers:
+            log(f"Edge {uuid.UUID(bytes=reader.edge_id)} lost its connection")
+            reader.lose_connection(connection)
+        ## The reader of the edge is gone (it gets the data from a copy of the writer if it is retried)
+        for writer in writers:
+            log(f"Edge {uuid.UUID(bytes=writer.edge_id)} lost its reader")
+            writer.cancel()
+
+    ## The writer might be registered before or after the subscription of the reader arrives
+    def get_writer(self, edge_id) -> EdgeWriter:
+        with self.lock:
+            if edge_id not in self.writers:
+                self.writers[edge_id] = EdgeWriter(self, edge_id)
+            return self.writers[edge_id]
+
+    def find_edge(self, edges, edge_id):
+        with self.lock:
+            return edges.get(edge_id)
+
+    def add_backup(self, edge_id, backup_edge_id, addr):
+        host, port = addr.rsplit(":", 1)
+        with self.lock:
+            reader = self.readers.get(edge_id)
+            if reader is None:
+                raise ValueError(f"unknown edge {uuid.UUID(bytes=edge_id)}")
+            self.readers[backup_edge_id] = reader
+        log(f"Edge {uuid.UUID(bytes=edge_id)} gets the backup writer {uuid.UUID(bytes=backup_edge_id)} on {addr}")
+        reader.add_backup(backup_edge_id, host, int(port))
+
+    def fail_edge(self, edge_id):
+        reader = self.find_edge(self.readers, edge_id)
+        if reader is None:
+            raise ValueError(f"unknown edge {uuid.UUID(bytes=edge_id)}")
+        with reader.lock:
+            reader.fail()
+
+    def subscribe(self, edge_id, connection, credit):
+        self.get_writer(edge_id).subscribe(connection, credit)
+
+    def finish_edge(self, edges, edge):
+        with self.lock:
+            ## A reader is also registered under the edge ids of its backups
+            for edge_id in [edge_id for edge_id, value in edges.items() if value is edge]:
+                del edges[edge_id]
+            self.finished.append(edge.stats)
+            del self.finished[:-FINISHED_EDGES_KEPT]
+        log(f"Edge {uuid.UUID(bytes=edge.edge_id)} ({edge.stats.direction}) moved {edge.stats.bytes} bytes in {edge.stats.seconds():.3f}s")
+
+    def stats(self):
+        with self.lock:
+            ## A reader with backups is registered more than once
+            edges = {id(edge): edge for edge in list(self.writers.values()) + list(self.readers.values())}
+            active = [edge.stats for edge in edges.values()]
+            return [stats.to_dict() for stats in active + self.finished]
+
+    def serve_local(self, conn, line):
+        command = line.split()
+        if command[0] == "WRITE":
+            edge = self.get_writer(uuid.UUID(command[1]).bytes)
+            edges, run_args = self.writers, (command[2],)
+        elif command[0] == "READ":
+            edge = EdgeReader(self, uuid.UUID(command[1]).bytes)
+            with self.lock:
+                self.readers[edge.edge_id] = edge
+            edges, run_args = self.readers, (command[2], command[3])
+        elif command[0] == "STATS":
+            conn.sendall(json.dumps(self.stats()).encode() + b"\n")
+            return
+        elif command[0] == "BACKUP":
+            self.add_backup(uuid.UUID(command[1]).bytes, uuid.UUID(command[2]).bytes, command[3])
+            conn.sendall(b"OK\n")
+            return
+        elif command[0] == "FAIL":
+            self.fail_edge(uuid.UUID(command[1]).bytes)
+            conn.sendall(b"OK\n")
+            return
+        else:
+            raise ValueError(f"unknown command {line}")
+        try:
+            edge.run(*run_args)
+            conn.sendall(f"{edge.status()} {edge.stats.bytes} {edge.stats.seconds():.6f}\n".encode())
+        finally:
+            self.finish_edge(edges, edge)
+
+    def handle(self, conn):
+        try:
+            first_line = bytearray()
+            while not first_line.endswith(b"\n"):
+                byte = conn.recv(1)
+                if not byte:
+                    conn.close()
+                    return
+                first_line.extend(byte)
+            if bytes(first_line) == PEER_HELLO:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                PeerConnection(self, conn)
+                return
+            self.serve_local(conn, first_line.decode().strip())
+        except (OSError, ValueError) as e:
+            log("Request failed:", e)
+        conn.close()
+
+    def run(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("0.0.0.0", self.port))
+        server.listen(128)
+        log(f"Listening on port {self.port}")
+        while True:
+            conn, _addr = server.accept()
+            Thread(target=self.handle, args=[conn], daemon=True).start()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="The data plane of the edges between dspash workers")
+    parser.add_argument("--port", type=int, default=DATA_PLANE_PORT,
+                        help="the port for the nodes and the other data planes")
+    parser.add_argument("--buffer_size", type=int, default=1024 * 1024,
+                        help="the bytes that every edge that is read on this machine buffers (in its pipe and its overflow), i.e., the credit of its writer (default: 1MB)")
+    parser.add_argument("--chunk_size", type=int, default=64 * 1024,
+                        help="the maximum size of a data frame (default: 64KB)")
+    parser.add_argument("--source_timeout", type=float, default=30,
+                        help="how long an edge whose writers were lost waits for a new writer before it fails (default: 30s)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    DataPlane(args.port, args.buffer_size, args.chunk_size, args.source_timeout).run()
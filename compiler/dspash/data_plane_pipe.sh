@@ -0,0 +1,28 @@
+#!/bin/bash
+
+## Connects the input (write) or the output (read) of a node to an edge that crosses machines,
+## through the data plane of this machine (see data_plane.py). It does not start any process.
+##
+## Usage: pash_data_plane_pipe write <host:port> <edge id>  < fifo
+##        pash_data_plane_pipe read <host:port> <edge id>   > fifo
+##   where host:port is the data plane of the machine that writes the edge.
+pash_data_plane_pipe()
+{
+    local direction=$1
+    local addr=$2
+    local id=$3
+    local fd node_fd status
+    exec {fd}<>"/dev/tcp/127.0.0.1/${PASH_DATA_PLANE_PORT:-50053}" || return 1
+    ## The data plane opens our stdin (or stdout) itself. We pass a copy of it since
+    ##   the redirections of echo and read temporarily replace stdin and stdout.
+    if [ "$direction" = "write" ]; then
+        exec {node_fd}<&0
+        echo "WRITE $id /proc/$BASHPID/fd/$node_fd" >&$fd
+    else
+        exec {node_fd}>&1
+        echo "READ $id /proc/$BASHPID/fd/$node_fd $addr" >&$fd
+    fi
+    read -r -u $fd status _
+    exec {fd}>&- {node_fd}>&-
+    [ "$status" = "DONE" ]
+}
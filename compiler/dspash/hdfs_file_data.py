@@ -5,7 +5,8 @@ from collections import namedtuple
 import json
 from typing import List, Tuple
 
-HDFSBlock = namedtuple("HDFSBlock", "path hosts")
+## The size of a block is None if fsck did not report it
+HDFSBlock = namedtuple("HDFSBlock", "path hosts size", defaults=[None])
 
 
 class FileData(object):
@@ -13,6 +14,7 @@ class FileData(object):
         self.blocknames = []
         self.dnodenames = []
         self.machines = []
+        self.blocksizes = []
         self.size = 0
         self.filename = filename
         # self.dnodepath = subprocess.check_output("hdfs getconf -confKey dfs.datanode.data.dir", shell=True).decode("utf-8").strip("\n")
@@ -43,12 +45,13 @@ class HDFSFileConfig:
         self.blocks : List[HDFSBlock] = []
         for i, block_path in enumerate(filedata.paths()):
             hosts = list(map(lambda addr: addr.rsplit(":", 1)[0], filedata.machines[i]))
-            self.blocks.append(HDFSBlock(block_path, hosts))
+            size = filedata.blocksizes[i] if i < len(filedata.blocksizes) else None
+            self.blocks.append(HDFSBlock(block_path, hosts, size))
     
     def _serialize(self):
         data = {"blocks": []}
-        for path, hosts in self.blocks:
-            data["blocks"].append({"path": path, "hosts": hosts})
+        for block in self.blocks:
+            data["blocks"].append({"path": block.path, "hosts": block.hosts})
         return data
 
     def dumps(self):
@@ -66,10 +69,13 @@ class HDFSFileConfig:
         return self.blocks == __o.blocks
 
 def get_hdfs_file_data(filename):
-    info = FileData(filename)
     log = subprocess.check_output(
         "hdfs fsck {0} -files -blocks -locations".format(filename), shell=True, stderr=subprocess.PIPE
     )
+    return parse_fsck_output(filename, log)
+
+def parse_fsck_output(filename, log):
+    info = FileData(filename)
     count = 0
     for line in log.splitlines():
         wordarr = line.split()
@@ -86,6 +92,7 @@ def get_hdfs_file_data(filename):
             rawinfo = wordarr[1].decode("utf-8").split(":")
             info.blocknames.append(rawinfo[1][0 : rawinfo[1].rfind("_")])
             info.dnodenames.append(rawinfo[0])
+            info.blocksizes.append(_getLength(wordarr))
             stline = line.decode("utf-8")
             info.machines.append(
                 _getIPs(stline[stline.find("DatanodeInfoWithStorage") - 1 :])
@@ -95,6 +102,12 @@ def get_hdfs_file_data(filename):
     assert info.size > 0
     return info
 
+def _getLength(wordarr):
+    for word in wordarr:
+        if word.startswith(b"len="):
+            return int(word[len(b"len="):])
+    return None
+
 def _getIPs(raw):
     rawparts = raw.split(" ")
     ips = []
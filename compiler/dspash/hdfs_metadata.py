@@ -0,0 +1,169 @@
+import shlex
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from dspash.hdfs_file_data import FileData, parse_fsck_output
+
+##
+## A cache of the HDFS metadata that the compiler needs (the blocks of files and
+## the datanode configuration), so that we do not start the hdfs tool (and its JVM)
+## on every compilation.
+##
+
+## How long (in seconds) a cached entry is used without checking if the file changed
+HDFS_METADATA_TTL = 60
+
+class HDFSCommandProvider:
+    """ Gets the metadata by running the hdfs command line tool.
+
+    The tool can be replaced (e.g., with a fake fsck script for testing) by
+    passing another command, or the whole provider can be replaced with
+    one that implements stat, fsck, and getconf.
+    """
+
+    def __init__(self, hdfs_cmd="hdfs"):
+        self.hdfs_cmd = hdfs_cmd
+
+    def run(self, args: List[str]) -> bytes:
+        cmd = " ".join([self.hdfs_cmd] + [shlex.quote(arg) for arg in args])
+        return subprocess.check_output(cmd, shell=True, stderr=subprocess.PIPE)
+
+    ## Returns the (modification time, size) of every file, with a single invocation of the tool
+    def stat(self, filenames: List[str]) -> Dict[str, Tuple[int, int]]:
+        output = self.run(["dfs", "-stat", "%Y %b"] + filenames)
+        lines = output.decode("utf-8").splitlines()
+        assert len(lines) == len(filenames)
+        stats = {}
+        for filename, line in zip(filenames, lines):
+            mtime, size = line.split()
+            stats[filename] = (int(mtime), int(size))
+        return stats
+
+    def fsck(self, filename: str) -> bytes:
+        return self.run(["fsck", filename, "-files", "-blocks", "-locations"])
+
+    def getconf(self, key: str) -> str:
+        return self.run(["getconf", "-confKey", key]).decode("utf-8").strip()
+
+
+class CacheEntry:
+    def __init__(self, value, version, fetch_time):
+        self.value = value
+        ## The (modification time, size) of the file when the value was fetched
+        self.version = version
+        self.fetch_time = fetch_time
+
+
+class HDFSMetadataCache:
+    """ A cache of FileData (from fsck) by path and of configuration values by key.
+
+    Entries are used without contacting HDFS for ttl seconds. After that, the files
+    are stat'ed (all together) and fsck only runs again for the ones whose modification
+    time or size changed. The files that are not cached are stat'ed in the same invocation
+    (to know their modification time) and then their fscks run concurrently.
+    Configuration values are refetched after the ttl expires.
+    """
+
+    def __init__(self, provider=None, ttl=HDFS_METADATA_TTL, max_concurrent_fscks=8):
+        self.provider = HDFSCommandProvider() if provider is None else provider
+        self.ttl = ttl
+        self.max_concurrent_fscks = max_concurrent_fscks
+        self.file_data = {}
+        self.conf = {}
+        ## Regions might be compiled concurrently
+        self.lock = Lock()
+
+    def is_fresh(self, entry, now) -> bool:
+        return now - entry.fetch_time < self.ttl
+
+    ## Versions are (modification time, size) pairs, or None if the file could not be stat'ed.
+    ##   A file that is rewritten with the same size only differs in its modification time.
+    def is_same_version(self, version, new_version) -> bool:
+        if version is None or new_version is None:
+            return False
+        return version == new_version
+
+    def evict_expired(self, now):
+        ## Expired file entries are kept since they can be revalidated with a stat
+        ##   (which is cheaper than an fsck), but not forever.
+        for filename in [filename for filename, entry in self.file_data.items()
+                         if now - entry.fetch_time >= 10 * self.ttl]:
+            del self.file_data[filename]
+        for key in [key for key, entry in self.conf.items() if not self.is_fresh(entry, now)]:
+            del self.conf[key]
+
+    def get_file_data(self, filename: str) -> FileData:
+        return self.get_files_data([filename])[filename]
+
+    def get_files_data(self, filenames: List[str]) -> Dict[str, FileData]:
+        with self.lock:
+            return self._get_files_data(filenames)
+
+    def _get_files_data(self, filenames: List[str]) -> Dict[str, FileData]:
+        now = time.time()
+        self.evict_expired(now)
+        filenames = list(dict.fromkeys(filenames))
+        expired = [filename for filename in filenames
+                   if filename in self.file_data and not self.is_fresh(self.file_data[filename], now)]
+        missing = [filename for filename in filenames if filename not in self.file_data]
+
+        ## Revalidate the expired entries and get the versions of the missing ones.
+        ##   The stat has to happen before the fscks, so that if a file changes in between,
+        ##   its entry has the old version and it is fetched again when it is revalidated.
+        versions = {}
+        if len(expired) + len(missing) > 0:
+            try:
+                versions = self.provider.stat(expired + missing)
+            except (subprocess.CalledProcessError, AssertionError, ValueError):
+                ## Some file might not exist anymore, fsck will report it
+                pass
+            for filename in expired:
+                entry = self.file_data[filename]
+                if self.is_same_version(entry.version, versions.get(filename)):
+                    entry.version = versions[filename]
+                    entry.fetch_time = now
+                else:
+                    missing.append(filename)
+
+        ## Run fsck for all the files that are not cached concurrently
+        if len(missing) > 0:
+            def fetch(filename):
+                return parse_fsck_output(filename, self.provider.fsck(filename))
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrent_fscks, len(missing))) as executor:
+                fetched = list(executor.map(fetch, missing))
+            for filename, file_data in zip(missing, fetched):
+                version = versions.get(filename)
+                ## The file changed between the stat and the fsck, it will be fetched again
+                if version is not None and version[1] != file_data.size:
+                    version = None
+                self.file_data[filename] = CacheEntry(file_data, version, now)
+
+        return {filename: self.file_data[filename].value for filename in filenames}
+
+    def get_conf(self, key: str) -> str:
+        with self.lock:
+            now = time.time()
+            entry = self.conf.get(key)
+            if entry is None or not self.is_fresh(entry, now):
+                entry = CacheEntry(self.provider.getconf(key), None, now)
+                self.conf[key] = entry
+            return entry.value
+
+    def clear(self):
+        with self.lock:
+            self.file_data.clear()
+            self.conf.clear()
+
+
+metadata_cache = HDFSMetadataCache()
+
+## Replaces the provider of the cache (and drops its entries), e.g., with a fake one for testing
+def set_provider(provider, ttl=HDFS_METADATA_TTL):
+    global metadata_cache
+    metadata_cache = HDFSMetadataCache(provider, ttl)
+
+def get_metadata_cache() -> HDFSMetadataCache:
+    return metadata_cache
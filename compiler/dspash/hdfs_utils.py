@@ -1,9 +1,6 @@
-from dspash.hdfs_file_data import get_hdfs_file_data, FileData, HDFSFileConfig
-from typing import List, Tuple
-
-def get_cmd_output(cmd:str):
-    ret = subprocess.check_output(cmd, shell=True, universal_newlines=True, stderr=subprocess.PIPE)
-    return ret.strip()
+from dspash.hdfs_file_data import get_hdfs_file_data, FileData, HDFSFileConfig, HDFSBlock
+from dspash.hdfs_metadata import get_metadata_cache
+from typing import Dict, List, Tuple
 
 def _remove_prefix(s:str, prefix:str) -> str:
     if s.startswith(prefix):
@@ -11,14 +8,89 @@ def _remove_prefix(s:str, prefix:str) -> str:
     return s
 
 def get_datanode_dir() -> str:
-    data_dir = get_cmd_output("hdfs getconf -confKey dfs.datanode.data.dir")
+    data_dir = get_metadata_cache().get_conf("dfs.datanode.data.dir")
     data_dir = _remove_prefix(data_dir, "file://")
     return data_dir
 
 def get_file_data(filename: str) -> FileData:
-    return get_hdfs_file_data(filename)
+    return get_metadata_cache().get_file_data(filename)
+
+## Looks up the metadata of all files at once (the fscks that are needed run concurrently)
+def get_files_data(filenames: List[str]) -> Dict[str, FileData]:
+    return get_metadata_cache().get_files_data(filenames)
 
 def get_file_config(filename: str) -> HDFSFileConfig:
     filedata = get_file_data(filename)
     return HDFSFileConfig(filedata)
 
+def assign_blocks_to_hosts(blocks: List[HDFSBlock], fan_out: int = None) -> List[Tuple[List[int], str]]:
+    """ Groups the blocks of a file into at most fan_out readers and assigns each
+    reader to one of the hosts that store all of its blocks.
+
+    Every group consists of adjacent blocks (so that a reader outputs a contiguous
+    part of the file) that have a common replica, and groups are filled up to
+    an equal share of the bytes of the file. Then the groups are assigned,
+    biggest first, to the replica that has been assigned the fewest bytes so far,
+    so that all datanodes read a similar amount of data locally.
+    If the blocks cannot be grouped locally, there are more groups than the fan_out.
+
+    Returns: A list of (block indices, host) pairs, in the order of the blocks
+    """
+    if len(blocks) == 0:
+        return []
+    if fan_out is None or fan_out > len(blocks):
+        fan_out = len(blocks)
+
+    ## Blocks with unknown size are assumed to be as big as the biggest known one
+    known_sizes = [block.size for block in blocks if block.size is not None]
+    default_size = max(known_sizes) if len(known_sizes) > 0 else 1
+    sizes = [default_size if block.size is None else block.size for block in blocks]
+    target_size = sum(sizes) / fan_out
+
+    groups = []
+    group = []
+    group_size = 0
+    group_hosts = set()
+    for i, block in enumerate(blocks):
+        common_hosts = group_hosts.intersection(block.hosts)
+        ## Leave at least one block for each of the remaining groups
+        remaining_groups = fan_out - len(groups) - 1
+        fits = group_size + sizes[i] <= target_size * 1.0001
+        if len(group) > 0 and (len(common_hosts) == 0 or not fits or len(blocks) - i <= remaining_groups):
+            groups.append((group, group_size, group_hosts))
+            group, group_size, common_hosts = [], 0, set(block.hosts)
+        elif len(group) == 0:
+            common_hosts = set(block.hosts)
+        group.append(i)
+        group_size += sizes[i]
+        group_hosts = common_hosts
+    groups.append((group, group_size, group_hosts))
+
+    assigned_bytes = {}
+    group_hosts = [None] * len(groups)
+    for index in sorted(range(len(groups)), key=lambda index: -groups[index][1]):
+        _group, size, hosts = groups[index]
+        ## Sort the hosts so that ties are broken deterministically
+        host = min(sorted(hosts), key=lambda host: assigned_bytes.get(host, 0))
+        assigned_bytes[host] = assigned_bytes.get(host, 0) + size
+        group_hosts[index] = host
+
+    ## Move groups away from the busiest host while that lowers its bytes
+    ##   (the greedy assignment can get stuck because of the replica constraints)
+    improved = True
+    while improved:
+        improved = False
+        busiest_host = max(sorted(assigned_bytes), key=lambda host: assigned_bytes[host])
+        for index, (_group, size, hosts) in enumerate(groups):
+            if group_hosts[index] != busiest_host:
+                continue
+            for host in sorted(hosts):
+                if assigned_bytes.get(host, 0) + size < assigned_bytes[busiest_host]:
+                    assigned_bytes[busiest_host] -= size
+                    assigned_bytes[host] = assigned_bytes.get(host, 0) + size
+                    group_hosts[index] = host
+                    improved = True
+                    break
+            if improved:
+                break
+    return [(group, host) for (group, _size, _hosts), host in zip(groups, group_hosts)]
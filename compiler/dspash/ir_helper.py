@@ -1,14 +1,14 @@
 import argparse
 import sys
 import socket
-import pickle
 import traceback
 from datetime import datetime
-from typing import List, Set, Tuple, Dict, Callable
+from typing import List, Set, Tuple, Dict, Callable, Optional
 from uuid import uuid4
 sys.path.append("/pash/compiler")
 
 import config
+import ir_serialization
 from ir import *
 from ast_to_ir import compile_asts
 from ir_to_ast import to_shell
@@ -25,6 +25,8 @@ import definitions.ir.nodes.r_split as r_split
 import definitions.ir.nodes.r_unwrap as r_unwrap
 import definitions.ir.nodes.dgsh_tee as dgsh_tee
 import definitions.ir.nodes.remote_pipe as remote_pipe
+from dspash.data_plane import DATA_PLANE_PORT
+from edge_compression import EdgeCodecChooser, changes_data, make_edge_codec_chooser, compress_edge
 import shlex
 import subprocess
 import pash_compiler
@@ -34,10 +36,17 @@ HOST = socket.gethostbyname(socket.gethostname())
 NEXT_PORT = 58000
 DISCOVERY_PORT = 50052
 
+## With --dspash_data_plane the edges between machines go through their data planes
+##   (see data_plane.py) instead of starting remote read/write processes that meet at the discovery server
+def make_remote_pipe(inputs, outputs, host_ip, is_remote_read, edge_uid):
+    if config.pash_args.dspash_data_plane:
+        return remote_pipe.make_data_plane_pipe(inputs, outputs, host_ip, DATA_PLANE_PORT, is_remote_read, edge_uid)
+    return remote_pipe.make_remote_pipe(inputs, outputs, host_ip, DISCOVERY_PORT, is_remote_read, edge_uid)
+
 
 def read_graph(filename):
     with open(filename, "rb") as ir_file:
-        ir, shell_vars = pickle.load(ir_file)
+        ir, (shell_vars,) = ir_serialization.load_graph(ir_file)
     return ir, shell_vars
 
 def save_configs(graph:IR, dfs_configs_paths: Dict[HDFSFileConfig, str]):
@@ -168,13 +177,180 @@ def split_ir(graph: IR) -> Tuple[List[IR], Dict[int, IR]]:
     # print(list(map(lambda k : k.all_fids(), graphs)))
     return subgraphs, input_fifo_map
 
+## How much more than the average load (the number of processes) a worker can get
+##   so that the subgraphs that exchange data can be kept on the same worker
+CLUSTER_LOAD_SLACK = 0.25
+
+def subgraph_output_fids(subgraph: IR) -> List[FileId]:
+    """ Returns the output edges of the sink nodes of the subgraph (that go to other subgraphs or the main graph) """
+    return [fid for sink in subgraph.sink_nodes()
+                for fid in subgraph.get_node_output_fids(sink)
+                if subgraph.edges[fid.get_ident()][2] is None]
+
+def subgraph_consumer(edge: FileId, input_fifo_map: Dict[int, IR]):
+    """ Returns the subgraph that reads an output edge of a subgraph, or None if the main graph reads it """
+    if edge.get_ident() in input_fifo_map and edge.is_ephemeral():
+        return input_fifo_map[edge.get_ident()][0]
+    return None
+
+def estimate_edge_volumes(subgraphs: List[IR], input_fifo_map: Dict[int, IR]) -> Dict[int, float]:
+    """ Estimates the data that flows through every edge between subgraphs, in units of
+    the size of an input of the script (assuming that all inputs have the same size).
+    Every subgraph is assumed to output as much as it reads, split evenly over its output edges.
+    """
+    producers = {fid.get_ident(): subgraph for subgraph in subgraphs for fid in subgraph_output_fids(subgraph)}
+    volumes = {}
+    ## Visit the subgraphs in topological order (a subgraph after all the subgraphs that it reads from)
+    remaining = {subgraph: set(producers[fid.get_ident()] for source in subgraph.source_nodes()
+                                   for fid in subgraph.get_node_input_fids(source)
+                                   if fid.get_ident() in producers)
+                 for subgraph in subgraphs}
+    workset = deque(subgraph for subgraph, previous in remaining.items() if len(previous) == 0)
+    while workset:
+        subgraph = workset.popleft()
+        input_volume = sum(volumes.get(fid.get_ident(), 1.0)
+                           for source in subgraph.source_nodes()
+                           for fid in subgraph.get_node_input_fids(source))
+        output_fids = subgraph_output_fids(subgraph)
+        for fid in output_fids:
+            volumes[fid.get_ident()] = input_volume / len(output_fids)
+            consumer = subgraph_consumer(fid, input_fifo_map)
+            if consumer is not None and subgraph in remaining[consumer]:
+                remaining[consumer].remove(subgraph)
+                if len(remaining[consumer]) == 0:
+                    workset.append(consumer)
+    return volumes
+
+def subgraph_sample_fids(subgraphs: List[IR]) -> Dict[IR, Optional[List[FileId]]]:
+    """ Returns the input files of the script that the data written by each subgraph comes from
+    (the ones that it reads and the ones upstream of it), to choose the codecs of its output edges
+    from a sample of them. It is None for the subgraphs that have a command that changes the data
+    (see edge_compression.changes_data), or one upstream of them, since the sample says nothing
+    about their data then. This has to run before the edges between the subgraphs are replaced.
+    """
+    producers = {fid.get_ident(): subgraph for subgraph in subgraphs for fid in subgraph_output_fids(subgraph)}
+    sample_fids = {}
+    def visit(subgraph):
+        if subgraph in sample_fids:
+            return sample_fids[subgraph]
+        fids = []
+        for fid in subgraph.all_input_fids():
+            if fid.get_ident() in producers:
+                upstream_fids = visit(producers[fid.get_ident()])
+                if upstream_fids is None:
+                    fids = None
+                    break
+                fids.extend(upstream_fids)
+            elif fid.has_file_resource():
+                fids.append(fid)
+        if fids is not None and any(changes_data(node) for node in subgraph.nodes.values()):
+            fids = None
+        sample_fids[subgraph] = fids
+        return fids
+    for subgraph in subgraphs:
+        visit(subgraph)
+    return sample_fids
+
+def merge_subgraphs(subgraphs: List[IR]) -> IR:
+    """ Returns a graph with the nodes and edges of all the subgraphs, where the
+    edges between them become plain (local) edges.
+    """
+    merged = IR({}, {})
+    for subgraph in subgraphs:
+        for edge_id, (fid, from_node, to_node) in subgraph.edges.items():
+            if edge_id in merged.edges:
+                _fid, merged_from, merged_to = merged.edges[edge_id]
+                from_node = merged_from if from_node is None else from_node
+                to_node = merged_to if to_node is None else to_node
+            merged.set_edge(edge_id, fid, from_node, to_node)
+    for subgraph in subgraphs:
+        for node in subgraph.nodes.values():
+            merged.add_node(node)
+    ## The outputs of the merged graph go to several workers
+    merged.wait_for_all_sinks = True
+    return merged
+
+def cluster_subgraphs(subgraphs: List[IR], input_fifo_map: Dict[int, IR], num_workers: int) -> Tuple[List[IR], Dict[int, IR]]:
+    """ Groups the subgraphs returned from split_ir so that the subgraphs that exchange
+    the most data run on the same worker, where the edges between them stay local.
+
+    The edges between subgraphs are visited from the one with the most data (see estimate_edge_volumes)
+    and the groups of their two ends are merged if the merged group does not have more processes than
+    the average number of processes of a worker (plus CLUSTER_LOAD_SLACK). For example, the splitter
+    of a width-16 graph on 4 workers is grouped with the first mappers that it feeds, and the merger
+    with some of the rest of the mappers. Groups that both read remote (e.g., HDFS) files are not
+    merged so that each of them can run where its files are stored.
+
+    Args:
+        subgraphs: the subgraphs returned from split_ir
+        input_fifo_map: the mapping returned from split_ir
+        num_workers: the number of workers that the subgraphs will be assigned to
+    Returns:
+        the merged subgraphs and the input_fifo_map for them (like split_ir)
+    """
+    if num_workers <= 0 or len(subgraphs) <= 1:
+        return subgraphs, input_fifo_map
+
+    loads = {subgraph: len(subgraph.nodes) for subgraph in subgraphs}
+    max_load = sum(loads.values()) / num_workers * (1 + CLUSTER_LOAD_SLACK)
+    reads_remote_files = {subgraph: any(fid.has_remote_file_resource() for fid in subgraph.all_fids())
+                          for subgraph in subgraphs}
+    ## Union-find over the subgraphs
+    group_of = {subgraph: subgraph for subgraph in subgraphs}
+    def find(subgraph):
+        while group_of[subgraph] is not subgraph:
+            group_of[subgraph] = group_of[group_of[subgraph]]
+            subgraph = group_of[subgraph]
+        return subgraph
+
+    volumes = estimate_edge_volumes(subgraphs, input_fifo_map)
+    cross_edges = [(volumes.get(fid.get_ident(), 0.0), producer, consumer)
+                   for producer in subgraphs
+                   for fid in subgraph_output_fids(producer)
+                   for consumer in [subgraph_consumer(fid, input_fifo_map)]
+                   if consumer is not None]
+    ## The sort is stable so among equal edges the ones of earlier subgraphs (e.g., the splitter) go first
+    cross_edges.sort(key=lambda edge: edge[0], reverse=True)
+    for _volume, producer, consumer in cross_edges:
+        producer_group, consumer_group = find(producer), find(consumer)
+        if producer_group is consumer_group:
+            continue
+        if loads[producer_group] + loads[consumer_group] > max_load:
+            continue
+        if reads_remote_files[producer_group] and reads_remote_files[consumer_group]:
+            continue
+        group_of[consumer_group] = producer_group
+        loads[producer_group] += loads[consumer_group]
+        reads_remote_files[producer_group] = reads_remote_files[producer_group] or reads_remote_files[consumer_group]
+
+    groups = {}
+    for subgraph in subgraphs:
+        groups.setdefault(find(subgraph), []).append(subgraph)
+    merged_of = {}
+    clusters = []
+    for members in groups.values():
+        cluster = members[0] if len(members) == 1 else merge_subgraphs(members)
+        clusters.append(cluster)
+        for member in members:
+            merged_of[member] = cluster
+
+    cluster_fifo_map = defaultdict(list)
+    for edge_id, readers in input_fifo_map.items():
+        cluster_fifo_map[edge_id] = [merged_of.get(reader, reader) for reader in readers]
+    total_volume = sum(volume for volume, _producer, _consumer in cross_edges)
+    remote_volume = sum(volume for volume, producer, consumer in cross_edges if find(producer) is not find(consumer))
+    log(f"Grouped {len(subgraphs)} subgraphs in {len(clusters)} groups for {num_workers} workers",
+        f"(estimated data between workers: {remote_volume:.2f} out of {total_volume:.2f} inputs)")
+    return clusters, cluster_fifo_map
+
 def add_stdout_fid(graph : IR, file_id_gen: FileIdGen) -> FileId:
     stdout = file_id_gen.next_file_id()
     stdout.set_resource(FileDescriptorResource(('fd', 1)))
     graph.add_edge(stdout)
     return stdout
 
-def assign_workers_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, input_fifo_map:Dict[int, IR], get_worker: Callable) -> (IR, Tuple):
+def assign_workers_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, input_fifo_map:Dict[int, IR], get_worker: Callable,
+                                edge_codecs: EdgeCodecChooser = None) -> (IR, Tuple):
     """ Takes a list of subgraphs and assigns a worker to each subgraph and augment
     the subgraphs with the necessary remote read/write nodes for data movement 
     between workers. This function also produces graph that should run in 
@@ -186,6 +362,7 @@ def assign_workers_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, inpu
         file_id_gen: file id generator of the original ir
         input_fifo_map: mapping from input idge id to subgraph (returned from split_ir)
         get_worker: a callback for getting a worker from worker manager
+        edge_codecs: chooses the codec (if any) that compresses the data of each remote edge (none by default)
     Returns:
         main_graph: the graph to execute on main shell
         worker_subgraph_pairs: A list of pairs representing which worker
@@ -194,27 +371,25 @@ def assign_workers_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, inpu
     # The graph to execute in the main pash_compiler
     main_graph = IR({}, {})
     worker_subgraph_pairs = []
+    if edge_codecs is None:
+        edge_codecs = EdgeCodecChooser("no", 0, "")
+    # The input files that the data of each subgraph comes from (that are sampled to choose the codecs of its output edges)
+    sample_fids = subgraph_sample_fids(subgraphs)
 
     # Replace output edges and corrosponding input edges with remote read/write
     for subgraph in subgraphs:
         subgraph_critical_fids = list(filter(lambda fid: fid.has_remote_file_resource(), subgraph.all_fids()))
         worker = get_worker(subgraph_critical_fids)
-        worker._running_processes += 1
+        worker.assign_subgraph()
         worker_subgraph_pairs.append((worker, subgraph))
-        sink_nodes = subgraph.sink_nodes()
-        assert(len(sink_nodes) == 1)
         
-        for out_edge in subgraph.get_node_output_fids(sink_nodes[0]):
+        for out_edge in subgraph_output_fids(subgraph):
             stdout = add_stdout_fid(subgraph, file_id_gen)
             out_edge_id = out_edge.get_ident()
             # Replace the old edge with an ephemeral edge in case it isn't and
             # to avoid modifying the edge in case it's used in some other subgraph
             ephemeral_edge = file_id_gen.next_ephemeral_file_id()
             subgraph.replace_edge(out_edge_id, ephemeral_edge)
-            edge_uid = uuid4()
-            # Add remote-write node at the end of the subgraph
-            remote_write = remote_pipe.make_remote_pipe([ephemeral_edge.get_ident()], [stdout.get_ident()], worker.host(), DISCOVERY_PORT, False, edge_uid)
-            subgraph.add_node(remote_write)
             
             # Copy the old output edge resource
             new_edge = file_id_gen.next_file_id()
@@ -227,8 +402,17 @@ def assign_workers_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, inpu
             else:
                 matching_subgraph = main_graph
                 matching_subgraph.add_edge(new_edge)
-    
-            remote_read = remote_pipe.make_remote_pipe([], [new_edge.get_ident()], worker.host(), DISCOVERY_PORT, True, edge_uid)
+
+            codec = edge_codecs.codec_for(sample_fids[subgraph])
+            write_input_id, read_output_id = compress_edge(codec, subgraph, ephemeral_edge.get_ident(),
+                                                           matching_subgraph, new_edge.get_ident(), file_id_gen)
+
+            edge_uid = uuid4()
+            # Add remote-write node at the end of the subgraph
+            remote_write = make_remote_pipe([write_input_id], [stdout.get_ident()], worker.host(), False, edge_uid)
+            subgraph.add_node(remote_write)
+
+            remote_read = make_remote_pipe([], [read_output_id], worker.host(), True, edge_uid)
             matching_subgraph.add_node(remote_read)
 
     # Replace non ephemeral input edges with remote read/write
@@ -245,16 +429,20 @@ def assign_workers_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, inpu
                     new_edge.set_resource(in_edge.get_resource())
                     main_graph.add_edge(new_edge)
 
+                    ephemeral_edge = file_id_gen.next_ephemeral_file_id()
+                    subgraph.replace_edge(in_edge.get_ident(), ephemeral_edge)
+
+                    codec = edge_codecs.codec_for([in_edge])
+                    write_input_id, read_output_id = compress_edge(codec, main_graph, new_edge.get_ident(),
+                                                                   subgraph, ephemeral_edge.get_ident(), file_id_gen)
+
                     # Add remote write to main subgraph
                     edge_uid = uuid4()
-                    remote_write = remote_pipe.make_remote_pipe([new_edge.get_ident()], [stdout.get_ident()], HOST, DISCOVERY_PORT, False, edge_uid)
+                    remote_write = make_remote_pipe([write_input_id], [stdout.get_ident()], HOST, False, edge_uid)
                     main_graph.add_node(remote_write)
 
                     # Add remote read to current subgraph
-                    ephemeral_edge = file_id_gen.next_ephemeral_file_id()
-                    subgraph.replace_edge(in_edge.get_ident(), ephemeral_edge)
-
-                    remote_read = remote_pipe.make_remote_pipe([], [ephemeral_edge.get_ident()], HOST, DISCOVERY_PORT, True, edge_uid)
+                    remote_read = make_remote_pipe([], [read_output_id], HOST, True, edge_uid)
                     subgraph.add_node(remote_read)
                 else:
                     # sometimes a command can have both a file resource and an ephemeral resources (example: spell oneliner)
@@ -262,7 +450,7 @@ def assign_workers_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, inpu
 
     return main_graph, worker_subgraph_pairs
 
-def prepare_graph_for_remote_exec(filename:str, get_worker:Callable):
+def prepare_graph_for_remote_exec(filename:str, get_worker:Callable, num_workers:int = 0):
     """
     Reads the complete ir from filename and splits it
     into subgraphs where ony the first subgraph represent a continues
@@ -270,6 +458,8 @@ def prepare_graph_for_remote_exec(filename:str, get_worker:Callable):
     Note: All subgraphs(except first one) read and write from remote pipes.
         However, we had to add a fake stdout to avoid some problems when converting to shell code.
 
+    With --dspash_cluster_subgraphs, the subgraphs are grouped for the num_workers workers (see cluster_subgraphs).
+
     Returns: 
         worker_graph_pairs: List of (worker, subgraph)
         shell_vars: shell variables
@@ -282,5 +472,8 @@ def prepare_graph_for_remote_exec(filename:str, get_worker:Callable):
     ir, shell_vars = read_graph(filename)
     file_id_gen = ir.get_file_id_gen()
     subgraphs, mapping = split_ir(ir)
-    main_graph, worker_graph_pairs = assign_workers_to_subgraphs(subgraphs, file_id_gen, mapping, get_worker)
+    if config.pash_args.dspash_cluster_subgraphs:
+        subgraphs, mapping = cluster_subgraphs(subgraphs, mapping, num_workers)
+    edge_codecs = make_edge_codec_chooser(config.pash_args, shell_vars)
+    main_graph, worker_graph_pairs = assign_workers_to_subgraphs(subgraphs, file_id_gen, mapping, get_worker, edge_codecs)
     return worker_graph_pairs, shell_vars, main_graph
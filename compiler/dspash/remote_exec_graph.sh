@@ -7,4 +7,5 @@ response=($(echo "Exec-Graph: $ir_file $declared_functions" | nc -U "$DSPASH_SOC
 status=${response[0]} #do something if false
 script_to_execute=${response[1]}
 
+source "$PASH_TOP/compiler/dspash/data_plane_pipe.sh"
 source "$script_to_execute"
@@ -0,0 +1,154 @@
+import copy
+import statistics
+import time
+from uuid import uuid4
+
+from definitions.ir.nodes.remote_pipe import DataPlanePipe
+from dspash.data_plane import DATA_PLANE_PORT
+from ir import IR
+
+##
+## Speculative re-execution of the straggler subgraphs (see --dspash_speculation).
+##
+## The workers report how many bytes each of their edges has written through the data plane
+## (see load_report in worker.py), i.e., the progress of every subgraph on its output edges.
+## A running subgraph is a straggler if it writes much slower than the other subgraphs of
+## its graph that run the same commands (e.g., the mappers of a parallel stage). If all the
+## inputs of a straggler can be replayed, i.e., it reads them itself from files on its worker
+## (such as HDFS blocks) instead of receiving them from another machine, a backup copy of it
+## is started on another worker. The readers of its edges then take the data from whichever
+## copy gets ahead and cancel the other one (see BACKUP in data_plane.py).
+##
+## The same copies are used to retry the subgraphs of a worker that failed (see
+## --dspash_fault_tolerance). The data of the edges that a lost subgraph was reading is gone
+## with it, so these edges are replayed by copies of their writers, and so on, until the
+## subgraphs that only read files.
+##
+
+## Subgraphs are only compared after they have been running for this long (in seconds)
+MIN_RUNTIME = 2
+## A straggler writes slower than this fraction of the median rate of its siblings
+SLOW_RATE_RATIO = 0.5
+
+class SubgraphRun:
+    """ A subgraph that was sent to a worker (or a copy of one, i.e., a backup or a retry). """
+
+    def __init__(self, job_id, worker, subgraph: IR, key, width, functions, reader_hosts, original=None, edges=None):
+        self.id = str(uuid4())
+        ## The subgraphs of the same graph share a job id
+        self.job_id = job_id
+        self.worker = worker
+        self.subgraph = subgraph
+        ## The profile key of the subgraph (see subgraph_profile_key), the same for all the subgraphs with the same commands
+        self.key = key
+        ## The number of subgraphs of the graph (for the profile store)
+        self.width = width
+        self.functions = functions
+        ## The ids of the output edges of the subgraph and the hosts where they are read
+        self.output_edges = [node.get_edge_uid() for node in data_plane_pipes(subgraph) if node.is_write()]
+        self.reader_hosts = reader_hosts
+        self.replayable = is_replayable(subgraph)
+        self.start_time = time.time()
+        self.end_time = None
+        self.exit_code = None
+        ## Set if the worker of the subgraph failed while it was running
+        self.lost = False
+        ## The original run of a copy, and all the runs of an original (including itself)
+        self.original = self if original is None else original
+        self.copies = [self]
+        ## The edge ids of the original that the copy writes with new ids (see make_backup_subgraph),
+        ##   and the ones among them that are read by another copy instead of the reader of the original
+        self.edges = {} if edges is None else edges
+        self.private_edges = set()
+        ## Set if a backup was needed but it could not be started
+        self.backup_failed = False
+
+    def is_copy(self):
+        return self.original is not self
+
+    def is_running(self):
+        return self.end_time is None
+
+    def finish(self, exit_code):
+        self.end_time = time.time()
+        self.exit_code = exit_code
+
+    def lose(self):
+        self.end_time = time.time()
+        self.lost = True
+
+    ## The bytes per second that the subgraph writes on its output edges
+    def rate(self, edge_progress, now):
+        elapsed = (now if self.end_time is None else self.end_time) - self.start_time
+        if elapsed <= 0:
+            return 0
+        return sum(edge_progress.get(edge, 0) for edge in self.output_edges) / elapsed
+
+    def __str__(self):
+        return f"Subgraph {self.id} on {self.worker}"
+
+def data_plane_pipes(graph: IR):
+    return [node for node in graph.nodes.values() if isinstance(node, DataPlanePipe)]
+
+## A subgraph can be executed again if it does not receive anything from another machine or its
+##   shell (e.g., stdin), i.e., it only reads files on the worker (the ones that the main shell sends
+##   through the data plane are streamed only once, so they cannot be replayed).
+def is_replayable(subgraph: IR) -> bool:
+    if any(not node.is_write() for node in data_plane_pipes(subgraph)):
+        return False
+    input_fids = [subgraph.get_edge_fid(edge_id) for edge_id in subgraph.input_edge_ids]
+    return all(fid.has_file_resource() or fid.has_remote_file_resource() for fid in input_fids)
+
+## Returns the host where every edge is read, given the (host, graph) pairs of all the graphs of a job
+def find_reader_hosts(host_graph_pairs):
+    return {node.get_edge_uid(): host
+            for host, graph in host_graph_pairs
+            for node in data_plane_pipes(graph)
+            if not node.is_write()}
+
+def find_stragglers(runs, edge_progress, now):
+    """ Returns the running original subgraphs that write much slower than their siblings
+    (the subgraphs of the same job with the same commands) and that can get a backup.
+    """
+    siblings = {}
+    for run in runs:
+        if not run.is_copy():
+            siblings.setdefault((run.job_id, run.key), []).append(run)
+
+    stragglers = []
+    for group in siblings.values():
+        if len(group) < 2:
+            continue
+        rates = {run: run.rate(edge_progress, now) for run in group}
+        median_rate = statistics.median(rates.values())
+        if median_rate == 0:
+            continue
+        for run in group:
+            if (run.is_running()
+                and run.replayable
+                and len(run.copies) == 1
+                and not run.backup_failed
+                and now - run.start_time >= MIN_RUNTIME
+                and rates[run] < SLOW_RATE_RATIO * median_rate):
+                stragglers.append(run)
+    return stragglers
+
+## Returns the run of the job that writes the edge (with its original id), if a subgraph writes it
+def find_writer_run(runs, job_id, edge):
+    for run in runs:
+        if run.job_id == job_id and not run.is_copy() and edge in run.output_edges:
+            return run
+    return None
+
+def make_backup_subgraph(subgraph: IR, host):
+    """ Returns a copy of the subgraph that writes its output edges from the data plane of the host
+    with new edge ids, and the mapping from the original edge ids to the new ones.
+    """
+    backup = copy.deepcopy(subgraph)
+    backup_edges = {}
+    for node in data_plane_pipes(backup):
+        if node.is_write():
+            backup_edge = str(uuid4())
+            backup_edges[node.get_edge_uid()] = backup_edge
+            node.set_writer(host, DATA_PLANE_PORT, backup_edge)
+    return backup, backup_edges
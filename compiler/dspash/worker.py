@@ -1,5 +1,5 @@
 import socket, pickle
-from threading import Thread
+from threading import Thread, Lock
 from socket_utils import encode_request, decode_request
 import subprocess
 import json
@@ -19,23 +19,48 @@ from util import log
 import pash_compiler
 from dspash.socket_utils import send_msg, recv_msg
 from dspash.ir_helper import save_configs, to_shell_file
+from dspash.data_plane import DATA_PLANE_PORT
 from dspash.utils import create_filename, write_file
 
 # from ... import config
 HOST = socket.gethostbyname(socket.gethostname())
 PORT = 65432        # Port to listen on (non-privileged ports are > 1023)
 
+## The shell processes of the subgraphs that this worker executes (by pid).
+##   They are removed when their watcher thread reaps them.
+running_subgraphs = {}
+running_subgraphs_lock = Lock()
+
 
 def err_print(*args):
     print(*args, file=sys.stderr)
 
-def send_success(conn, body, msg = ""):
+def send_success(conn, body, msg = "", request_id = None, send_lock = None):
+    ## The manager matches responses to its requests by their id
     request = {
         'status': 'OK',
         'body': body,
-        'msg': msg
+        'msg': msg,
+        'id': request_id
     }
-    send_msg(conn, encode_request(request))
+    send(conn, request, send_lock)
+
+## Notifications are sent without a request, so they have no id
+def send_event(conn, event, body, send_lock = None):
+    request = {
+        'status': 'OK',
+        'event': event,
+        'body': body,
+        'id': None
+    }
+    send(conn, request, send_lock)
+
+def send(conn, request, send_lock):
+    if send_lock is None:
+        send_msg(conn, encode_request(request))
+        return
+    with send_lock:
+        send_msg(conn, encode_request(request))
 
 def parse_exec_request(request):
     return request['cmd']
@@ -53,10 +78,109 @@ def exec_graph(graph, shell_vars, functions):
     # store functions
     functions_file = create_filename(dir=config.PASH_TMP_PREFIX, prefix='pashFuncs')
     write_file(functions_file, functions)
-    cmd = f"source {functions_file}; source {script_path}"
+    data_plane_functions = os.path.join(PASH_TOP, "compiler/dspash/data_plane_pipe.sh")
+    cmd = f"source {functions_file}; source {data_plane_functions}; source {script_path}"
     rc = subprocess.Popen(cmd, env=e, executable="/bin/bash", shell=True)
+    with running_subgraphs_lock:
+        running_subgraphs[rc.pid] = rc
     return rc
 
+def count_running_subgraphs():
+    with running_subgraphs_lock:
+        return len(running_subgraphs)
+
+def read_io_counters(pid):
+    counters = {}
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except OSError:
+        pass
+    return counters
+
+## Waits for the subgraph to finish and returns its completion report.
+##   The io counters and the resource usage of a process include the ones of all its
+##   children that it waited for, i.e., all the nodes of the subgraph.
+def wait_subgraph(rc, start_time):
+    ## Wait without reaping the process so that its io counters can still be read
+    os.waitid(os.P_PID, rc.pid, os.WEXITED | os.WNOWAIT)
+    io_counters = read_io_counters(rc.pid)
+    _pid, status, rusage = os.wait4(rc.pid, 0)
+    rc.returncode = os.waitstatus_to_exitcode(status)
+    with running_subgraphs_lock:
+        del running_subgraphs[rc.pid]
+    return {
+        'exit_code': rc.returncode,
+        'wall_time': time.time() - start_time,
+        'cpu_time': rusage.ru_utime + rusage.ru_stime,
+        ## These include the bytes that the nodes of the subgraph pass each other through pipes
+        'bytes_read': io_counters.get('rchar'),
+        'bytes_written': io_counters.get('wchar')
+    }
+
+def watch_subgraph(rc, start_time, conn, send_lock, tag):
+    report = wait_subgraph(rc, start_time)
+    report['tag'] = tag
+    print(f"subgraph {rc.pid} finished with exit code {report['exit_code']}")
+    try:
+        send_event(conn, 'Exec-Graph-Done', report, send_lock)
+    except OSError as e:
+        print(f"could not report the completion of subgraph {rc.pid}: {e}")
+
+def read_free_memory():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+## The bytes that are queued in the send and receive buffers of the tcp sockets of the machine,
+##   i.e., the data of the remote pipes that has not yet been consumed.
+def read_bytes_in_flight():
+    bytes_in_flight = 0
+    for path in ["/proc/net/tcp", "/proc/net/tcp6"]:
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    tx_queue, rx_queue = line.split()[4].split(':')
+                    bytes_in_flight += int(tx_queue, 16) + int(rx_queue, 16)
+        except OSError:
+            continue
+    return bytes_in_flight
+
+## The bytes that the data plane of the machine has sent on every edge that is written here
+##   (i.e., the progress of the subgraphs, see speculation.py), by edge id
+def read_edge_progress():
+    try:
+        with socket.create_connection(("127.0.0.1", DATA_PLANE_PORT), timeout=1) as s:
+            s.sendall(b"STATS\n")
+            data = bytearray()
+            while not data.endswith(b"\n"):
+                packet = s.recv(65536)
+                if not packet:
+                    break
+                data.extend(packet)
+        return {edge['edge']: edge['bytes'] for edge in json.loads(data) if edge['direction'] == "write"}
+    except (OSError, ValueError):
+        ## The data plane is not running (or it is not used)
+        return {}
+
+def load_report():
+    return {
+        'running_subgraphs': count_running_subgraphs(),
+        'cpu_count': os.cpu_count(),
+        'load_average': os.getloadavg()[0],
+        'free_memory': read_free_memory(),
+        'bytes_in_flight': read_bytes_in_flight(),
+        'edges': read_edge_progress()
+    }
+
 class Worker:
     def __init__(self, port = None):
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -81,7 +205,8 @@ class Worker:
             t.join()
 
 def manage_connection(conn, addr):
-    rcs = []
+    ## The watchers of the subgraphs report their completion on the same connection
+    send_lock = Lock()
     with conn:
         print('Connected by', addr)
         dfs_configs_paths = {}
@@ -90,19 +215,22 @@ def manage_connection(conn, addr):
             if not data:
                 break
 
-            print("got new request")
             request = decode_request(data)
-            if request['type'] == 'Exec-Graph':
+            if request['type'] == 'Heartbeat':
+                body = load_report()
+            elif request['type'] == 'Exec-Graph':
+                print("got new request")
+                start_time = time.time()
                 graph, shell_vars, functions = parse_exec_graph(request)
                 save_configs(graph, dfs_configs_paths)
-                exec_graph(graph, shell_vars, functions)
+                rc = exec_graph(graph, shell_vars, functions)
+                Thread(target=watch_subgraph, args=[rc, start_time, conn, send_lock, request.get('tag')], daemon=True).start()
                 body = {}
             else:
                 print(f"Unsupported request {request}")
-            send_success(conn, body)
+                body = {}
+            send_success(conn, body, request_id=request.get('id'), send_lock=send_lock)
     print("connection ended")
-    for rc in rcs:
-        rc.wait()
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Process some integers.')
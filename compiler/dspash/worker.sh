@@ -21,8 +21,8 @@ source "$PASH_TOP/compiler/orchestrator_runtime/pash_init_setup.sh" "$@" --distr
 export PASH_TMP_PREFIX="$(mktemp -d /tmp/pash_XXXXXXX)/"
 
 cleanup() {
-        kill "$FILEREADER_PID" "$DISCOVERY_PID"
-        wait "$FILEREADER_PID" "$DISCOVERY_PID" 2>/dev/null
+        kill "$FILEREADER_PID" "$DISCOVERY_PID" "$DATA_PLANE_PID"
+        wait "$FILEREADER_PID" "$DISCOVERY_PID" "$DATA_PLANE_PID" 2>/dev/null
         rm -rf "$PASH_TMP_PREFIX"
 }
 
@@ -30,4 +30,7 @@ cleanup() {
 FILEREADER_PID=$!
 "$PASH_TOP/runtime/dspash/file_reader/discovery_server" &
 DISCOVERY_PID=$!
+# used by --dspash_data_plane
+python3 "$PASH_TOP/compiler/dspash/data_plane.py" &
+DATA_PLANE_PID=$!
 python3 "$PASH_TOP/compiler/dspash/worker.py" "$@"
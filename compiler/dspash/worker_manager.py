@@ -1,75 +1,285 @@
+import asyncio
+import hashlib
 import socket
 import os
+import struct
+import subprocess
+import sys
 import time
 import queue
 import pickle
 import json
+from threading import Lock, Thread
+from uuid import uuid4
 
 from dspash.socket_utils import SocketManager, encode_request, decode_request, send_msg, recv_msg
 from util import log
 from dspash.ir_helper import prepare_graph_for_remote_exec, to_shell_file
+from dspash.data_plane import DATA_PLANE_PORT
+from dspash.speculation import SubgraphRun, data_plane_pipes, find_reader_hosts, find_stragglers, find_writer_run, make_backup_subgraph
 from dspash.utils import read_file
+from profile_store import ProfileStore
 import config 
 import copy
 
 PORT = 65425        # Port to listen on (non-privileged ports are > 1023)
 
+## Timeouts (in seconds) for connecting to a worker and for getting the ack of a request
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 30
+## How many times we try to reconnect to a worker before failing a request
+RECONNECT_ATTEMPTS = 3
+## How often (in seconds) the workers are asked for a load report
+HEARTBEAT_INTERVAL = 1
+## How long (in seconds) we wait for the answer to a heartbeat
+HEARTBEAT_TIMEOUT = 2 * HEARTBEAT_INTERVAL
+## A worker that misses this many heartbeats in a row has failed
+MISSED_HEARTBEATS = 3
+## Load reports older than this (in seconds) are not used for scheduling
+LOAD_REPORT_TTL = 5 * HEARTBEAT_INTERVAL
+## Workers with less free memory than this are only chosen if no other worker can be
+LOW_MEMORY = 256 * 1024 * 1024
+## How many bytes in flight weigh as much as a busy core
+BYTES_IN_FLIGHT_PER_CORE = 64 * 1024 * 1024
+
 class WorkerConnection:
-    def __init__(self, host, port):
+    """ A persistent connection to a worker.
+
+    Requests are tagged with an id that the worker echoes in its response,
+    so many requests can be in flight on the same connection. All methods
+    (except the getters and assign_subgraph) run in the event loop of the Dispatcher.
+    The counts of the subgraphs of the worker and its load report are also used by the
+    scheduler in the thread of the worker manager, so they are only accessed with _load_lock.
+    """
+    def __init__(self, host, port, on_completion = None, on_failure = None):
         self._host = socket.gethostbyaddr(host)[2][0] # get ip address in case host needs resolving
         self._port = port
+        ## The subgraphs that were assigned to the worker but that it has not acknowledged yet
+        ##   (afterwards they are included in the running subgraphs of its load report)
         self._running_processes = 0
-        self._online = True
-        # assume client service is running, can add a way to activate later
+        ## The last load report of the worker (see load_report in worker.py) and when it was received
+        self._load = None
+        self._load_time = 0
+        self._load_lock = Lock()
+        ## Called with the worker and the report of every subgraph that finishes
+        self._on_completion = on_completion
+        ## Called with the worker when it fails, i.e., the subgraphs that run on it are lost
+        self._on_failure = on_failure
+        self._online = False
+        ## The heartbeats that the worker did not answer since its last answer
+        self._missed_heartbeats = 0
+        ## Set when the worker fails, until it answers a heartbeat again
+        self._failed = False
+        self._reader = None
+        self._writer = None
+        ## The futures of the requests that wait for a response, by request id
+        self._pending = {}
+        self._next_request_id = 0
+
+    async def connect(self) -> bool:
         try:
-            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._socket.connect((self._host, self._port))
-        except Exception as e:
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self._host, self._port),
+                                                                CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            ## The heartbeats keep trying to reconnect to a failed worker
+            if self._missed_heartbeats == 0:
+                log(f"{self}: Could not connect: {e}")
             self._online = False
-        
+            return False
+        self._online = True
+        asyncio.ensure_future(self._receive_responses(self._reader))
+        return True
+
+    ## Resolves the pending requests as their responses arrive (in any order)
+    async def _receive_responses(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                msglen = struct.unpack('>I', header)[0]
+                response = decode_request(await reader.readexactly(msglen))
+                if 'event' in response:
+                    self._handle_event(response)
+                    continue
+                future = self._pending.pop(response.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            ## Only drop the connection if it was not replaced in the meantime
+            if reader is self._reader:
+                self._disconnect(e)
+
+    def _disconnect(self, reason):
+        log(f"{self}: Connection lost: {reason}")
+        self._online = False
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"{self}: connection lost: {reason}"))
+        self._pending.clear()
+        ## The running subgraphs cannot report their completion anymore
+        self._fail(f"connection lost: {reason}")
+
+    def _fail(self, reason):
+        if self._failed:
+            return
+        self._failed = True
+        log(f"{self}: Failed: {reason}")
+        if self._writer is not None:
+            self._disconnect(reason)
+        if self._on_failure is not None:
+            self._on_failure(self)
+
+    def _handle_event(self, event):
+        if event['event'] == 'Exec-Graph-Done':
+            ## Free the slot of the subgraph until the next load report
+            with self._load_lock:
+                if self._load is not None:
+                    self._load['running_subgraphs'] = max(0, self._load['running_subgraphs'] - 1)
+            if self._on_completion is not None:
+                self._on_completion(self, event['body'])
+        else:
+            log(f"{self}: Unknown event: {event['event']}")
+
     def is_online(self):
-        # TODO: create a ping to confirm is online
         return self._online
 
     def get_running_processes(self):
-        # request_dict = { 'type': 'query',
-        #                 'fields': ['running_processes']
-        # }
-        # with self.socket.connect((self.host, self.port)):
-        #     self.socket.send(request)
-        #     # TODO wait until the command exec finishes and run this in parallel?
-        #     answer = self.socket.recv(1024)
-        return self._running_processes
-
-    def send_graph_exec_request(self, graph, shell_vars, functions) -> bool:
+        with self._load_lock:
+            load = self._fresh_load()
+            if load is not None:
+                return load['running_subgraphs'] + self._running_processes
+            return self._running_processes
+
+    def assign_subgraph(self):
+        with self._load_lock:
+            self._running_processes += 1
+
+    ## The bytes that were written on every edge of the worker (see read_edge_progress in worker.py)
+    def edge_progress(self):
+        with self._load_lock:
+            load = self._fresh_load()
+            if load is None:
+                return {}
+            return dict(load.get('edges', {}))
+
+    def has_fresh_load(self):
+        with self._load_lock:
+            return self._fresh_load() is not None
+
+    ## Called with _load_lock held
+    def _fresh_load(self):
+        if self._load is not None and time.time() - self._load_time < LOAD_REPORT_TTL:
+            return self._load
+        return None
+
+    ## Estimates how busy the worker is in cores, so that lower is better.
+    ##   Without a recent load report we can only count the subgraphs that we assigned to it.
+    def load_score(self) -> float:
+        with self._load_lock:
+            load = self._fresh_load()
+            if load is None:
+                return self._running_processes
+            running_processes = load['running_subgraphs'] + self._running_processes
+            load = dict(load)
+        cores = load['cpu_count'] or 1
+        ## The load average lags behind, while the subgraphs that were just started are not busy yet
+        score = max(running_processes, load['load_average']) / cores
+        score += load['bytes_in_flight'] / (BYTES_IN_FLIGHT_PER_CORE * cores)
+        free_memory = load['free_memory']
+        if free_memory is not None and free_memory < LOW_MEMORY:
+            score += cores
+        return score
+
+    ## A worker that does not answer MISSED_HEARTBEATS heartbeats in a row (or whose connection
+    ##   is lost) has failed, until it answers again (e.g., after it was restarted)
+    async def heartbeat(self):
+        try:
+            if not self._online and not await self.connect():
+                raise ConnectionError(f"{self}: not connected")
+            response = await self.request({'type': 'Heartbeat'}, HEARTBEAT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            self._missed_heartbeats += 1
+            if self._missed_heartbeats >= MISSED_HEARTBEATS:
+                self._fail(f"missed {self._missed_heartbeats} heartbeats")
+            raise
+        if self._failed:
+            log(f"{self}: Back online")
+            self._failed = False
+        self._missed_heartbeats = 0
+        with self._load_lock:
+            self._load = response['body']
+            self._load_time = time.time()
+
+    ## Sends a request and waits for its response.
+    ##   If the worker is not connected we try to reconnect, but we never resend a request
+    ##   that was already sent, since the worker might have executed it.
+    async def request(self, request_dict, timeout=None):
+        if timeout is None:
+            timeout = REQUEST_TIMEOUT
+        for attempt in range(RECONNECT_ATTEMPTS + 1):
+            if self._online or await self.connect():
+                break
+            ## Back off before trying again
+            await asyncio.sleep(0.1 * 2 ** attempt)
+        else:
+            raise ConnectionError(f"{self}: could not reconnect after {RECONNECT_ATTEMPTS} attempts")
+
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        request = encode_request(dict(request_dict, id=request_id))
+        try:
+            self._writer.write(struct.pack('>I', len(request)) + request)
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            ## The worker is slow to answer but the connection is fine (it is an OSError since python 3.11),
+            ##   the heartbeats decide whether the worker has failed
+            raise
+        except OSError as e:
+            self._disconnect(e)
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    ## The tag is returned in the completion report of the subgraph
+    async def send_graph_exec_request(self, graph, shell_vars, functions, tag = None) -> bool:
         request_dict = { 'type': 'Exec-Graph',
                         'graph': graph,
                         'functions': functions,
-                        'shell_variables': None # Doesn't seem needed for now     
+                        'shell_variables': None, # Doesn't seem needed for now     
+                        'tag': tag
                     }
-        request = encode_request(request_dict)
-        #TODO: do I need to open and close connection?
-        send_msg(self._socket, request)
-        # TODO wait until the command exec finishes and run this in parallel?
-        response_data = recv_msg(self._socket)
-        if not response_data or decode_request(response_data)['status'] != "OK":
-            raise Exception(f"didn't recieved ack on request {response_data}")
-        else:
-            # self._running_processes += 1 #TODO: decrease in case of failure or process ended
-            response = decode_request(response_data)
-            return True
-
-    def close(self):
-        self._socket.send("Done")
-        self._socket.close()
+        try:
+            response = await self.request(request_dict)
+        except BaseException:
+            ## The subgraph was never started
+            with self._load_lock:
+                self._running_processes -= 1
+            raise
+        ## From now on the subgraph is counted in the load report (until the next one arrives),
+        ##   in the same step, so that the scheduler never counts it twice or not at all
+        with self._load_lock:
+            self._running_processes -= 1
+            if response['status'] == "OK" and self._load is not None:
+                self._load['running_subgraphs'] += 1
+        if response['status'] != "OK":
+            raise Exception(f"didn't recieved ack on request {response}")
+        return True
 
-    def _wait_ack(self):
-        confirmation = self._socket.recv(4096)
-        if not confirmation or decode_request(confirmation).status != "OK":
-            return False
-            # log(f"Confirmation not recieved {confirmation}")
-        else:
-            return True
+    async def close(self):
+        ## Forget the connection first, so that its end is not taken for a failure
+        writer = self._writer
+        self._online = False
+        self._reader = None
+        self._writer = None
+        if writer is not None:
+            writer.close()
+            await writer.wait_closed()
 
     def __str__(self):
         return f"Worker {self._host}:{self._port}"
@@ -77,37 +287,313 @@ class WorkerConnection:
     def host(self):
         return self._host
 
+class Dispatcher:
+    """ Runs an asyncio event loop in its own thread that owns the worker connections.
+
+    The worker manager submits coroutines to it, so that the requests
+    to all workers are pipelined instead of waiting for each ack in turn.
+    """
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._heartbeats = None
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    ## Blocks until the coroutine completes and returns its result
+    def run(self, coroutine):
+        return self.submit(coroutine).result()
+
+    def connect_all(self, workers):
+        async def connect_all():
+            await asyncio.gather(*[worker.connect() for worker in workers if not worker.is_online()])
+        self.run(connect_all())
+
+    ## Sends all subgraphs at once and returns a future of the results (True or the exception of each request)
+    def dispatch_graphs(self, worker_subgraph_pairs, shell_vars, functions, tags = None):
+        if tags is None:
+            tags = [None] * len(worker_subgraph_pairs)
+        async def dispatch_all():
+            start_time = time.time()
+            results = await asyncio.gather(*[worker.send_graph_exec_request(subgraph, shell_vars, functions, tag)
+                                             for (worker, subgraph), tag in zip(worker_subgraph_pairs, tags)],
+                                           return_exceptions=True)
+            for (worker, _subgraph), result in zip(worker_subgraph_pairs, results):
+                if isinstance(result, BaseException):
+                    log(f"{worker}: Exec-Graph request failed: {result!r}")
+            log(f"Dispatched {len(worker_subgraph_pairs)} subgraphs in {(time.time() - start_time) * 1000:.2f} ms")
+            return results
+        return self.submit(dispatch_all())
+
+    ## Periodically updates the load reports of the workers (and tries to reconnect to the
+    ##   offline ones), and awaits on_heartbeats (if given) after every interval.
+    ##   Every worker has its own loop, so that a worker that does not answer does not delay the others.
+    def start_heartbeats(self, workers, on_heartbeats = None):
+        async def heartbeats(worker):
+            while True:
+                was_online = worker.is_online()
+                try:
+                    await worker.heartbeat()
+                except Exception as e:
+                    if was_online:
+                        log(f"{worker}: Heartbeat failed: {e!r}")
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+        async def callbacks():
+            while True:
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+                try:
+                    await on_heartbeats()
+                except Exception as e:
+                    log(f"Heartbeat callback failed: {e!r}")
+        async def all_heartbeats():
+            loops = [heartbeats(worker) for worker in workers]
+            if on_heartbeats is not None:
+                loops.append(callbacks())
+            await asyncio.gather(*loops)
+        self._heartbeats = self.submit(all_heartbeats())
+
+    def close(self, workers):
+        if self._heartbeats is not None:
+            self._heartbeats.cancel()
+        async def close_all():
+            await asyncio.gather(*[worker.close() for worker in workers], return_exceptions=True)
+        self.run(close_all())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+## Sends a command to the data plane of a host (see data_plane.py) and returns its answer
+async def data_plane_request(host, command) -> str:
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, DATA_PLANE_PORT), CONNECT_TIMEOUT)
+    try:
+        writer.write(command.encode() + b"\n")
+        await writer.drain()
+        response = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+    finally:
+        writer.close()
+    return response.decode().strip()
+
+## The commands of a subgraph identify it across runs (unlike its node and edge ids)
+def subgraph_profile_key(subgraph) -> str:
+    commands = sorted(os.path.basename(str(node.cmd_invocation_with_io_vars.cmd_name))
+                      for node in subgraph.nodes.values())
+    return hashlib.sha256(" ".join(commands).encode()).hexdigest()
+
 class WorkersManager():
     def __init__(self, workers: WorkerConnection = []):
         self.workers = workers
+        self.dispatcher = Dispatcher()
+        ## The execution times of the subgraphs, by the number of subgraphs of their graph
+        self.profile_store = ProfileStore()
+        self.completed_subgraphs = 0
+        self.failed_subgraphs = 0
+        ## The subgraphs (and their copies) that are tracked for speculation and fault tolerance, by run id
+        self.runs = {}
+        self.backup_subgraphs = 0
+        self.retried_subgraphs = 0
+        self.speculation = config.pash_args.dspash_speculation and config.pash_args.dspash_data_plane
+        self.fault_tolerance = config.pash_args.dspash_fault_tolerance and config.pash_args.dspash_data_plane
         self.host = socket.gethostbyname(socket.gethostname())
         self.args = copy.copy(config.pash_args)
         # Required to create a correct multi sink graph
         self.args.termination = "" 
 
-    def get_worker(self, fids = None) -> WorkerConnection:
+    ## Chooses the online worker that stores all the remote files (fids) locally,
+    ##   preferring the one that they were assigned to and then the least loaded one.
+    ##   The workers on the excluded host are not chosen.
+    def get_worker(self, fids = None, exclude_host = None) -> WorkerConnection:
         if not fids:
             fids = []
 
         best_worker = None  # Online worker with least work
+        best_score = None
         for worker in self.workers:
-            if not worker.is_online():
+            if not worker.is_online() or worker.host() == exclude_host:
                 continue
             
             # Skip if any provided fid isn't available on the worker machine
             if any(map(lambda fid: not fid.is_available_on(worker.host()), fids)):
                 continue
 
-            if best_worker is None or best_worker.get_running_processes() > worker.get_running_processes():
+            ## Only splits have a preferred host, which is otherwise any host that stores the file
+            ##   (see split_hdfs_cat_input in pash_compiler.py)
+            not_preferred = sum(1 for fid in fids if not fid.is_preferred_on(worker.host()))
+            score = (not_preferred, worker.load_score())
+            if best_worker is None or best_score > score:
                 best_worker = worker
+                best_score = score
 
         if best_worker == None:
             raise Exception("no workers online where the date is stored")
 
+        log(f"Chose {best_worker} with load score {best_score[1]:.2f} for {len(fids)} remote files ({best_score[0]} not on their preferred host)")
         return best_worker
 
+    def online_workers_count(self):
+        return sum(1 for worker in self.workers if worker.is_online())
+
     def add_worker(self, host, port):
-        self.workers.append(WorkerConnection(host, port))
+        worker = WorkerConnection(host, port, self.record_completion, self.handle_failure)
+        self.workers.append(worker)
+        self.dispatcher.connect_all([worker])
+
+    ## Runs in the event loop of the dispatcher
+    def record_completion(self, worker, report):
+        log(f"{worker}: Subgraph finished with exit code {report['exit_code']}",
+            f"Wall time: {report['wall_time']:.3f}s",
+            f"CPU time: {report['cpu_time']:.3f}s",
+            f"Bytes read: {report['bytes_read']}",
+            f"Bytes written: {report['bytes_written']}")
+        if report['tag'] is None:
+            subgraph_key, subgraphs, run_id = None, None, None
+        else:
+            subgraph_key, subgraphs, run_id = report['tag']
+
+        run = self.runs.get(run_id)
+        if run is not None:
+            if run.lost:
+                log(f"{run}: Finished after it was taken for lost")
+                return
+            run.finish(report['exit_code'])
+            self.finish_job_runs(run.job_id)
+            ## A subgraph with copies (a backup or retries) counts once: when its first copy succeeds
+            ##   (the others are cancelled), or when its last copy fails
+            copies = run.original.copies
+            if any(other is not run and other.exit_code == 0 for other in copies):
+                return
+            if report['exit_code'] != 0 and any(other.is_running() for other in copies):
+                log(f"{run}: Stopped while another copy continues")
+                return
+
+        if report['exit_code'] == 0:
+            self.completed_subgraphs += 1
+        else:
+            self.failed_subgraphs += 1
+        if subgraph_key is not None:
+            self.profile_store.add(subgraph_key, subgraphs, report['wall_time'])
+
+    ## Stops tracking the subgraphs of a job when all of them have finished
+    def finish_job_runs(self, job_id):
+        job_runs = [run for run in self.runs.values() if run.job_id == job_id]
+        if all(not run.is_running() for run in job_runs):
+            for run in job_runs:
+                del self.runs[run.id]
+
+    ## Runs in the event loop of the dispatcher after every round of heartbeats
+    async def start_backups(self):
+        edge_progress = {}
+        for worker in self.workers:
+            edge_progress.update(worker.edge_progress())
+        for run in find_stragglers(list(self.runs.values()), edge_progress, time.time()):
+            await self.start_backup(run)
+
+    async def start_backup(self, run):
+        try:
+            backup = self.plan_copy(run, exclude_host=run.worker.host())[0]
+        except Exception as e:
+            log(f"{run}: No worker for a backup: {e}")
+            run.backup_failed = True
+            return
+        log(f"{run}: Straggler, starting a backup on {backup.worker}")
+        self.add_copies([backup])
+        self.backup_subgraphs += 1
+        await self.start_copies([backup])
+
+    ## Returns a copy of the run on another worker, followed by the copies of the runs that write
+    ##   the edges that it reads (recursively), since the data of these edges cannot be read again
+    def plan_copy(self, run, exclude_host = None):
+        critical_fids = [fid for fid in run.subgraph.all_fids() if fid.has_remote_file_resource()]
+        worker = self.get_worker(critical_fids, exclude_host=exclude_host)
+        subgraph, edges = make_backup_subgraph(run.subgraph, worker.host())
+        copy = SubgraphRun(run.job_id, worker, subgraph, run.key, run.width, run.functions,
+                           run.reader_hosts, original=run, edges=edges)
+        copies = [copy]
+        for node in data_plane_pipes(subgraph):
+            if node.is_write():
+                continue
+            edge = node.get_edge_uid()
+            writer_run = find_writer_run(self.runs.values(), run.job_id, edge)
+            if writer_run is None:
+                raise Exception(f"edge {edge} is not written by a subgraph that can be replayed")
+            writer_copies = self.plan_copy(writer_run)
+            writer_copy = writer_copies[0]
+            ## The copy reads the edge from the copy of its writer
+            writer_copy.private_edges.add(edge)
+            node.set_writer(writer_copy.worker.host(), DATA_PLANE_PORT, writer_copy.edges[edge])
+            copies += writer_copies
+        return copies
+
+    def add_copies(self, copies):
+        for copy in copies:
+            copy.original.copies.append(copy)
+            self.runs[copy.id] = copy
+
+    ## Starts the copies, and gives them to the readers of the edges of their originals as backup writers,
+    ##   so that the readers take the data from whichever copy gets ahead
+    async def start_copies(self, copies):
+        for copy in copies:
+            try:
+                copy.worker.assign_subgraph()
+                await copy.worker.send_graph_exec_request(copy.subgraph, None, copy.functions,
+                                                          (copy.key, copy.width, copy.id))
+                for edge, copy_edge in copy.edges.items():
+                    if edge in copy.private_edges:
+                        continue
+                    response = await data_plane_request(copy.reader_hosts[edge],
+                                                        f"BACKUP {edge} {copy_edge} {copy.worker.host()}:{DATA_PLANE_PORT}")
+                    if response != "OK":
+                        log(f"{copy}: The reader of edge {edge} did not accept the copy: {response}")
+            except Exception as e:
+                log(f"{copy}: Could not start the copy: {e!r}")
+
+    ## Runs in the event loop of the dispatcher when a worker fails. The lost subgraphs are retried
+    ##   on the other workers (with --dspash_fault_tolerance), otherwise the readers of their edges
+    ##   fail (instead of waiting for them).
+    def handle_failure(self, worker):
+        lost_runs = [run for run in self.runs.values() if run.worker is worker and run.is_running()]
+        if len(lost_runs) == 0:
+            return
+        log(f"{worker}: Lost {len(lost_runs)} running subgraphs")
+        for run in lost_runs:
+            run.lose()
+        for run in lost_runs:
+            ## The output of the subgraph comes from another copy (e.g., one that was started for another lost subgraph)
+            if any(other.is_running() or other.exit_code == 0 for other in run.original.copies):
+                continue
+            if self.fault_tolerance:
+                try:
+                    retries = self.plan_copy(run.original)
+                except Exception as e:
+                    log(f"{run}: Cannot be retried: {e}")
+                else:
+                    log(f"{run}: Retrying it on {retries[0].worker} (and replaying its inputs with {len(retries) - 1} more subgraphs)")
+                    self.add_copies(retries)
+                    self.retried_subgraphs += len(retries)
+                    asyncio.ensure_future(self.start_copies(retries))
+                    continue
+            self.failed_subgraphs += 1
+            asyncio.ensure_future(self.fail_edges(run.original))
+        for job_id in set(run.job_id for run in lost_runs):
+            self.finish_job_runs(job_id)
+
+    async def fail_edges(self, run):
+        for edge in run.output_edges:
+            try:
+                await data_plane_request(run.reader_hosts[edge], f"FAIL {edge}")
+            except Exception as e:
+                log(f"{run}: Could not fail the reader of edge {edge}: {e!r}")
+
+    ## Runs in the event loop of the dispatcher (like all the accesses to the runs)
+    async def track_runs(self, worker_subgraph_pairs, main_graph, keys, functions):
+        job_id = str(uuid4())
+        reader_hosts = find_reader_hosts([(self.host, main_graph)] + [(worker.host(), subgraph)
+                                                                     for worker, subgraph in worker_subgraph_pairs])
+        run_ids = []
+        for (worker, subgraph), key in zip(worker_subgraph_pairs, keys):
+            run = SubgraphRun(job_id, worker, subgraph, key, len(worker_subgraph_pairs), functions, reader_hosts)
+            self.runs[run.id] = run
+            run_ids.append(run.id)
+        return run_ids
 
     def add_workers_from_cluster_config(self, config_path):
         with open(config_path, 'r') as f:
@@ -117,24 +603,41 @@ class WorkersManager():
         for worker in workers:
             host = worker['host']
             port = worker['port']
-            self.add_worker(host, port)
-            
+            self.workers.append(WorkerConnection(host, port, self.record_completion, self.handle_failure))
+        ## Connect to all workers concurrently
+        self.dispatcher.connect_all(self.workers)
+
             
     def run(self):
         workers_manager = self
         workers_manager.add_workers_from_cluster_config(os.path.join(config.PASH_TOP, 'cluster.json'))
 
+        ## The main shell reads and writes edges through the data plane of this machine
+        data_plane = None
+        if config.pash_args.dspash_data_plane:
+            data_plane = subprocess.Popen([sys.executable, os.path.join(config.PASH_TOP, "compiler/dspash/data_plane.py")])
+
+        self.dispatcher.start_heartbeats(self.workers, self.start_backups if self.speculation else None)
+
         dspash_socket = SocketManager(os.getenv('DSPASH_SOCKET'))
         while True:
             request, conn = dspash_socket.get_next_cmd()
             if request.startswith("Done"):
                 dspash_socket.close()
+                self.dispatcher.close(self.workers)
+                if data_plane is not None:
+                    data_plane.terminate()
+                    data_plane.wait()
+                log(f"Subgraphs completed: {self.completed_subgraphs}, failed: {self.failed_subgraphs}, backups: {self.backup_subgraphs}, retries: {self.retried_subgraphs}")
                 break
             elif request.startswith("Exec-Graph"):
                 args = request.split(':', 1)[1].strip()
                 filename, declared_functions_file = args.split()
 
-                worker_subgraph_pairs, shell_vars, main_graph = prepare_graph_for_remote_exec(filename, self.get_worker)
+                ## Try to bring back the workers whose connection was lost
+                self.dispatcher.connect_all(self.workers)
+
+                worker_subgraph_pairs, shell_vars, main_graph = prepare_graph_for_remote_exec(filename, self.get_worker, self.online_workers_count())
                 script_fname = to_shell_file(main_graph, self.args)
                 log("Master node graph stored in ", script_fname)
 
@@ -146,9 +649,13 @@ class WorkersManager():
                 response_msg = f"OK {script_fname}"
                 dspash_socket.respond(response_msg, conn)
 
-                # Execute subgraphs on workers
-                for worker, subgraph in worker_subgraph_pairs:
-                    worker.send_graph_exec_request(subgraph, shell_vars, declared_functions)
+                # Execute subgraphs on workers (without waiting for the acks)
+                keys = [subgraph_profile_key(subgraph) for _worker, subgraph in worker_subgraph_pairs]
+                run_ids = [None] * len(worker_subgraph_pairs)
+                if self.speculation or self.fault_tolerance:
+                    run_ids = self.dispatcher.run(self.track_runs(worker_subgraph_pairs, main_graph, keys, declared_functions))
+                tags = [(key, len(worker_subgraph_pairs), run_id) for key, run_id in zip(keys, run_ids)]
+                self.dispatcher.dispatch_graphs(worker_subgraph_pairs, shell_vars, declared_functions, tags)
             else:
                 raise Exception(f"Unknown request: {request}")
         
@@ -0,0 +1,173 @@
+import os
+import shutil
+import zlib
+from collections import namedtuple
+from typing import List, Optional
+
+from util import log
+
+##
+## Chooses whether (and how) to compress the data of the edges that cross machines
+## (see --edge_compression), from a cheap compressibility sample of the input files
+## and the bandwidth of the links between the machines.
+##
+## The codec commands run on the workers (--distributed_exec), which are assumed to have
+## the same commands as the machine that compiles the script. The lambdas of
+## --serverless_exec do not have them, so their edges are never compressed.
+##
+
+## The command of a codec and its flags, its rough throughputs (in bytes per second),
+##   and how its compression ratio compares to zlib at zlib_level (that is used on the sample).
+Codec = namedtuple("Codec", "name command compress_args decompress_args compress_throughput decompress_throughput zlib_level ratio_factor")
+
+CODECS = [Codec("lz4", "lz4", ["-1", "-c"], ["-d", "-c"], 500 * 10**6, 2000 * 10**6, 1, 0.8),
+          Codec("zstd", "zstd", ["-q", "-1", "-c"], ["-q", "-d", "-c"], 350 * 10**6, 1000 * 10**6, 1, 1.0),
+          Codec("zstd-3", "zstd", ["-q", "-3", "-c"], ["-q", "-d", "-c"], 200 * 10**6, 1000 * 10**6, 6, 1.05)]
+
+## The sample consists of a few chunks spread over every file
+SAMPLE_CHUNK_SIZE = 64 * 1024
+SAMPLE_CHUNKS_PER_FILE = 4
+## Compression has to make an edge at least this much faster to be used
+MIN_SPEEDUP = 1.2
+
+## The commands (or commands with one of the flags) whose output does not look like their input
+##   (e.g., counts), so that a sample of the input files says nothing about how well it compresses.
+##   The output of most other commands (cat, grep, tr, sort, cut, ...) is a part of their input.
+DATA_CHANGING_COMMANDS = ["wc", "cksum", "md5sum", "sha1sum", "sha256sum", "nl"]
+DATA_CHANGING_FLAGS = {"uniq": ["-c", "--count"]}
+
+
+def get_codec(name) -> Codec:
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    raise ValueError(f"unknown codec: {name}")
+
+## Whether the command of the codec is installed
+def is_available(codec) -> bool:
+    return shutil.which(codec.command) is not None
+
+def read_sample(path) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            chunks = []
+            for i in range(SAMPLE_CHUNKS_PER_FILE):
+                f.seek(size * i // SAMPLE_CHUNKS_PER_FILE)
+                chunks.append(f.read(SAMPLE_CHUNK_SIZE))
+            return b"".join(chunks)
+    except OSError:
+        return b""
+
+## Returns the compression ratio of zlib at the given level on samples of the files,
+##   or None if none of them can be read (e.g., they are not local)
+def sample_ratio(paths: List[str], level) -> Optional[float]:
+    raw_size = 0
+    compressed_size = 0
+    for path in paths:
+        sample = read_sample(path)
+        if len(sample) == 0:
+            continue
+        raw_size += len(sample)
+        compressed_size += len(zlib.compress(sample, level))
+    if raw_size == 0:
+        return None
+    return raw_size / compressed_size
+
+## The throughput of an edge (in bytes per second of uncompressed data) when compressed with the codec
+def edge_throughput(codec, ratio, bandwidth):
+    return min(codec.compress_throughput, codec.decompress_throughput, bandwidth * ratio)
+
+def choose_codec(mode, bandwidth, sample_paths: List[str]) -> Optional[Codec]:
+    """ Returns the codec for an edge (None means no compression).
+
+    mode: "no", "auto", or the name of a codec (see --edge_compression)
+    bandwidth: the bandwidth of the link between the machines in bytes per second
+    sample_paths: the input files whose data flows through the edge
+    """
+    if mode == "no":
+        return None
+    elif mode != "auto":
+        codec = get_codec(mode)
+        if not is_available(codec):
+            log("Edge compression:", codec.command, "is not installed, not compressing")
+            return None
+        return codec
+
+    ratios = {}
+    best_codec = None
+    best_throughput = bandwidth * MIN_SPEEDUP
+    for codec in CODECS:
+        if not is_available(codec):
+            continue
+        if codec.zlib_level not in ratios:
+            ratios[codec.zlib_level] = sample_ratio(sample_paths, codec.zlib_level)
+        ratio = ratios[codec.zlib_level]
+        if ratio is None:
+            log("Edge compression: No sample of:", sample_paths)
+            return None
+        throughput = edge_throughput(codec, ratio * codec.ratio_factor, bandwidth)
+        if throughput > best_throughput:
+            best_codec = codec
+            best_throughput = throughput
+    log("Edge compression: Sample ratios:", ratios, "Chose:", None if best_codec is None else best_codec.name)
+    return best_codec
+
+def changes_data(node) -> bool:
+    cmd_invocation = node.cmd_invocation_with_io_vars
+    command = os.path.basename(str(cmd_invocation.cmd_name))
+    if command in DATA_CHANGING_COMMANDS:
+        return True
+    flags = [flag.get_name() for flag in cmd_invocation.flag_option_list if hasattr(flag, "get_name")]
+    return any(flag in DATA_CHANGING_FLAGS.get(command, []) for flag in flags)
+
+class EdgeCodecChooser:
+    """ Chooses the codec of every edge between machines from the input files whose data flows through it.
+
+    The paths of the files are relative to cwd (the PWD of the shell that runs the script)
+    and the choice for a set of files is cached, since many edges carry data from the same files.
+    """
+
+    def __init__(self, mode, bandwidth, cwd):
+        self.mode = mode
+        ## The bandwidth is configured in MB/s
+        self.bandwidth = bandwidth * 10**6
+        self.cwd = cwd
+        self.choices = {}
+
+    ## The fids are None if the data of the edge does not come unchanged from files (see changes_data)
+    def codec_for(self, fids) -> Optional[Codec]:
+        if self.mode == "no":
+            return None
+        if fids is None:
+            if self.mode == "auto":
+                return None
+            paths = ()
+        else:
+            paths = tuple(sorted(os.path.join(self.cwd, str(fid.get_resource()))
+                                 for fid in fids if fid.has_file_resource()))
+        if paths not in self.choices:
+            self.choices[paths] = choose_codec(self.mode, self.bandwidth, list(paths))
+        return self.choices[paths]
+
+def make_edge_codec_chooser(pash_args, shell_vars) -> EdgeCodecChooser:
+    _type, pwd = shell_vars.get('PWD', [None, None])
+    if pwd is None:
+        pwd = os.getcwd()
+    return EdgeCodecChooser(pash_args.edge_compression, pash_args.edge_bandwidth, pwd)
+
+## Adds a compression node in the writer graph before the writer of an edge and a decompression
+##   node in the reader graph after its reader. Returns the ids of the edges that the writer should
+##   read from and the reader should write to (the original ones if the codec is None).
+def compress_edge(codec, writer_graph, write_input_id, reader_graph, read_output_id, file_id_gen):
+    if codec is None:
+        return write_input_id, read_output_id
+    from definitions.ir.nodes.edge_codec import make_edge_codec_node
+    compressed_write_input = file_id_gen.next_ephemeral_file_id()
+    writer_graph.add_edge(compressed_write_input)
+    writer_graph.add_node(make_edge_codec_node(codec, write_input_id, compressed_write_input.get_ident(), decompress=False))
+
+    compressed_read_output = file_id_gen.next_ephemeral_file_id()
+    reader_graph.add_edge(compressed_read_output)
+    reader_graph.add_node(make_edge_codec_node(codec, compressed_read_output.get_ident(), read_output_id, decompress=True))
+    return compressed_write_input.get_ident(), compressed_read_output.get_ident()
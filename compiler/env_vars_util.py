@@ -1,85 +1,321 @@
-import shlex
+import codecs
+from collections.abc import MutableMapping
 from datetime import datetime
 
 from util import log, print_time_delta
 
+## The variables file is the output of `declare -p`. Every declaration has the form:
+##
+##   declare <flags> <name>[=<value>]
+##
+## where the value is double-quoted ("..."), ANSI-C quoted ($'...'), single-quoted (older bash),
+## or an array ( [<index>]=<value> ... ).
+##
+## Instead of tokenizing the whole file, we only index it (find where each declaration is),
+## and we parse the declarations of the variables that are actually looked up.
+##
+## The indexing mostly uses `str.find` to skip over values, which is much faster than
+## shlex (that took about 15ms on deathstar for an average environment).
+DECLARE_PREFIX = "declare "
+
 def read_vars_file(var_file_path):
     log("Reading variables from:", var_file_path)
 
     if(not var_file_path is None):
-        vars_dict = {}
-        # with open(var_file_path) as f:
-        #     lines = [line.rstrip() for line in f.readlines()]
-
+        variable_reading_start_time = datetime.now()
         with open(var_file_path) as f:
-            variable_reading_start_time = datetime.now()
             data = f.read()
-            variable_reading_end_time = datetime.now()
-            print_time_delta("Variable Reading", variable_reading_start_time, variable_reading_end_time)
-
-            variable_tokenizing_start_time = datetime.now()
-            ## TODO: Can we replace this tokenizing process with our own code? This is very slow :'(
-            ##       It takes about 15ms on deathstar.
-            tokens = shlex.split(data)
-            variable_tokenizing_end_time = datetime.now()
-            print_time_delta("Variable Tokenizing", variable_tokenizing_start_time, variable_tokenizing_end_time)
-            # log("Tokens:", tokens)
-
-        # MMG 2021-03-09 definitively breaking on newlines (e.g., IFS) and function outputs (i.e., `declare -f`)
-        # KK  2021-10-26 no longer breaking on newlines (probably)
-
-        ## At the start of each iteration token_i should point to a 'declare'
-        token_i = 0
-        while token_i < len(tokens):
-            # FIXME is this assignment needed?
-            export_or_typeset = tokens[token_i]
-
-            ## Array variables require special parsing treatment
-            if (export_or_typeset == "declare" and is_array_variable(tokens[token_i+1])):
-                var_name, var_type, var_value, new_token_i = parse_array_variable(tokens, token_i)
-                vars_dict[var_name] = (var_type, var_value)
-                token_i = new_token_i
-                continue
+        variable_reading_end_time = datetime.now()
+        print_time_delta("Variable Reading", variable_reading_start_time, variable_reading_end_time)
 
-            new_token_i = find_next_delimiter(tokens, token_i)
-            rest = " ".join(tokens[(token_i+1):new_token_i])
-            token_i = new_token_i
+        variable_indexing_start_time = datetime.now()
+        declarations = vars_file_loader.index(data)
+        variable_indexing_end_time = datetime.now()
+        print_time_delta("Variable Indexing", variable_indexing_start_time, variable_indexing_end_time)
 
-            space_index = rest.find(' ')
-            eq_index = rest.find('=')
-            var_type = None
+        vars_dict = ShellVariables(declarations)
+        final_vars_dict = set_special_parameters(vars_dict)
+        return final_vars_dict
 
-            ## Declared but unset?
+
+class VarsFileLoader:
+    """ Keeps the index of the previous variables file so that it can be reused.
+
+    In the common case (e.g., a loop) the variables file is identical or almost identical
+    to the one of the previous request. If it is identical we reuse the previous index
+    as is, and otherwise we reuse the parsed values of all the declarations that did not change.
+    """
+    def __init__(self):
+        self.previous_data = None
+        self.previous_declarations = None
+
+    def index(self, data):
+        if data == self.previous_data:
+            log("Variables file is identical to the previous one, reusing its index")
+            return self.previous_declarations
+
+        if self.previous_declarations is None:
+            previously_parsed = {}
+        else:
+            previously_parsed = self.previous_declarations.parsed
+        declarations = DeclareOutputIndex(data, previously_parsed)
+        self.previous_data = data
+        self.previous_declarations = declarations
+        return declarations
+
+vars_file_loader = VarsFileLoader()
+
+
+class DeclareOutputIndex:
+    """ An index from variable names to their declarations in the output of `declare -p`. """
+
+    def __init__(self, data, previously_parsed={}):
+        self.data = data
+        ## A map from variable names to the (start, end) of their declaration in the data
+        self.spans = {}
+        ## A map from raw declarations to their parsed (type, value)
+        self.parsed = {}
+        self.previously_parsed = previously_parsed
+        self.index_declarations()
+
+    def index_declarations(self):
+        data = self.data
+        data_len = len(data)
+        pos = 0
+        while pos < data_len:
+            line_end = find_or_end(data, '\n', pos)
+            if not data.startswith(DECLARE_PREFIX, pos):
+                ## TODO: When can this happen? The old tokenizer also skipped these.
+                log("Skipping unknown line in variables file:", data[pos:line_end])
+                pos = line_end + 1
+                continue
+
+            name_start = data.index(' ', pos + len(DECLARE_PREFIX), line_end) + 1
+            eq_index = data.find('=', name_start, line_end)
             if eq_index == -1:
-                if space_index != -1:
-                    var_name = rest[(space_index+1):]
-                    var_type = rest[:space_index]
-                else:
-                    var_name = rest
-                var_value = ""
-            ## Set, with type
-            elif(space_index < eq_index and not space_index == -1):
-                var_type = rest[:space_index]
-
-                if var_type == "--":
-                    var_type = None
-                
-                var_name = rest[(space_index+1):eq_index]
-                var_value = rest[(eq_index+1):]
-            ## Set, without type
+                ## Declared but unset
+                name = data[name_start:line_end]
+                end = line_end
             else:
-                var_name = rest[:eq_index]
-                var_value = rest[(eq_index+1):]
+                name = data[name_start:eq_index]
+                _value, end = read_value(data, eq_index + 1, decode=False)
+                ## The declaration continues until the end of the line
+                end = find_or_end(data, '\n', end)
+            self.spans[name] = (pos, end)
+            pos = end + 1
+
+    def names(self):
+        return self.spans.keys()
+
+    def __contains__(self, name):
+        return name in self.spans
+
+    ## Returns the (type, value) of the given variable
+    def lookup(self, name):
+        start, end = self.spans[name]
+        declaration = self.data[start:end]
+        try:
+            return self.parsed[declaration]
+        except KeyError:
+            pass
+
+        if declaration in self.previously_parsed:
+            type_and_value = self.previously_parsed[declaration]
+        else:
+            type_and_value = parse_declaration(declaration)
+        self.parsed[declaration] = type_and_value
+        return type_and_value
+
+
+class ShellVariables(MutableMapping):
+    """ The shell variables, which are parsed lazily from a `DeclareOutputIndex`.
+
+    Values that are set (e.g., special parameters or invalidated variables during expansion)
+    are kept separately so that the (shared) index is never modified.
+    """
+
+    def __init__(self, declarations, overlay=None, deleted=None):
+        self.declarations = declarations
+        self.overlay = {} if overlay is None else overlay
+        self.deleted = set() if deleted is None else deleted
+
+    def __getitem__(self, name):
+        if name in self.overlay:
+            return self.overlay[name]
+        if name in self.deleted or not name in self.declarations:
+            raise KeyError(name)
+        var_type, var_value = self.declarations.lookup(name)
+        ## Arrays are copied so that the parsed value cannot be modified through them
+        if isinstance(var_value, list):
+            var_value = var_value.copy()
+        return (var_type, var_value)
+
+    def __setitem__(self, name, value):
+        self.overlay[name] = value
+        self.deleted.discard(name)
+
+    def __delitem__(self, name):
+        if not name in self:
+            raise KeyError(name)
+        self.overlay.pop(name, None)
+        self.deleted.add(name)
+
+    def __contains__(self, name):
+        return (name in self.overlay
+                or (name in self.declarations and not name in self.deleted))
+
+    def __iter__(self):
+        for name in self.declarations.names():
+            if not name in self.deleted and not name in self.overlay:
+                yield name
+        yield from self.overlay
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        return ShellVariables(self.declarations, self.overlay.copy(), self.deleted.copy())
+
+    ## When pickled (e.g., to be sent to workers) the variables become a normal dictionary
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+    def __repr__(self):
+        return f'ShellVariables(Declarations:{len(self.declarations.spans)}, Overlay:{self.overlay})'
+
+
+def find_or_end(data, char, start):
+    index = data.find(char, start)
+    if index == -1:
+        return len(data)
+    return index
+
+## Returns the index of the closing quote, skipping escaped quotes
+def find_closing_quote(data, start, quote):
+    while True:
+        quote_index = data.index(quote, start)
+        ## Count the backslashes before the quote
+        backslash_index = quote_index - 1
+        while data[backslash_index] == '\\':
+            backslash_index -= 1
+        if (quote_index - 1 - backslash_index) % 2 == 0:
+            return quote_index
+        start = quote_index + 1
+
+## Reads a (potentially quoted) word starting at i.
+## Returns its value (only if decode is set) and the index right after it.
+def read_word(data, i, decode=True, stop_chars=" \n"):
+    value = None
+    if data.startswith('"', i):
+        end = find_closing_quote(data, i + 1, '"')
+        if decode:
+            value = double_quote_unescape(data[i+1:end])
+        return value, end + 1
+    elif data.startswith("$'", i):
+        end = find_closing_quote(data, i + 2, "'")
+        if decode:
+            value = ansi_c_expand(data[i+2:end])
+        return value, end + 1
+    elif data.startswith("'", i):
+        end = data.index("'", i + 1)
+        if decode:
+            value = data[i+1:end]
+        return value, end + 1
+    else:
+        end = i
+        while end < len(data) and not data[end] in stop_chars:
+            end += 1
+        if decode:
+            value = data[i:end]
+        return value, end
+
+## Reads the value of a declaration starting at i.
+## Returns its value (only if decode is set) and the index right after it.
+def read_value(data, i, decode=True):
+    if data.startswith('(', i):
+        return read_array(data, i, decode)
+    else:
+        return read_word(data, i, decode)
+
+## Reads an array of the form ([<key>]=<value> ...) starting at i.
+## Returns a list of (key, value) (only if decode is set) and the index right after it.
+def read_array(data, i, decode=True):
+    assert(data[i] == '(')
+    items = [] if decode else None
+    i += 1
+    while True:
+        while data[i] == ' ':
+            i += 1
+        if data[i] == ')':
+            return items, i + 1
+        assert(data[i] == '[')
+        ## Associative array keys might be quoted
+        key, i = read_word(data, i + 1, decode, stop_chars="]")
+        assert(data[i] == ']' and data[i+1] == '=')
+        value, i = read_word(data, i + 2, decode, stop_chars=" )")
+        if decode:
+            items.append((key, value))
+
+## Parses a single declaration and returns its (type, value)
+def parse_declaration(declaration):
+    assert(declaration.startswith(DECLARE_PREFIX))
+    flags_start = len(DECLARE_PREFIX)
+    name_start = declaration.index(' ', flags_start) + 1
+    var_type = declaration[flags_start:(name_start-1)]
+    eq_index = declaration.find('=', name_start)
+
+    if var_type == "--":
+        var_type = None
+
+    ## Declared but unset
+    if eq_index == -1:
+        return (var_type, "")
+
+    value_start = eq_index + 1
+    if is_array_type(var_type):
+        ## Older bash versions print arrays as a single-quoted string
+        if declaration.startswith("'", value_start):
+            array_string, _ = read_word(declaration, value_start)
+            items, _ = read_array(array_string, 0)
+        else:
+            items, _ = read_array(declaration, value_start)
+        return make_array_value(var_type, items)
+
+    var_value, _ = read_word(declaration, value_start)
+    return (var_type, var_value)
+
+def is_array_type(var_type):
+    return (var_type is not None
+            and ('a' in var_type or 'A' in var_type))
+
+def make_array_value(var_type, items):
+    ## Associative arrays are kept as maps (they cannot be expanded for now)
+    if 'A' in var_type:
+        return (None, {key: value for key, value in items})
 
-            ## Strip quotes
-            if var_value is not None and len(var_value) >= 2 and \
-               var_value[0] == "\"" and var_value[-1] == "\"":
-                var_value = var_value[1:-1]                
-                
-            vars_dict[var_name] = (var_type, var_value)
+    var_values = []
+    for item_index_raw, item_value in items:
+        item_index = int(item_index_raw)
+        ## Add None values if the index is larger than the next item (see Bash sparse arrays)
+        ## TODO: Keep bash array values as maps to avoid sparse costs 
+        var_values += [None] * (item_index - len(var_values))
+        var_values.append(item_value)
 
-        final_vars_dict = set_special_parameters(vars_dict)
-        return final_vars_dict
+    ## TODO: Michael?
+    return (None, var_values)
+
+## Inside double quotes, bash's `declare -p` escapes only these characters
+def double_quote_unescape(string):
+    if not '\\' in string:
+        return string
+    chars = []
+    i = 0
+    while i < len(string):
+        if string[i] == '\\' and i + 1 < len(string) and string[i+1] in '"\\$`':
+            i += 1
+        chars.append(string[i])
+        i += 1
+    return "".join(chars)
 
 
 ## This sets the values of the special shell parameters correctly
@@ -140,93 +376,12 @@ def get_var(variables: dict, varname: str):
     type, value = variables.get(varname, [None, None])
     return type, value
 
-def is_array_variable(token):
-    return ('a' in token)
-
 ## Based on the following:
 ## https://www.gnu.org/software/bash/manual/html_node/ANSI_002dC-Quoting.html#ANSI_002dC-Quoting
+##
+## Non-ASCII characters are printed by `declare -p` as octal escapes of their (utf-8) bytes,
+## so we need to decode them as bytes.
 def ansi_c_expand(string):
-    return bytes(string, "utf-8").decode("unicode_escape")
-
-## This finds the end of this variable/function
-def find_next_delimiter(tokens, i):
-    if (tokens[i] == "declare"):
-        return i + 3
-    else:
-        ## TODO: When is this case actually useful?
-        j = i + 1
-        while j < len(tokens) and (tokens[j] != "declare"):
-            j += 1
-        return j
-
-def parse_array_variable(tokens, i):
-    ## The `declare` keyword
-    _declare = tokens[i]
-    ## The type
-    declare_type = tokens[i+1]
-    assert(is_array_variable(declare_type))
-
-    ## The variable name and first argument
-    ## TODO: Test with empty array and single value array
-    name_and_start=tokens[i+2]
-    first_equal_index = name_and_start.find('=')
-
-    ## If it doesn't contain any = then it is empty
-    if first_equal_index == -1:
-        ## Then the name is the whole token,
-        ##  the type is None (TODO)
-        ##  and the value is empty
-        return name_and_start, None, "", i+3
-
-    var_name = name_and_start[:first_equal_index]
-    array_start = name_and_start[first_equal_index+1:]
-
-    var_values = []
-    if array_start == "()":
-        next_i = i+3
-    else:
-        ## Remove the opening parenthesis
-        array_item = array_start[1:]
-
-        ## Set the index that points to array items
-        curr_i = i+2
-
-        done = False
-        while not done:
-            ## TODO: Is this check adequate? Or could it miss the end 
-            ##       (or be misleaded into an earlier end by the item value?)
-            if array_item.endswith(")"):
-                done = True
-                array_item = array_item[:-1]
-
-            first_equal_index = array_item.find('=')
-            ## Find the index and value of the array item
-            item_index_raw = array_item[:first_equal_index]
-            item_value = array_item[first_equal_index+1:]
-
-            ## Sometimes the value starts with a dollar mark, see Bash ANSI-C quoting:
-            ## https://www.gnu.org/software/bash/manual/html_node/ANSI_002dC-Quoting.html#ANSI_002dC-Quoting
-            if item_value.startswith("$"):
-                ## TODO: Figure out if this is adequate
-                item_value = ansi_c_expand(item_value[1:])
-
-            item_index = int(item_index_raw[1:-1])
-            
-            ## Add None values if the index is larger than the next item (see Bash sparse arrays)
-            ## TODO: Keep bash array values as maps to avoid sparse costs 
-            var_values += [None] * (item_index - len(var_values))
-            ## Set the next item
-            var_values.append(item_value)
-
-            
-
-            ## Get next array_item
-            curr_i += 1
-            array_item = tokens[curr_i]
-        
-        next_i = curr_i
-
-    ## TODO: Michael?
-    var_type = None
-
-    return var_name, var_type, var_values, next_i
+    string = string.replace("\\E", "\\x1b").replace("\\e", "\\x1b")
+    expanded_bytes, _ = codecs.escape_decode(string.encode("utf-8"))
+    return expanded_bytes.decode("utf-8", errors="surrogateescape")
@@ -1,3 +1,5 @@
+from collections import deque
+
 import pash_annotations.datatypes
 
 from pash_annotations.datatypes.CommandInvocationInitial import CommandInvocationInitial
@@ -270,6 +272,12 @@ class IR:
         self.nodes = nodes
         self.edges = edges
         self.background = background
+        ## Whether the graph waits for all its sink nodes instead of just its output node
+        ##   (e.g., the subgraphs that dspash runs on a worker that send data to several machines).
+        self.wait_for_all_sinks = False
+
+        ## Build the index of the edges of every node
+        self.init_adjacency_index()
 
         ## Apply the redirections for each separate node.
         ## This needs to be called here because nodes do not
@@ -288,26 +296,89 @@ class IR:
         ## We need to merge common files after redirections have been applied.
         self.combine_common_files()
 
+    ## The adjacency index contains the incoming and outgoing edges of every node,
+    ##   the input edges (edges without a from node), the output edges (edges without a to node),
+    ##   and the nodes that have no inputs, so that the neighbours of a node, and the sources
+    ##   and sinks of the graph can be found without scanning all the edges.
+    ##
+    ## It is updated by set_edge and remove_edge, so all modifications of self.edges
+    ##   need to go through them (or be followed by a call to init_adjacency_index).
+    ##
+    ## The edge ids are kept as keys of dictionaries to have a deterministic order.
+    ##
+    ## The nodes without inputs can be given if they are already known
+    ##   (e.g., when decoding an IR) so that the nodes don't need to be accessed.
+    def init_adjacency_index(self, nodes_without_inputs=None):
+        self.node_in_edges = {}
+        self.node_out_edges = {}
+        self.input_edge_ids = {}
+        self.output_edge_ids = {}
+        for edge_id in self.edges:
+            self.index_edge(edge_id)
+        if nodes_without_inputs is None:
+            nodes_without_inputs = [node_id for node_id, node in self.nodes.items()
+                                    if len(node.get_input_list()) == 0]
+        self.nodes_without_inputs = set(nodes_without_inputs)
+
+    def index_edge(self, edge_id):
+        _edge_fid, from_node, to_node = self.edges[edge_id]
+        if from_node is None:
+            self.input_edge_ids[edge_id] = None
+        else:
+            self.node_out_edges.setdefault(from_node, {})[edge_id] = None
+        if to_node is None:
+            self.output_edge_ids[edge_id] = None
+        else:
+            self.node_in_edges.setdefault(to_node, {})[edge_id] = None
+
+    def unindex_edge(self, edge_id):
+        _edge_fid, from_node, to_node = self.edges[edge_id]
+        if from_node is None:
+            del self.input_edge_ids[edge_id]
+        else:
+            out_edges = self.node_out_edges[from_node]
+            del out_edges[edge_id]
+            if len(out_edges) == 0:
+                del self.node_out_edges[from_node]
+        if to_node is None:
+            del self.output_edge_ids[edge_id]
+        else:
+            in_edges = self.node_in_edges[to_node]
+            del in_edges[edge_id]
+            if len(in_edges) == 0:
+                del self.node_in_edges[to_node]
+
+    ## Adds or updates an edge (and the adjacency index)
+    def set_edge(self, edge_id, edge_fid, from_node, to_node):
+        if edge_id in self.edges:
+            self.unindex_edge(edge_id)
+        self.edges[edge_id] = (edge_fid, from_node, to_node)
+        self.index_edge(edge_id)
+
+    def remove_edge(self, edge_id):
+        self.unindex_edge(edge_id)
+        del self.edges[edge_id]
+
     ## Refactor these to call .add_edge, and .set_edge_to/from 
     ## Add an edge that points to a node
     def add_to_edge(self, to_edge, node_id):
         edge_id = to_edge.get_ident()
         assert(not edge_id in self.edges)
-        self.edges[edge_id] = (to_edge, None, node_id)
+        self.set_edge(edge_id, to_edge, None, node_id)
 
     ## Add an edge that starts from a node
     def add_from_edge(self, node_id, from_edge):
         edge_id = from_edge.get_ident()
         assert(not edge_id in self.edges)
-        self.edges[edge_id] = (from_edge, node_id, None)
+        self.set_edge(edge_id, from_edge, node_id, None)
 
     def set_edge_to(self, edge_id, to_node_id):
         edge_fid, from_node, old_to_node = self.edges[edge_id]
-        self.edges[edge_id] = (edge_fid, from_node, to_node_id)
+        self.set_edge(edge_id, edge_fid, from_node, to_node_id)
 
     def set_edge_from(self, edge_id, from_node_id):
         edge_fid, old_from_node, to_node = self.edges[edge_id]
-        self.edges[edge_id] = (edge_fid, from_node_id, to_node)
+        self.set_edge(edge_id, edge_fid, from_node_id, to_node)
 
     def get_edge_fid(self, fid_id):
         if(fid_id in self.edges):
@@ -325,12 +396,12 @@ class IR:
         assert(new_edge_fid not in self.all_fids())
         new_edge_id = new_edge_fid.get_ident()
         old_fid, from_node, to_node = self.edges[old_edge_id]
-        self.edges[new_edge_id] = (new_edge_fid, from_node, to_node)
+        self.set_edge(new_edge_id, new_edge_fid, from_node, to_node)
         if from_node is not None:
             self.get_node(from_node).replace_edge(old_edge_id, new_edge_id)
         if to_node is not None:
             self.get_node(to_node).replace_edge(old_edge_id, new_edge_id)
-        del self.edges[old_edge_id]
+        self.remove_edge(old_edge_id)
         
     def get_stdin(self):
         stdin_id = self.get_stdin_id()
@@ -398,7 +469,7 @@ class IR:
             file_to_redirect_to = fid.to_ast()
             ## Change the stdin_id to point to this resource
             _prev_fid, from_node, to_node = self.edges[stdin_id]
-            self.edges[stdin_id] = (fid, from_node, to_node)
+            self.set_edge(stdin_id, fid, from_node, to_node)
             ## Create a command that redirects stdin to this ephemeral fid
             redirect_stdin_script = os.path.join(config.PASH_TOP, config.config['runtime']['redirect_stdin_binary'])
             com_args = [string_to_argument('source'), string_to_argument(redirect_stdin_script), file_to_redirect_to]
@@ -418,7 +489,9 @@ class IR:
         ## For now we just allow more than one output by waiting for one of them
         ## at random.
         stdout_edge_id = self.get_stdout_id()
-        if (not stdout_edge_id is None):
+        if self.wait_for_all_sinks:
+            sink_node_ids = self.sink_nodes()
+        elif (not stdout_edge_id is None):
             sink_node_ids = [self.edges[stdout_edge_id][1]]
         else:
             sink_node_ids = self.sink_nodes()
@@ -434,13 +507,23 @@ class IR:
                 asts.append(assignment)
 
         ## Put the output node in the end for wait to work.
-        for node_id in sink_node_ids:
-            node = self.get_node(node_id)
-            node_ast = node.to_ast(self.edges, drain_streams)
-            asts.append(make_background(node_ast))
-            ## Gather all pids
+        if len(sink_node_ids) > 1:
+            ## Wait for all the sink nodes in a single background process:
+            ##   ( sink_1 & ... sink_n & wait ) &
+            sink_asts = [make_background(self.get_node(node_id).to_ast(self.edges, drain_streams))
+                         for node_id in sink_node_ids]
+            wait_com = make_command([string_to_argument('wait')])
+            asts.append(make_background(make_subshell(make_semi_sequence(sink_asts + [wait_com]))))
             assignment = self.collect_pid_assignment()
             asts.append(assignment)
+        else:
+            for node_id in sink_node_ids:
+                node = self.get_node(node_id)
+                node_ast = node.to_ast(self.edges, drain_streams)
+                asts.append(make_background(node_ast))
+                ## Gather all pids
+                assignment = self.collect_pid_assignment()
+                asts.append(assignment)
 
         ## TODO: Ideally we would like to make them as typed nodes already
         class_asts = [to_ast_node(ast_node_to_untyped_deep(ast)) for ast in asts]
@@ -502,7 +585,7 @@ class IR:
         ## ... = OtherInNode(..., my_out, ...)
         other_in_node = other.nodes[other_in_node_id]
         other_in_node.replace_edge(other_in, my_out)
-        other.edges.pop(other_in)
+        other.remove_edge(other_in)
 
         ## Make the my_out id to be ephemeral file.
         my_out_fid, from_node, to_node = self.edges[my_out]
@@ -510,7 +593,7 @@ class IR:
         my_out_fid.make_ephemeral()
 
         ## Add the other node in my edges
-        self.edges[my_out] = (my_out_fid, from_node, other_in_node_id)
+        self.set_edge(my_out, my_out_fid, from_node, other_in_node_id)
 
         ## Just call union here
         self.union(other)
@@ -541,6 +624,7 @@ class IR:
         ## TODO: Check that all ids are OK (no cycles etc)
         self.nodes = all_nodes
         self.edges = all_edges
+        self.init_adjacency_index()
 
         ## TODO: Handle connections of common files (pipes, etc)
         self.combine_common_files()
@@ -568,6 +652,16 @@ class IR:
         ## input and 1 output (or more than 1 output in general) we
         ## signal an error.
 
+        ## Index the outputs of all nodes that are files by their resource,
+        ##   so that the output that an input refers to can be found without
+        ##   going through all nodes. The key is the string of the resource,
+        ##   and resources with the same key are then compared for equality.
+        file_outputs = {}
+        for node_id, _node in self.nodes.items():
+            for id_out, fid_out in self.get_node_output_ids_fids(node_id):
+                if fid_out.has_file_resource():
+                    file_outputs.setdefault(str(fid_out.get_resource()), []).append([node_id, id_out])
+
         ## For all inputs of all nodes, check if they are the output
         ## of exactly one other node.
         # log("Combining files for:", self)
@@ -577,19 +671,19 @@ class IR:
             for id_in, fid_in in inputs_with_file_resource:
                 in_resource = fid_in.get_resource()
                 number_of_out_resources = 0
-                for node_id2, _node2 in self.nodes.items():
-                    outputs_with_file_resource = [(id, fid) for id, fid in self.get_node_output_ids_fids(node_id2)
-                                                  if fid.has_file_resource()]
-                    for id_out, fid_out in outputs_with_file_resource:
-                        out_resource = fid_out.get_resource()
-                        ## Do not combine if the ids of the edges are already the same
-                        if (not id_in == id_out
-                            and in_resource == out_resource):
-                            number_of_out_resources += 1
-                            ## They point to the same File resource so we need to unify their fids
-                            self.nodes[node_id2].replace_edge(id_out, id_in)
-                            self.set_edge_from(id_in, node_id2)
-                            self.set_edge_from(id_out, None)
+                for file_output in file_outputs.get(str(in_resource), []):
+                    node_id2, id_out = file_output
+                    out_resource = self.edges[id_out][0].get_resource()
+                    ## Do not combine if the ids of the edges are already the same
+                    if (not id_in == id_out
+                        and in_resource == out_resource):
+                        number_of_out_resources += 1
+                        ## They point to the same File resource so we need to unify their fids
+                        self.nodes[node_id2].replace_edge(id_out, id_in)
+                        self.set_edge_from(id_in, node_id2)
+                        self.set_edge_from(id_out, None)
+                        ## The output of the node is now the input edge
+                        file_output[1] = id_in
 
                 ## Exit with an error if a file is written by more than one node.
                 ##
@@ -603,33 +697,30 @@ class IR:
 
     ## Returns all input fids of the IR
     def all_input_fids(self):
-        all_input_fids = [fid for fid, from_node, _to_node in self.edges.values()
-                          if from_node is None]
+        all_input_fids = [self.edges[edge_id][0] for edge_id in self.input_edge_ids]
         return all_input_fids
 
     ## Returns all output fids of the IR
     def all_output_fids(self):
-        all_output_fids = [fid for fid, _from_node, to_node in self.edges.values()
-                          if to_node is None]
+        all_output_fids = [self.edges[edge_id][0] for edge_id in self.output_edge_ids]
         return all_output_fids
 
     ## Returns the sources of the IR.
     ##   This includes both the nodes that have an incoming edge (file) that has no from_node,
     ##     but also nodes that have no incoming edge (generator nodes). 
     def source_nodes(self):
-        sources = set()
-        for _edge_fid, from_node, to_node in self.edges.values():
-            if(from_node is None and not to_node is None):
+        sources = set(self.nodes_without_inputs)
+        for edge_id in self.input_edge_ids:
+            to_node = self.edges[edge_id][2]
+            if(not to_node is None):
                 sources.add(to_node)
-        for node_id, node in self.nodes.items():
-            if len(node.get_input_list()) == 0:
-                sources.add(node_id)
         return list(sources)
 
     def sink_nodes(self):
         sources = set()
-        for _edge_fid, from_node, to_node in self.edges.values():
-            if(to_node is None and not from_node is None):
+        for edge_id in self.output_edge_ids:
+            from_node = self.edges[edge_id][1]
+            if(not from_node is None):
                 sources.add(from_node)
         return list(sources)
 
@@ -641,26 +732,51 @@ class IR:
         output_edge_ids = self.nodes[node_id].get_output_list()
         return output_edge_ids
 
+    ## The next and previous nodes are found using the adjacency index
+    ##   so that we don't need to generate the outputs/inputs of the node.
     def get_next_nodes(self, node_id):
-        output_edge_ids = self.get_node_outputs(node_id)
         next_nodes = []
-        for edge_id in output_edge_ids:
-            _fid, from_node, to_node = self.edges[edge_id]
-            assert(from_node == node_id)
+        for edge_id in self.node_out_edges.get(node_id, {}):
+            to_node = self.edges[edge_id][2]
             if(not to_node is None):
                 next_nodes.append(to_node)
         return next_nodes
 
     def get_previous_nodes(self, node_id):
-        input_edge_ids = self.get_node_inputs(node_id)
         previous_nodes = []
-        for edge_id in input_edge_ids:
-            _fid, from_node, to_node = self.edges[edge_id]
-            assert(to_node == node_id)
+        for edge_id in self.node_in_edges.get(node_id, {}):
+            from_node = self.edges[edge_id][1]
             if(not from_node is None):
                 previous_nodes.append(from_node)
         return previous_nodes
 
+    ## Returns the previous and next nodes of every node.
+    ##   This is a snapshot, so it can be used to traverse the graph while it is being modified.
+    def get_adjacency(self):
+        previous_nodes = {node_id: self.get_previous_nodes(node_id) for node_id in self.nodes}
+        next_nodes = {node_id: self.get_next_nodes(node_id) for node_id in self.nodes}
+        return previous_nodes, next_nodes
+
+    ## Returns all nodes in topological order, i.e., every node comes after all its previous nodes.
+    ##
+    ## This counts the unvisited previous nodes of every node (Kahn's algorithm), so it takes
+    ## linear time in the size of the graph.
+    def topological_order(self):
+        previous_nodes, next_nodes = self.get_adjacency()
+        in_degree = {node_id: len(prev_ids) for node_id, prev_ids in previous_nodes.items()}
+        workset = deque(node_id for node_id, degree in in_degree.items() if degree == 0)
+        order = []
+        while (len(workset) > 0):
+            curr_id = workset.popleft()
+            order.append(curr_id)
+            for next_id in next_nodes[curr_id]:
+                in_degree[next_id] -= 1
+                if (in_degree[next_id] == 0):
+                    workset.append(next_id)
+        ## The graph should never have cycles
+        assert(len(order) == len(self.nodes))
+        return order
+
     def get_node_input_ids_fids(self, node_id):
         node = self.get_node(node_id)
         return [(input_edge_id, self.edges[input_edge_id][0]) for input_edge_id in node.get_input_list()]
@@ -693,6 +809,7 @@ class IR:
 
     def remove_node(self, node_id):
         node = self.nodes.pop(node_id)
+        self.nodes_without_inputs.discard(node_id)
         ## Remove the node in the edges dictionary
         for in_id in node.get_input_list():
             self.set_edge_to(in_id, None)
@@ -704,6 +821,8 @@ class IR:
     def add_node(self, node):
         node_id = node.get_id()
         self.nodes[node_id] = node
+        if len(node.get_input_list()) == 0:
+            self.nodes_without_inputs.add(node_id)
         ## Add the node in the edges dictionary
         for in_id in node.get_input_list():
             self.set_edge_to(in_id, node_id)
@@ -723,7 +842,7 @@ class IR:
     def add_edge(self, edge_fid):
         fid_id = edge_fid.get_ident()
         assert(not fid_id in self.edges)
-        self.edges[fid_id] = (edge_fid, None, None)
+        self.set_edge(fid_id, edge_fid, None, None)
 
     ## Note: We assume that the lack of nodes is an adequate condition
     ##       to check emptiness.
@@ -768,7 +887,9 @@ class IR:
         if len(prev_nodes) == 1:
             first_pred_node, first_pred_cmd_inv = \
                 self.get_only_previous_node_and_only_previous_cmd_invocation(prev_nodes)
-            if isinstance(first_pred_node, r_merge.RMerge):
+            ## The previous split can only be reused if the previous node has the same width
+            if (isinstance(first_pred_node, r_merge.RMerge)
+                and len(first_pred_cmd_inv.operand_list) == fan_out):
                 can_be_fused_with_prev = True
 
         # remove node to be parallelized
@@ -806,7 +927,9 @@ class IR:
         if len(prev_nodes) == 1:
             first_pred_node, first_pred_cmd_inv = \
                 self.get_only_previous_node_and_only_previous_cmd_invocation(prev_nodes)
-            if isinstance(first_pred_node, r_merge.RMerge):
+            ## The previous split can only be reused if the previous node has the same width
+            if (isinstance(first_pred_node, r_merge.RMerge)
+                and len(first_pred_cmd_inv.operand_list) == fan_out):
                 can_be_fused_with_prev = True
 
         # remove node to be parallelized
@@ -848,7 +971,8 @@ class IR:
         if len(prev_nodes) == 1:
             first_pred_node, first_pred_cmd_inv = \
                 self.get_only_previous_node_and_only_previous_cmd_invocation(prev_nodes)
-            if first_pred_cmd_inv.is_aggregator_concatenate():
+            if (first_pred_cmd_inv.is_aggregator_concatenate()
+                and len(first_pred_cmd_inv.operand_list) == fan_out):
                 can_be_fused_with_prev = True
 
         # remove node to be parallelized
@@ -0,0 +1,500 @@
+import importlib
+import pickle
+import struct
+from collections.abc import MutableMapping
+from enum import Enum
+
+from shasta.ast_node import CArgChar
+
+##
+## A compact binary format for the df_regions that the preprocessor hands to the daemon,
+## and for the IRs that the daemon hands to the distributed and serverless backends.
+##
+## Objects of plain classes (shasta AST nodes, DFG nodes, file ids, resources, etc.)
+## are stored as a reference to their shape (class and attribute names), which is only
+## stored once per file, followed by the values of their attributes. Strings are also
+## stored once per file. Sequences of simple characters (CArgChar), which make up most of
+## the ASTs, are stored as a single byte string. Values that are not supported by the
+## format are pickled.
+##
+## Like pickle, objects, lists, dicts, and pickled values that are reached again (shared
+## or cyclic ones) are stored as a reference to the first time that they were stored,
+## so that they are decoded as one object. References do not cross encoded nodes.
+##
+## The nodes of an IR are encoded separately and are only decoded when they are first accessed.
+##
+
+FORMAT_MAGIC = b"PaSh"
+## Bump this if the format changes
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<4sHB")
+
+KIND_DF_REGION = 1
+KIND_GRAPH = 2
+
+## The tags of the encoded values
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_BYTES = 6
+TAG_LIST = 7
+TAG_TUPLE = 8
+TAG_DICT = 9
+TAG_OBJECT = 10
+TAG_CHARS = 11
+TAG_ENUM = 12
+TAG_PICKLE = 13
+TAG_REF = 14
+
+FLOAT = struct.Struct("<d")
+
+## object.__getstate__ only exists after python 3.11
+OBJECT_GETSTATE = getattr(object, "__getstate__", None)
+
+
+## Returns whether the objects of a class can be stored as their attributes,
+##   i.e., whether pickle would store them like that.
+def is_plain_class(cls):
+    if (cls.__module__ == "builtins"
+        or has_slot_attributes(cls)
+        or hasattr(cls, "__setstate__")
+        or cls.__reduce_ex__ is not object.__reduce_ex__
+        or cls.__reduce__ is not object.__reduce__
+        or getattr(cls, "__getstate__", None) is not OBJECT_GETSTATE):
+        return False
+    return is_named_class(cls)
+
+## Returns whether the class can be found by its name when decoding
+def is_named_class(cls):
+    try:
+        return find_class(cls.__module__, cls.__qualname__) is cls
+    except (ImportError, AttributeError):
+        return False
+
+## Returns whether some attributes of the objects of the class are not in their __dict__
+def has_slot_attributes(cls):
+    for klass in cls.__mro__:
+        slots = klass.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = [slots]
+        if any(not slot in ["__dict__", "__weakref__"] for slot in slots):
+            return True
+    return False
+
+def find_class(module_name, qualname):
+    cls = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        cls = getattr(cls, name)
+    return cls
+
+def is_simple_char(value):
+    return (type(value) is CArgChar
+            and len(vars(value)) == 1
+            and 0 <= value.char < 256)
+
+
+class Encoder:
+    """ Encodes values in byte arrays and keeps the shapes of all the objects and the strings that it has encoded. """
+
+    def __init__(self):
+        self.shapes = {}
+        self.strings = {}
+        self.plain_classes = {}
+        ## A map from the ids of the stored objects, lists, dicts, and pickled values to their index
+        ##   (in the order that they were stored), and the values themselves so that their ids are not reused
+        self.memo = {}
+        self.memo_values = []
+
+    def shape_id(self, shape):
+        try:
+            return self.shapes[shape]
+        except KeyError:
+            self.shapes[shape] = len(self.shapes)
+            return self.shapes[shape]
+
+    def string_id(self, string):
+        try:
+            return self.strings[string]
+        except KeyError:
+            self.strings[string] = len(self.strings)
+            return self.strings[string]
+
+    def is_plain_class(self, cls, is_enum=False):
+        try:
+            return self.plain_classes[cls]
+        except KeyError:
+            if is_enum:
+                self.plain_classes[cls] = is_named_class(cls)
+            else:
+                self.plain_classes[cls] = is_plain_class(cls)
+            return self.plain_classes[cls]
+
+    ## The value is encoded on its own, i.e., it does not refer to other encoded values
+    def encode(self, value):
+        memo, memo_values = self.memo, self.memo_values
+        self.memo, self.memo_values = {}, []
+        try:
+            out = bytearray()
+            self.write_value(out, value)
+        finally:
+            self.memo, self.memo_values = memo, memo_values
+        return out
+
+    ## Writes a reference if the value has already been stored and returns whether it did
+    def write_ref(self, out, value):
+        next_index = len(self.memo_values)
+        index = self.memo.setdefault(id(value), next_index)
+        if index == next_index:
+            self.memo_values.append(value)
+            return False
+        out.append(TAG_REF)
+        self.write_uint(out, index)
+        return True
+
+    def write_uint(self, out, n):
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def write_bytes(self, out, data):
+        self.write_uint(out, len(data))
+        out += data
+
+    def write_str(self, out, string):
+        self.write_bytes(out, string.encode("utf-8", "surrogatepass"))
+
+    def write_value(self, out, value):
+        value_type = type(value)
+        if value is None:
+            out.append(TAG_NONE)
+        elif value is False:
+            out.append(TAG_FALSE)
+        elif value is True:
+            out.append(TAG_TRUE)
+        elif value_type is int:
+            out.append(TAG_INT)
+            ## Zigzag encoding so that small negative numbers are short
+            self.write_uint(out, value << 1 if value >= 0 else ((-value) << 1) - 1)
+        elif value_type is float:
+            out.append(TAG_FLOAT)
+            out += FLOAT.pack(value)
+        elif value_type is str:
+            out.append(TAG_STR)
+            self.write_uint(out, self.string_id(value))
+        elif value_type is bytes:
+            out.append(TAG_BYTES)
+            self.write_bytes(out, value)
+        elif value_type is list:
+            if self.write_ref(out, value):
+                return
+            out.append(TAG_LIST)
+            self.write_uint(out, len(value))
+            self.write_items(out, value)
+        elif value_type is tuple:
+            out.append(TAG_TUPLE)
+            self.write_uint(out, len(value))
+            self.write_items(out, value)
+        elif value_type is dict:
+            if self.write_ref(out, value):
+                return
+            out.append(TAG_DICT)
+            self.write_uint(out, len(value))
+            for key, item in value.items():
+                self.write_value(out, key)
+                self.write_value(out, item)
+        elif isinstance(value, Enum) and self.is_plain_class(value_type, is_enum=True):
+            ## Enum members are stored as their class (which has no attributes) and their name
+            out.append(TAG_ENUM)
+            self.write_uint(out, self.shape_id((value_type, ())))
+            self.write_uint(out, self.string_id(value.name))
+        elif hasattr(value, "__dict__") and self.is_plain_class(value_type):
+            if self.write_ref(out, value):
+                return
+            attributes = vars(value)
+            out.append(TAG_OBJECT)
+            self.write_uint(out, self.shape_id((value_type, tuple(attributes))))
+            for item in attributes.values():
+                self.write_value(out, item)
+        else:
+            if self.write_ref(out, value):
+                return
+            out.append(TAG_PICKLE)
+            self.write_bytes(out, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    ## Writes the items of a sequence (whose length has already been written),
+    ##   storing runs of simple characters as byte strings.
+    def write_items(self, out, items):
+        i = 0
+        while i < len(items):
+            j = i
+            while j < len(items) and is_simple_char(items[j]):
+                j += 1
+            if j > i:
+                out.append(TAG_CHARS)
+                self.write_bytes(out, bytes(char.char for char in items[i:j]))
+                i = j
+            else:
+                self.write_value(out, items[i])
+                i += 1
+
+    ## Encodes the shapes and the strings, which are needed to decode all values
+    def encode_tables(self):
+        out = bytearray()
+        self.write_uint(out, len(self.shapes))
+        for (cls, attribute_names), _shape_id in sorted(self.shapes.items(), key=lambda item: item[1]):
+            self.write_str(out, cls.__module__)
+            self.write_str(out, cls.__qualname__)
+            self.write_uint(out, len(attribute_names))
+            for name in attribute_names:
+                self.write_str(out, name)
+        self.write_uint(out, len(self.strings))
+        for string in self.strings:
+            self.write_str(out, string)
+        return out
+
+
+class Decoder:
+    """ Decodes the values of a file, given the shapes and the strings that are stored in it. """
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self.shapes = []
+        self.strings = []
+        ## The decoded objects, lists, dicts, and pickled values (in the order that they were stored)
+        self.memo = []
+
+    def read_uint(self):
+        data = self.data
+        result = 0
+        shift = 0
+        while True:
+            byte = data[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def read_bytes(self):
+        length = self.read_uint()
+        data = bytes(self.data[self.pos:self.pos+length])
+        self.pos += length
+        return data
+
+    def read_str(self):
+        return self.read_bytes().decode("utf-8", "surrogatepass")
+
+    def read_tables(self):
+        for _ in range(self.read_uint()):
+            cls = find_class(self.read_str(), self.read_str())
+            attribute_names = [self.read_str() for _ in range(self.read_uint())]
+            self.shapes.append((cls, attribute_names))
+        self.strings = [self.read_str() for _ in range(self.read_uint())]
+
+    def read_value(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == TAG_NONE:
+            return None
+        elif tag == TAG_FALSE:
+            return False
+        elif tag == TAG_TRUE:
+            return True
+        elif tag == TAG_INT:
+            n = self.read_uint()
+            return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+        elif tag == TAG_FLOAT:
+            value, = FLOAT.unpack_from(self.data, self.pos)
+            self.pos += FLOAT.size
+            return value
+        elif tag == TAG_STR:
+            return self.strings[self.read_uint()]
+        elif tag == TAG_BYTES:
+            return self.read_bytes()
+        elif tag == TAG_LIST:
+            ## The list is in the memo before its items are decoded since they might refer to it
+            result = []
+            self.memo.append(result)
+            result.extend(self.read_items(self.read_uint()))
+            return result
+        elif tag == TAG_TUPLE:
+            return tuple(self.read_items(self.read_uint()))
+        elif tag == TAG_DICT:
+            result = {}
+            self.memo.append(result)
+            for _ in range(self.read_uint()):
+                key = self.read_value()
+                result[key] = self.read_value()
+            return result
+        elif tag == TAG_OBJECT:
+            cls, attribute_names = self.shapes[self.read_uint()]
+            value = cls.__new__(cls)
+            self.memo.append(value)
+            attributes = value.__dict__
+            for name in attribute_names:
+                attributes[name] = self.read_value()
+            return value
+        elif tag == TAG_ENUM:
+            cls, _attribute_names = self.shapes[self.read_uint()]
+            return cls[self.strings[self.read_uint()]]
+        elif tag == TAG_PICKLE:
+            value = pickle.loads(self.read_bytes())
+            self.memo.append(value)
+            return value
+        elif tag == TAG_REF:
+            return self.memo[self.read_uint()]
+        else:
+            raise ValueError(f'Unknown tag: {tag} at position: {self.pos - 1}')
+
+    def read_items(self, length):
+        items = []
+        while len(items) < length:
+            if self.data[self.pos] == TAG_CHARS:
+                self.pos += 1
+                items.extend(map(CArgChar, self.read_bytes()))
+            else:
+                items.append(self.read_value())
+        return items
+
+    def decode(self, data):
+        decoder = Decoder(data)
+        decoder.shapes = self.shapes
+        decoder.strings = self.strings
+        return decoder.read_value()
+
+
+class LazyNodes(MutableMapping):
+    """ The nodes of a decoded IR. Each node is decoded when it is first accessed. """
+
+    def __init__(self, decoder, encoded_nodes):
+        self.decoder = decoder
+        ## A map from node ids to either encoded or decoded nodes
+        self.nodes = encoded_nodes
+
+    def __getitem__(self, node_id):
+        node = self.nodes[node_id]
+        if type(node) is bytes:
+            node = self.decoder.decode(node)
+            self.nodes[node_id] = node
+        return node
+
+    def __setitem__(self, node_id, node):
+        self.nodes[node_id] = node
+
+    def __delitem__(self, node_id):
+        del self.nodes[node_id]
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    ## Copying or pickling decodes all the nodes
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def write_header(f, kind):
+    f.write(HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, kind))
+
+def read_header(data, kind):
+    if len(data) < HEADER.size:
+        raise ValueError("The file is too short to be a serialized region or graph")
+    magic, version, file_kind = HEADER.unpack_from(data)
+    if magic != FORMAT_MAGIC:
+        raise ValueError("The file is not a serialized region or graph")
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Serialization version: {version} is not supported (expected: {FORMAT_VERSION})')
+    if file_kind != kind:
+        raise ValueError(f'Expected a file of kind: {kind} but found: {file_kind}')
+    return HEADER.size
+
+## Stores the (candidate) df_region asts in the file
+def dump_df_region(asts, f):
+    encoder = Encoder()
+    body = encoder.encode(asts)
+    write_header(f, KIND_DF_REGION)
+    f.write(encoder.encode_tables())
+    f.write(body)
+
+def load_df_region(f):
+    data = f.read()
+    decoder = Decoder(data, read_header(data, KIND_DF_REGION))
+    decoder.read_tables()
+    return decoder.read_value()
+
+## The attributes of the IR that are not stored as is
+IR_STRUCTURE_ATTRIBUTES = ["nodes", "edges", "node_in_edges", "node_out_edges",
+                           "input_edge_ids", "output_edge_ids", "nodes_without_inputs"]
+
+## Stores the IR and a tuple of extra values (e.g., the shell variables) in the file
+def dump_graph(ir, extras, f):
+    encoder = Encoder()
+    attributes = {name: value for name, value in vars(ir).items()
+                  if not name in IR_STRUCTURE_ATTRIBUTES}
+
+    body = bytearray()
+    encoder.write_value(body, attributes)
+    encoder.write_value(body, extras)
+    encoder.write_value(body, list(ir.nodes_without_inputs))
+    encoder.write_uint(body, len(ir.edges))
+    for edge_id, (fid, from_node, to_node) in ir.edges.items():
+        encoder.write_value(body, edge_id)
+        encoder.write_value(body, from_node)
+        encoder.write_value(body, to_node)
+        encoder.write_value(body, fid)
+    encoder.write_uint(body, len(ir.nodes))
+    for node_id, node in ir.nodes.items():
+        encoder.write_value(body, node_id)
+        encoder.write_bytes(body, encoder.encode(node))
+
+    write_header(f, KIND_GRAPH)
+    f.write(encoder.encode_tables())
+    f.write(body)
+
+## Returns the IR and the extra values that were stored with it
+def load_graph(f):
+    ## Imported here so that the preprocessor does not need to import the IR
+    from ir import IR
+    from definitions.ir.dfg_node import DFGNode
+
+    data = f.read()
+    decoder = Decoder(data, read_header(data, KIND_GRAPH))
+    decoder.read_tables()
+    attributes = decoder.read_value()
+    extras = decoder.read_value()
+    nodes_without_inputs = decoder.read_value()
+    edges = {}
+    for _ in range(decoder.read_uint()):
+        edge_id = decoder.read_value()
+        from_node = decoder.read_value()
+        to_node = decoder.read_value()
+        edges[edge_id] = (decoder.read_value(), from_node, to_node)
+    encoded_nodes = {}
+    for _ in range(decoder.read_uint()):
+        node_id = decoder.read_value()
+        encoded_nodes[node_id] = decoder.read_bytes()
+
+    ## The IR is restored as is (like pickle does) without applying redirections again
+    ir = IR.__new__(IR)
+    ir.__dict__.update(attributes)
+    ir.nodes = LazyNodes(decoder, encoded_nodes)
+    ir.edges = edges
+    ir.init_adjacency_index(nodes_without_inputs)
+
+    ## Make sure that new nodes do not get the ids of the decoded ones
+    if len(encoded_nodes) > 0:
+        DFGNode.next_id = max(DFGNode.next_id, max(encoded_nodes) + 1)
+    return ir, extras
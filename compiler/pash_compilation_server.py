@@ -1,14 +1,20 @@
 import argparse
+import multiprocessing
+import select
 import signal
 import traceback
+from collections import deque
 from threading import Thread
 from datetime import datetime, timedelta
 # import queue
 
 import config
 import env_vars_util
+from compilation_cache import CompilationCache, CachedCompilation, df_region_digest, input_fingerprint, ir_tmp_dirs, is_size_dependent
 from pash_graphviz import maybe_generate_graphviz
 import pash_compiler
+from cost_model import command_throughput, ir_command_counts, ir_input_size, merged_throughputs, shell_cwd
+from profile_store import ProfileStore
 from util import *
 from dspash.worker_manager import WorkersManager
 import server_util
@@ -61,6 +67,9 @@ class ProcIdInfo:
         self.compiler_config = compiler_config
         self.exec_time = exec_time
         self.start_exec_time = start_exec_time
+        ## The commands and the input size of the compiled region (see CompilationResult)
+        self.command_counts = {}
+        self.input_size = None
         ## TODO: Extend it with other info from scheduler, like dependencies
 
     def set_exec_time(self, exec_time):
@@ -72,10 +81,90 @@ class ProcIdInfo:
     def get_start_exec_time(self):
         return self.start_exec_time
 
+    def set_region_info(self, command_counts, input_size):
+        self.command_counts = command_counts
+        self.input_size = input_size
+
     def __repr__(self):
         return f'ProcIdInfo(InputIR:{self.input_ir}, CompConfig:{self.compiler_config}, ExecTime:{self.exec_time})'
 
 
+##
+## A compilation request that has not been responded to yet
+##
+class CompilationRequest:
+    def __init__(self, process_id, compiled_script_file, var_file, input_ir_file, request_start_time):
+        self.process_id = process_id
+        self.compiled_script_file = compiled_script_file
+        self.var_file = var_file
+        self.input_ir_file = input_ir_file
+        self.request_start_time = request_start_time
+        self.compile_start_time = None
+        self.compile_end_time = None
+        self.cache_key = None
+        self.cached = False
+        ## The connection to respond to (only when compiling in workers)
+        self.connection = None
+        ## The result is either a CompilationResult or a CachedCompilation, and None if compilation failed
+        self.result = None
+        self.finished = False
+
+    def set_result(self, result):
+        self.result = result
+        self.compile_end_time = datetime.now()
+        self.finished = True
+
+    def __repr__(self):
+        return f'CompilationRequest(ProcId:{self.process_id}, InputIR:{self.input_ir_file}, Finished:{self.finished})'
+
+
+##
+## The parts of a compiled IR that the scheduler needs. This is what
+##   a compilation worker sends back instead of the whole IR.
+##
+class CompilationResult:
+    def __init__(self, input_resources, output_resources, tmp_dirs, command_counts, input_size):
+        self.input_resources = input_resources
+        self.output_resources = output_resources
+        self.tmp_dirs = tmp_dirs
+        ## The number of processes of each command and the size of the input files
+        ##   (used to measure the throughputs of commands)
+        self.command_counts = command_counts
+        self.input_size = input_size
+
+    def __repr__(self):
+        return f'CompilationResult(Inputs:{self.input_resources}, Outputs:{self.output_resources})'
+
+
+def compile_region(process_id, compiled_script_file, input_ir_file, compiler_config):
+    ast_or_ir = pash_compiler.compile_ir(
+        input_ir_file, compiled_script_file, config.pash_args, compiler_config)
+    if ast_or_ir is None:
+        return None
+
+    maybe_generate_graphviz(ast_or_ir, config.pash_args, name=f'dfg-{process_id}')
+
+    proc_input_resources = set(map(lambda out: str(out.resource) if str(
+        out.resource) != "None" else out, ast_or_ir.all_input_fids()))
+    proc_output_resources = set(map(lambda out: str(out.resource) if str(
+        out.resource) != "None" else out, ast_or_ir.all_output_fids()))
+    return CompilationResult(proc_input_resources, proc_output_resources, ir_tmp_dirs(ast_or_ir),
+                             ir_command_counts(ast_or_ir), ir_input_size(ast_or_ir))
+
+def init_compilation_worker():
+    config.LOGGING_PREFIX = f"Daemon Worker {os.getpid()}: "
+
+## The workers are forked when the daemon starts, so they have to read the variables of each request.
+def compile_region_in_worker(process_id, compiled_script_file, var_file, input_ir_file, compiler_config):
+    variable_reading_start_time = datetime.now()
+    vars_dict = env_vars_util.read_vars_file(var_file)
+    config.set_vars_file(var_file, vars_dict)
+    variable_reading_end_time = datetime.now()
+    print_time_delta("Variable Loading", variable_reading_start_time, variable_reading_end_time)
+
+    return compile_region(process_id, compiled_script_file, input_ir_file, compiler_config)
+
+
 class Scheduler:
     """ Takes care of running processes in parallel if there is no conflict. 
     The scheduler relies on the fact that process will wait for a compilation response.
@@ -93,6 +182,10 @@ class Scheduler:
 
                     |   Done -> no more pipelines -> wait for all processes to finish and exit
 
+        With --compilation_workers, step 1 happens in a pool of worker processes, so that
+        many regions can be compiled at once, and steps 2-3 happen (in the daemon) when
+        all earlier requests have been responded to.
+
     Notes:
         The current design relies on the data being written atomicly to the pipe for the size of our input. This allows as to use only one pipe instead of a pipe per process.
         Source: https://www.gnu.org/software/libc/manual/html_node/Pipe-Atomicity.html
@@ -114,8 +207,25 @@ class Scheduler:
         
         ## A map that keeps mappings between proc_id and (input_ir, width, exec_time)
         self.process_id_input_ir_map = {}
-        ## This is a map from input IRs, i.e., locations in the code, to a list of process_ids
-        self.input_ir_to_process_id_map = {}
+        ## The execution time profiles of regions (if profile_driven) and a map
+        ##   from input IRs, i.e., locations in the code, to their region keys in the store.
+        self.profile_store = None
+        self.input_ir_to_region_key = {}
+
+        ## The compilation cache (if enabled) and a map from the cache keys
+        ##   of the currently running cached scripts to their process_ids.
+        ##   A cached script cannot be used by two processes at the same time
+        ##   since they would share their fifos.
+        self.compilation_cache = None
+        self.cache_key_to_running_process_ids = {}
+
+        ## The pool of compilation workers (if enabled), the compilations that
+        ##   have not been responded to yet (in the order that they were requested),
+        ##   and a pipe that is used to wake up the daemon when a compilation finishes.
+        self.compilation_pool = None
+        self.pending_compilations = deque()
+        self.compilation_done_reader = None
+        self.compilation_done_writer = None
 
     def check_resources_safety(self, process_id):
         proc_input_resources, proc_output_resources = self.process_resources[process_id]
@@ -130,9 +240,26 @@ class Scheduler:
     ##
     ##############################################################################
 
-    ## TODO: It is possible that there will be many process ids being gathered here.
-    ##       If that becomes an overhead, we need to consider removing old ones
-    ##         or keeping sketches of the information (instead of their raw numbers).
+    ## The profiles are kept as sketches (per region and width) in the profile store,
+    ##   so selecting a width does not depend on the number of processes that have run.
+    ##   The throughput cost model uses the throughputs of commands from the store.
+    def init_profile_store(self):
+        if (config.pash_args.profile_driven 
+            or config.pash_args.parallelizer_cost_model == "throughput"):
+            self.profile_store = ProfileStore(config.pash_args.profile_store)
+
+    def close_profile_store(self):
+        if self.profile_store is not None:
+            self.profile_store.store()
+
+    ## The region key is the same for the same region across runs (in contrast to the input IR file)
+    def get_region_key(self, input_ir_file):
+        try:
+            return self.input_ir_to_region_key[input_ir_file]
+        except KeyError:
+            region_key = df_region_digest(input_ir_file)
+            self.input_ir_to_region_key[input_ir_file] = region_key
+            return region_key
 
     def determine_compiler_config(self, input_ir_file):
         if config.pash_args.profile_driven:
@@ -144,7 +271,7 @@ class Scheduler:
             ##
             ## Strategy, start trying lower widths, if the time seems to drop, keep trying lower.
             ## 
-            width_avgs = self.get_averages_per_width(input_ir_file)
+            width_avgs = self.profile_store.get_averages_per_width(self.get_region_key(input_ir_file))
             log("Width averages:", width_avgs)
             widths = width_avgs.keys()
             
@@ -175,41 +302,15 @@ class Scheduler:
             selected_width = config.pash_args.width
 
         log("Selected width:", selected_width)
-        return pash_compiler.CompilerConfig(selected_width)
-
-    def get_averages_per_width(self, input_ir_file):
-        ## If we haven't gathered any statistic yet
-        if not input_ir_file in self.input_ir_to_process_id_map:
-            return {}
-
-        all_proc_ids = self.input_ir_to_process_id_map[input_ir_file]
-
-        ## TODO: If that becomes an overhead, we need to add a new
-        ##       data structure to keep the latest averages (sum, len)
-        ##       to avoid recomputing every time.
-        width_times = {}
-        for proc_id in all_proc_ids:
-            proc_info = self.process_id_input_ir_map[proc_id]
-            width = proc_info.compiler_config.width
-            exec_time = proc_info.exec_time
-
-            if exec_time is not None:
-                try:
-                    width_times[width].append(exec_time)
-                except:
-                    width_times[width] = [exec_time]
-        
-        ## We have gathered all times for each width
-        width_avgs = {}
-        for width, exec_times in width_times.items():
-            width_avgs[width] = sum(exec_times) / len(exec_times)
-        
-        return width_avgs
+        command_throughputs = None
+        if self.profile_store is not None:
+            command_throughputs = self.profile_store.get_command_throughputs()
+        return pash_compiler.CompilerConfig(selected_width, command_throughputs)
 
     ## This adds the time measurement, or just removes the entry if there is no exec_time (for space reclamation)
     def handle_time_measurement(self, process_id, exec_time):
-        ## TODO: Could put those behind the profile_driven check too to not fill memory
-        assert(self.process_id_input_ir_map[process_id].exec_time is None)
+        proc_info = self.process_id_input_ir_map[process_id]
+        assert(proc_info.exec_time is None)
         
         ## If we don't have the exec time we do Nothing
         ##
@@ -217,7 +318,15 @@ class Scheduler:
         if exec_time is None:
             pass
         else:
-            self.process_id_input_ir_map[process_id].set_exec_time(exec_time)
+            proc_info.set_exec_time(exec_time)
+            if self.profile_store is not None:
+                self.profile_store.add(self.get_region_key(proc_info.input_ir), 
+                                       proc_info.compiler_config.width, exec_time)
+                ## The exec time is in milliseconds
+                throughputs = merged_throughputs(proc_info.compiler_config.command_throughputs)
+                self.profile_store.add_region_throughputs(proc_info.command_counts, proc_info.input_size,
+                                                          exec_time / 1000,
+                                                          lambda command: command_throughput(throughputs, command))
 
         # log("All measurements:", self.process_id_input_ir_map)
 
@@ -225,58 +334,198 @@ class Scheduler:
         assert(not process_id in self.process_id_input_ir_map)
         self.process_id_input_ir_map[process_id] = ProcIdInfo(input_ir_file, compiler_config)
 
-        ## Add the mapping from ir to process_id
+    ##############################################################################
+    ##
+    ## Compilation cache
+    ##
+    ##############################################################################
+
+    def init_compilation_cache(self):
+        if (config.pash_args.compilation_cache
+            and not config.pash_args.distributed_exec
+            and not config.pash_args.serverless_exec):
+            self.compilation_cache = CompilationCache(config.pash_args.compilation_cache_size,
+                                                      config.pash_args.compilation_cache_dir)
+
+    ## Returns the cache key of this compilation and the cached compilation (if there is one that can be used)
+    def lookup_compilation_cache(self, input_ir_file, compiler_config):
+        if self.compilation_cache is None:
+            return None, None
+
+        cache_key = self.compilation_cache.key(input_ir_file, config.config['shell_variables'], 
+                                               compiler_config, config.pash_args)
+        if cache_key in self.cache_key_to_running_process_ids:
+            log("Compilation cache: Cached script is already running, compiling again")
+            return None, None
+
+        cwd = shell_cwd() if is_size_dependent(config.pash_args) else None
+        cached_compilation = self.compilation_cache.get(cache_key, cwd)
+        log("Compilation cache:", self.compilation_cache, "Hit:", not cached_compilation is None)
+        return cache_key, cached_compilation
+
+    def add_to_compilation_cache(self, cache_key, compiled_script_file, result):
+        with open(compiled_script_file) as f:
+            script = f.read()
+        cached_compilation = CachedCompilation(script, result.tmp_dirs, 
+                                               result.input_resources, result.output_resources,
+                                               result.command_counts, result.input_size,
+                                               input_fingerprint(result.input_resources, shell_cwd()))
+        self.compilation_cache.add(cache_key, cached_compilation)
+
+    def mark_cached_script_running(self, cache_key, process_id):
         try:
-            self.input_ir_to_process_id_map[input_ir_file].append(process_id)
+            self.cache_key_to_running_process_ids[cache_key].add(process_id)
         except:
-            self.input_ir_to_process_id_map[input_ir_file] = [process_id]
-        # log("All mappings from input_ir to proc_id:", self.input_ir_to_process_id_map)
+            self.cache_key_to_running_process_ids[cache_key] = {process_id}
+
+    def mark_cached_script_exited(self, process_id):
+        for cache_key, process_ids in list(self.cache_key_to_running_process_ids.items()):
+            process_ids.discard(process_id)
+            if len(process_ids) == 0:
+                del self.cache_key_to_running_process_ids[cache_key]
+
+    ##############################################################################
+
+    ##############################################################################
+    ##
+    ## Compilation workers
+    ##
+    ##############################################################################
+
+    ## The workers are forked before the daemon starts accepting connections,
+    ##   so that they do not hold on to the connections of the requests.
+    def init_compilation_pool(self):
+        if config.pash_args.compilation_workers <= 0:
+            return
+        if config.pash_args.daemon_communicates_through_unix_pipes:
+            log("Compilation workers are not supported when communicating through unix pipes, compiling in the daemon")
+            return
+        self.compilation_pool = multiprocessing.get_context("fork").Pool(config.pash_args.compilation_workers,
+                                                                         initializer=init_compilation_worker)
+        self.compilation_done_reader, self.compilation_done_writer = os.pipe()
+        log("Started", config.pash_args.compilation_workers, "compilation workers")
+
+    def close_compilation_pool(self):
+        if self.compilation_pool is not None:
+            self.compilation_pool.close()
+            self.compilation_pool.join()
+
+    def submit_compilation(self, compilation, compiler_config):
+        ## These are called from the result handler thread of the pool,
+        ##   so they only record the result and wake up the main loop.
+        def compilation_finished(result):
+            compilation.set_result(result)
+            os.write(self.compilation_done_writer, b'\n')
+
+        def compilation_failed(exception):
+            log("Compilation worker failed with:", exception)
+            compilation.set_result(None)
+            os.write(self.compilation_done_writer, b'\n')
+
+        self.compilation_pool.apply_async(compile_region_in_worker,
+                                          (compilation.process_id, compilation.compiled_script_file, 
+                                           compilation.var_file, compilation.input_ir_file, compiler_config),
+                                          callback=compilation_finished,
+                                          error_callback=compilation_failed)
+
+    ## Blocks until either a new request arrives or a compilation finishes.
+    ##   Returns True if there is a new request.
+    def wait_for_request_or_compilation(self):
+        readable, _, _ = select.select([self.connection_manager, self.compilation_done_reader], [], [])
+        if self.compilation_done_reader in readable:
+            os.read(self.compilation_done_reader, config.SOCKET_BUF_SIZE)
+        return self.connection_manager in readable
+
+    ## Responses are sent in the order that requests arrived, so that resource
+    ##   conflicts are resolved in the same way as if compilation was sequential.
+    def finish_ready_compilations(self):
+        while len(self.pending_compilations) > 0 and self.pending_compilations[0].finished:
+            self.finish_pending_compilation(self.pending_compilations.popleft())
+
+    def finish_all_compilations(self):
+        while len(self.pending_compilations) > 0:
+            while not self.pending_compilations[0].finished:
+                os.read(self.compilation_done_reader, config.SOCKET_BUF_SIZE)
+            self.finish_pending_compilation(self.pending_compilations.popleft())
+
+    def finish_pending_compilation(self, compilation):
+        response = self.finish_compilation(compilation)
+        request_processing_end_time = datetime.now()
+        print_time_delta("Request handling", compilation.request_start_time, request_processing_end_time)
+        self.connection_manager.respond_to(compilation.connection, response)
 
     ##############################################################################
 
     def compile_and_add(self, compiled_script_file, var_file, input_ir_file):
+        compilation = self.start_compilation(compiled_script_file, var_file, input_ir_file)
+        return self.finish_compilation(compilation)
+
+    ## Starts compiling a region, either in the daemon itself, or in a compilation worker.
+    def start_compilation(self, compiled_script_file, var_file, input_ir_file):
         process_id = self.get_next_id()
-        run_parallel = False
-        compile_success = False
+        compilation = CompilationRequest(process_id, compiled_script_file, var_file, input_ir_file,
+                                         self.request_processing_start_time)
 
-        variable_reading_start_time = datetime.now()
-        # Read any shell variables files if present
-        vars_dict = env_vars_util.read_vars_file(var_file)
-        config.set_vars_file(var_file, vars_dict)
+        ## The workers read the variables file themselves, but the daemon needs them for the cache key
+        if self.compilation_pool is None or self.compilation_cache is not None:
+            variable_reading_start_time = datetime.now()
+            # Read any shell variables files if present
+            vars_dict = env_vars_util.read_vars_file(var_file)
+            config.set_vars_file(var_file, vars_dict)
 
-        variable_reading_end_time = datetime.now()
-        print_time_delta("Variable Loading", variable_reading_start_time, variable_reading_end_time)
+            variable_reading_end_time = datetime.now()
+            print_time_delta("Variable Loading", variable_reading_start_time, variable_reading_end_time)
 
-        daemon_compile_start_time = datetime.now()
+        compilation.compile_start_time = datetime.now()
         ## TODO: Make the compiler config based on profiling data
         compiler_config = self.determine_compiler_config(input_ir_file)
         ## Add the process_id -> input_ir mapping
         self.add_proc_id_map(process_id, input_ir_file, compiler_config)
 
-        ast_or_ir = pash_compiler.compile_ir(
-            input_ir_file, compiled_script_file, config.pash_args, compiler_config)
-
-        daemon_compile_end_time = datetime.now()
-        print_time_delta("Daemon Compile", daemon_compile_start_time, daemon_compile_end_time)
+        compilation.cache_key, cached_compilation = self.lookup_compilation_cache(input_ir_file, compiler_config)
+        if compilation.cache_key is not None:
+            ## This has to happen before the compilation finishes so that a
+            ##   concurrent request does not get the same cached script.
+            self.mark_cached_script_running(compilation.cache_key, process_id)
+
+        if cached_compilation is not None:
+            cached_compilation.write_script(compiled_script_file)
+            compilation.set_result(cached_compilation)
+            compilation.cached = True
+        elif self.compilation_pool is None:
+            compilation.set_result(compile_region(process_id, compiled_script_file, 
+                                                  input_ir_file, compiler_config))
+        else:
+            self.submit_compilation(compilation, compiler_config)
+        return compilation
 
-        self.wait_unsafe()
-        if ast_or_ir != None:
-            compile_success = True
+    ## Decides whether the compiled region can run in parallel with the running ones
+    ##   and returns the response for it. This is always done in the order that requests arrived.
+    def finish_compilation(self, compilation):
+        process_id = compilation.process_id
+        run_parallel = False
+        result = compilation.result
+        compile_success = result is not None
 
-            maybe_generate_graphviz(ast_or_ir, config.pash_args, name=f'dfg-{process_id}')
+        print_time_delta("Daemon Compile", compilation.compile_start_time, compilation.compile_end_time)
 
+        self.wait_unsafe()
+        if compile_success:
+            proc_input_resources = result.input_resources
+            proc_output_resources = result.output_resources
 
-            proc_input_resources = set(map(lambda out: str(out.resource) if str(
-                out.resource) != "None" else out, ast_or_ir.all_input_fids()))
-            proc_output_resources = set(map(lambda out: str(out.resource) if str(
-                out.resource) != "None" else out, ast_or_ir.all_output_fids()))
+            if compilation.cache_key is not None and not compilation.cached:
+                self.add_to_compilation_cache(compilation.cache_key, compilation.compiled_script_file, result)
 
             self.process_resources[process_id] = (proc_input_resources, proc_output_resources)
+            self.process_id_input_ir_map[process_id].set_region_info(result.command_counts, result.input_size)
 
             run_parallel = self.check_resources_safety(process_id)
             if run_parallel:
                 self.input_resources = self.input_resources.union(proc_input_resources)
                 self.output_resources = self.output_resources.union(proc_output_resources)
+        elif compilation.cache_key is not None:
+            self.mark_cached_script_exited(process_id)
 
         
         if not run_parallel:
@@ -284,7 +533,7 @@ class Scheduler:
             
         if compile_success:
             response = server_util.success_response(
-                f'{process_id} {compiled_script_file} {var_file} {input_ir_file}')
+                f'{process_id} {compilation.compiled_script_file} {compilation.var_file} {compilation.input_ir_file}')
         else:
             response = server_util.error_response(f'{process_id} failed to compile')
             self.unsafe_running = True
@@ -303,6 +552,7 @@ class Scheduler:
 
     def remove_process(self, process_id):
         log("The following process exited:", process_id)
+        self.mark_cached_script_exited(process_id)
         if process_id in self.process_resources:
             del self.process_resources[process_id]
             # TODO: Should be improved to not rebuild inputs and outputs from scratch maybe use counters
@@ -324,6 +574,10 @@ class Scheduler:
             # must be exit command or something is wrong
             if (input_cmd.startswith("Exit:")):
                 self.handle_exit(input_cmd)
+            elif (input_cmd.startswith("Compile") and self.compilation_pool is not None):
+                ## Compile it while we wait, it will be responded to after the pending ones
+                self.request_processing_start_time = datetime.now()
+                self.parse_and_run_cmd(input_cmd)
             else:
                 raise Exception(
                     f"Command should be exit but it was {input_cmd}")
@@ -354,14 +608,21 @@ class Scheduler:
         if(input_cmd.startswith("Compile")):
             compiled_script_file, var_file, input_ir_file = self.__parse_compile_command(
                 input_cmd)
-            response = self.compile_and_add(compiled_script_file, var_file, input_ir_file)
-            request_processing_end_time = datetime.now()
-            print_time_delta("Request handling", self.request_processing_start_time, request_processing_end_time)
-            ## Send output to the specific command
-            self.respond(response)
+            if self.compilation_pool is None:
+                response = self.compile_and_add(compiled_script_file, var_file, input_ir_file)
+                request_processing_end_time = datetime.now()
+                print_time_delta("Request handling", self.request_processing_start_time, request_processing_end_time)
+                ## Send output to the specific command
+                self.respond(response)
+            else:
+                compilation = self.start_compilation(compiled_script_file, var_file, input_ir_file)
+                ## The response is sent when the compilation is finished
+                compilation.connection = self.connection_manager.take_last_connection()
+                self.pending_compilations.append(compilation)
         elif (input_cmd.startswith("Exit:")):
             self.handle_exit(input_cmd)
         elif (input_cmd.startswith("Done")):
+            self.finish_all_compilations()
             self.wait_for_all()
             ## We send output to the top level pash process
             ## to signify that we are done.
@@ -398,6 +659,7 @@ class Scheduler:
             raise Exception(f'Parsing failure for line: {input}')
 
     def run(self):
+        self.init_compilation_pool()
         ## By default communicate through sockets, except if the user wants to do it through pipes
         if (config.pash_args.daemon_communicates_through_unix_pipes):
             in_filename = os.getenv("RUNTIME_IN_FIFO")
@@ -405,7 +667,14 @@ class Scheduler:
             self.connection_manager = server_util.UnixPipeReader(in_filename, out_filename, self.reader_pipes_are_blocking)
         else:
             self.connection_manager = server_util.SocketManager(os.getenv('DAEMON_SOCKET'))
+        self.init_compilation_cache()
+        self.init_profile_store()
         while not self.done:
+            if self.compilation_pool is not None:
+                self.finish_ready_compilations()
+                if not self.wait_for_request_or_compilation():
+                    continue
+
             # Process a single request
             input_cmd = self.get_input()
             self.request_processing_start_time = datetime.now()
@@ -414,6 +683,8 @@ class Scheduler:
             self.parse_and_run_cmd(input_cmd)
         
         self.connection_manager.close()
+        self.close_compilation_pool()
+        self.close_profile_store()
         shutdown()
 
 
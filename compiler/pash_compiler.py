@@ -1,17 +1,19 @@
 import argparse
 import sys
-import pickle
 import traceback
+from collections import deque
 from datetime import datetime
 
 from pash_annotations.annotation_generation.datatypes.parallelizability.AggregatorKind import AggregatorKindEnum
 
 import config
 import env_vars_util
+import ir_serialization
 from ir import *
 from ast_to_ir import compile_asts
 from ir_to_ast import to_shell
 from pash_graphviz import maybe_generate_graphviz
+from cost_model import make_cost_model
 from util import *
 
 from definitions.ir.aggregator_node import *
@@ -81,11 +83,13 @@ def parse_args():
 
 ## TODO: Add more fields from args in this
 class CompilerConfig:
-    def __init__(self, width):
+    def __init__(self, width, command_throughputs=None):
         self.width = width
+        ## The measured throughputs of commands (used by the throughput cost model)
+        self.command_throughputs = command_throughputs
     
     def __repr__(self):
-        return f'CompilerConfig(Width:{self.width})'
+        return f'CompilerConfig(Width:{self.width}, CommandThroughputs:{self.command_throughputs})'
 
 def compile_ir(ir_filename, compiled_script_file, args, compiler_config):
     """
@@ -126,14 +130,14 @@ def compile_optimize_output_script(ir_filename, compiled_script_file, args, comp
             maybe_log_optimized_script(script_to_execute, args)
 
             with open(ir_filename, "wb") as f:
-                obj = (optimized_ast_or_ir, config.config['shell_variables'])
-                pickle.dump(obj, f)
+                extras = (config.config['shell_variables'],)
+                ir_serialization.dump_graph(optimized_ast_or_ir, extras, f)
         elif args.serverless_exec:
             ir_filename = ptempfile()
             script_to_execute = f"$PASH_TOP/compiler/serverless/serverless_exec_graph.sh {ir_filename}\n"
             with open(ir_filename, "wb") as f:
-                obj = (optimized_ast_or_ir, config.config['shell_variables'], args)
-                pickle.dump(obj, f)
+                extras = (config.config['shell_variables'], args)
+                ir_serialization.dump_graph(optimized_ast_or_ir, extras, f)
         else:
             script_to_execute = to_shell(optimized_ast_or_ir, args)
             
@@ -150,7 +154,7 @@ def compile_optimize_output_script(ir_filename, compiled_script_file, args, comp
 def load_df_region(ir_filename):
     log("Retrieving candidate DF region: {} ... ".format(ir_filename), end='')
     with open(ir_filename, "rb") as ir_file:
-        candidate_df_region = pickle.load(ir_file)
+        candidate_df_region = ir_serialization.load_df_region(ir_file)
     log("Done!")
     return candidate_df_region
 
@@ -223,7 +227,10 @@ def optimize_irs(asts_and_irs, args, compiler_config):
             # with cProfile.Profile() as pr:
             distributed_graph = choose_and_apply_parallelizing_transformations(ast_or_ir, compiler_config.width,
                                                                       runtime_config['batch_size'],
-                                                                      args.r_split_batch_size)
+                                                                      args.r_split_batch_size,
+                                                                      args.parallelizer_cost_model,
+                                                                      compiler_config.command_throughputs,
+                                                                      args.cost_model_cores)
             # pr.print_stats()
 
             # Eagers are added in remote notes when using distributed exec
@@ -256,58 +263,55 @@ def print_graph_statistics(graph):
     log("Eager nodes:", len(eager_nodes))
 
 
-def choose_and_apply_parallelizing_transformations(graph, fan_out, batch_size, r_split_batch_size):
-    parallelizer_map = choose_parallelizing_transformations(graph)
-    apply_parallelizing_transformations(graph, parallelizer_map, fan_out, batch_size, 
+def choose_and_apply_parallelizing_transformations(graph, fan_out, batch_size, r_split_batch_size,
+                                                   cost_model_name="priority", command_throughputs=None,
+                                                   cost_model_cores=0):
+    cost_model = make_cost_model(cost_model_name, graph, fan_out, r_split_batch_size,
+                                 command_throughputs, cost_model_cores)
+    parallelizer_map = choose_parallelizing_transformations(graph, cost_model)
+    apply_parallelizing_transformations(graph, parallelizer_map, cost_model.width_map, batch_size, 
                                         r_split_batch_size)
     return graph
 
 
-def choose_parallelizing_transformations(graph): # shall return map
-    source_node_ids = graph.source_nodes()
+def choose_parallelizing_transformations(graph, cost_model): # shall return map
     parallelizer_map = {}
-    workset = source_node_ids
-    visited = set()
-    # We apply a modified BFS such that we ensure that we know which parallelizer was chosen for all previous nodes
+    # We visit the nodes in topological order such that we ensure that we know which parallelizer was chosen for all previous nodes
     # and assume that the decision for any subsequent node will exploit any potential synergy effects
-    while (len(workset) > 0):
-        curr_id = workset.pop(0)
+    for curr_id in graph.topological_order():
         assert(isinstance(curr_id, int))
-        all_previous_nodes_visited = all(prev in visited for prev in graph.get_previous_nodes(curr_id))
-        if not all_previous_nodes_visited:
-            workset.append(curr_id)
-        elif not curr_id in visited:
-            next_node_ids = graph.get_next_nodes(curr_id)
-            workset += next_node_ids
-            parallelizer_map[curr_id] = choose_parallelizing_transformation(curr_id, graph)
-            visited.add(curr_id)
+        parallelizer_map[curr_id] = choose_parallelizing_transformation(curr_id, cost_model, parallelizer_map)
     return parallelizer_map
 
 
-## This currently chooses the best parallelization based on priority:
+## The cost model scores all implemented parallelizers of the node (and not parallelizing it)
+##   and returns the cheapest. By default (the priority cost model) this is based on priority:
 ## 1. The round robin
 ## 2. The round robin after having performed unwrap (not sure why this is the second priority)
 ## 3. The consecutive chunks
-## 
-## TODO: In the future, we could develop more complex strategies      
-def choose_parallelizing_transformation(curr_id, graph): # shall return map entry
-    curr = graph.get_node(curr_id)
-    list_all_parallelizers_in_priority = [curr.get_option_implemented_round_robin_parallelizer(),
-                                          curr.get_option_implemented_round_robin_with_unwrap_parallelizer(),
-                                          curr.get_option_implemented_consecutive_chunks_parallelizer()]
-    return next((item for item in list_all_parallelizers_in_priority if item is not None), None)
+def choose_parallelizing_transformation(curr_id, cost_model, parallelizer_map): # shall return map entry
+    return cost_model.choose(curr_id, parallelizer_map)
 
 
-def apply_parallelizing_transformations(graph, parallelizer_map, fan_out, batch_size, r_split_batch_size):
+## Each node is parallelized with its own width (fan_out) as chosen by the cost model.
+##   If adjacent nodes have different widths, the IR merges and re-splits between them.
+def apply_parallelizing_transformations(graph, parallelizer_map, width_map, batch_size, r_split_batch_size):
     fileIdGen = graph.get_file_id_gen()
     node_id_non_none_parallelizer_list = [(node_id, parallelizer) for (node_id, parallelizer) in parallelizer_map.items()
                                                                   if parallelizer is not None]
     for (node_id, parallelizer) in node_id_non_none_parallelizer_list:
-        graph.apply_parallelization_to_node(node_id, parallelizer, fileIdGen, fan_out, r_split_batch_size)
-
-def split_hdfs_cat_input(hdfs_cat, next_node, graph, fileIdGen):
+        graph.apply_parallelization_to_node(node_id, parallelizer, fileIdGen, width_map[node_id], r_split_batch_size)
+
+## TODO: This is not called yet. `hdfs dfs -cat` has no annotation so it never becomes a node of a
+##       dataflow graph, HDFSCat and DFSSplitReader still use the old DFGNode constructor, and the
+##       split reader binary (runtime/dspash/dfs_split_reader.sh) is not part of the runtime.
+##       Once it is called (with fan_out set to the width) from optimize_irs for distributed_exec,
+##       the preferred hosts of the splits also guide get_worker.
+def split_hdfs_cat_input(hdfs_cat, next_node, graph, fileIdGen, fan_out=None):
     """
-    Replaces hdfs cat with a cat per block, each cat uses has an HDFSResource input fid
+    Replaces hdfs cat with a reader per block, each reader uses has an HDFSResource input fid.
+    If the fan_out is lower than the number of blocks, adjacent blocks that are stored
+    on the same host are read one after the other and concatenated (see hdfs_utils.assign_blocks_to_hosts).
     Returns: A normal Cat that merges the blocks (will be removed when parallizing next_node)
     """
     assert(isinstance(hdfs_cat, HDFSCat))
@@ -321,22 +325,34 @@ def split_hdfs_cat_input(hdfs_cat, next_node, graph, fileIdGen):
     hdfs_filepath = str(hdfs_fid.get_resource())
     output_ids = []
 
-    # Create a cat command per file block
+    # Create a reader per group of file blocks
     file_config = hdfs_utils.get_file_config(hdfs_filepath)
     dummy_config_path = ptempfile() # Dummy config file, should be updated by workers
-    for split_num, block in enumerate(file_config.blocks):
-        resource = DFSSplitResource(file_config.dumps(), dummy_config_path, split_num, block.hosts)
-        block_fid = fileIdGen.next_file_id()
-        block_fid.set_resource(resource)
-        graph.add_edge(block_fid)
-
-        output_fid = fileIdGen.next_file_id()
-        output_fid.make_ephemeral()
-        output_ids.append(output_fid.get_ident())
-        graph.add_edge(output_fid)
-
-        split_reader_node = dfs_split_reader.make_dfs_split_reader_node([block_fid.get_ident()], output_fid.get_ident(), split_num, config.HDFS_PREFIX)
-        graph.add_node(split_reader_node)
+    for block_indices, host in hdfs_utils.assign_blocks_to_hosts(file_config.blocks, fan_out):
+        block_output_ids = []
+        for split_num in block_indices:
+            block = file_config.blocks[split_num]
+            resource = DFSSplitResource(file_config.dumps(), dummy_config_path, split_num, block.hosts, host)
+            block_fid = fileIdGen.next_file_id()
+            block_fid.set_resource(resource)
+            graph.add_edge(block_fid)
+
+            output_fid = fileIdGen.next_file_id()
+            output_fid.make_ephemeral()
+            block_output_ids.append(output_fid.get_ident())
+            graph.add_edge(output_fid)
+
+            split_reader_node = dfs_split_reader.make_dfs_split_reader_node([block_fid.get_ident()], output_fid.get_ident(), split_num, config.HDFS_PREFIX)
+            graph.add_node(split_reader_node)
+
+        if len(block_output_ids) == 1:
+            output_ids.append(block_output_ids[0])
+        else:
+            group_output_fid = fileIdGen.next_file_id()
+            group_output_fid.make_ephemeral()
+            output_ids.append(group_output_fid.get_ident())
+            graph.add_edge(group_output_fid)
+            graph.add_node(make_cat_node(block_output_ids, group_output_fid.get_ident()))
 
     # Remove the HDFS Cat command as it's not used anymore
     graph.remove_node(hdfs_cat.get_id())
@@ -379,49 +395,58 @@ def add_eager_nodes(graph):
     ## Generate a fileIdGen that doesnt clash with graph fids.
     fileIdGen = graph.get_file_id_gen()
 
+    ## The adjacency is computed before adding any eager nodes, since
+    ##   the eager nodes themselves never need eager nodes.
+    _previous_nodes, next_nodes = graph.get_adjacency()
+
     ## Get the next nodes
-    workset = [node for source_node_id in source_node_ids for node in graph.get_next_nodes(source_node_id)]
+    workset = deque()
     visited = set()
+    for source_node_id in source_node_ids:
+        for next_id in next_nodes[source_node_id]:
+            if (not next_id in visited):
+                visited.add(next_id)
+                workset.append(next_id)
     while (len(workset) > 0):
-        curr_id = workset.pop(0)
+        curr_id = workset.popleft()
         curr = graph.get_node(curr_id)
-        if (not curr_id in visited):
-            visited.add(curr_id)
-            next_node_ids = graph.get_next_nodes(curr_id)
-            workset += next_node_ids
-
-            ## TODO: Make sure that we don't add duplicate eager nodes
-
-            ## Add eager nodes if the node has more than one input
-            curr_input_ids = graph.get_node_input_ids(curr_id)
-            if (len(curr_input_ids) > 1):
-                ## TODO: If we know that a command reads its inputs in a list,
-                ##       then we might not need to put an eager on its first input.
-                ## Note: This cannot be done for `sort -m` so we need to know in the
-                ##       annotations whether input consumption is in order or not.
-
-                for curr_input_id in curr_input_ids:
-                    _fid, from_node, to_node = graph.edges[curr_input_id]
-                    assert(to_node == curr_id)
-                    ## If the edge is an input edge, then we don't want to put eager.
-                    if(not from_node is None):
-                        add_eager(curr_input_id, graph, fileIdGen)
-
-            if(isinstance(curr, Split)):
-                eager_input_ids = curr.get_output_list()[:-1]
-                for edge_id in eager_input_ids:
-                    add_eager(edge_id, graph, fileIdGen)
-
-            ## Add an eager after r_unwrap            
-            if(isinstance(curr, r_unwrap.RUnwrap)):
-                eager_input_id = curr.get_output_list()[0]
-                add_eager(eager_input_id, graph, fileIdGen)
-
-            ## Add an eager after r_split
-            if(isinstance(curr, r_split.RSplit)):
-                eager_input_ids = curr.get_output_list()
-                for edge_id in eager_input_ids:
-                    add_eager(edge_id, graph, fileIdGen)
+        for next_id in next_nodes[curr_id]:
+            if (not next_id in visited):
+                visited.add(next_id)
+                workset.append(next_id)
+
+        ## TODO: Make sure that we don't add duplicate eager nodes
+
+        ## Add eager nodes if the node has more than one input
+        curr_input_ids = graph.get_node_input_ids(curr_id)
+        if (len(curr_input_ids) > 1):
+            ## TODO: If we know that a command reads its inputs in a list,
+            ##       then we might not need to put an eager on its first input.
+            ## Note: This cannot be done for `sort -m` so we need to know in the
+            ##       annotations whether input consumption is in order or not.
+
+            for curr_input_id in curr_input_ids:
+                _fid, from_node, to_node = graph.edges[curr_input_id]
+                assert(to_node == curr_id)
+                ## If the edge is an input edge, then we don't want to put eager.
+                if(not from_node is None):
+                    add_eager(curr_input_id, graph, fileIdGen)
+
+        if(isinstance(curr, Split)):
+            eager_input_ids = curr.get_output_list()[:-1]
+            for edge_id in eager_input_ids:
+                add_eager(edge_id, graph, fileIdGen)
+
+        ## Add an eager after r_unwrap            
+        if(isinstance(curr, r_unwrap.RUnwrap)):
+            eager_input_id = curr.get_output_list()[0]
+            add_eager(eager_input_id, graph, fileIdGen)
+
+        ## Add an eager after r_split
+        if(isinstance(curr, r_split.RSplit)):
+            eager_input_ids = curr.get_output_list()
+            for edge_id in eager_input_ids:
+                add_eager(edge_id, graph, fileIdGen)
 
     return graph
 
@@ -0,0 +1,157 @@
+import json
+import os
+
+from util import log
+
+##
+## A store of execution time profiles that is used by the daemon
+## to select the width of a region (when --profile_driven is set),
+## and of the throughputs of the commands that the regions run,
+## which are used by the throughput cost model.
+##
+
+## Bump this if the format of the stored profiles changes
+PROFILE_STORE_VERSION = 1
+
+
+class RunningStats:
+    """ A sketch of a series of measurements, e.g., the execution times of a region
+    with a specific width or the throughputs of a command.
+
+    It keeps the count, mean, and sum of squared differences from the mean
+    (Welford's algorithm), so that adding a measurement and computing the average
+    or the variance take constant time and space.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def total(self):
+        return self.mean * self.count
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    def to_list(self):
+        return [self.count, self.mean, self.m2]
+
+    @staticmethod
+    def from_list(values):
+        count, mean, m2 = values
+        return RunningStats(int(count), float(mean), float(m2))
+
+    def __repr__(self):
+        return f'RunningStats(Count:{self.count}, Mean:{self.mean}, Variance:{self.variance()})'
+
+
+class ProfileStore:
+    """ A map from region keys to the profiles of each width that the region has been executed with.
+
+    The region key is the digest of the df_region, so that profiles of the same region
+    can be found across runs. If a file is given, the profiles are loaded from it
+    when the store is created and they are written back with `store`.
+
+    It also keeps a profile of the throughput (in bytes per second, per process) of each
+    command that has been the bottleneck of a region (see `add_region_throughputs`).
+    """
+
+    def __init__(self, store_file=""):
+        self.store_file = store_file
+        self.profiles = {}
+        self.command_profiles = {}
+        if self.store_file != "":
+            self.load()
+
+    def add(self, region_key, width, exec_time):
+        region_profiles = self.profiles.setdefault(region_key, {})
+        try:
+            region_profiles[width].add(exec_time)
+        except KeyError:
+            region_profiles[width] = RunningStats()
+            region_profiles[width].add(exec_time)
+
+    def get_profiles(self, region_key):
+        return self.profiles.get(region_key, {})
+
+    def get_averages_per_width(self, region_key):
+        return {width: profile.mean
+                for width, profile in self.get_profiles(region_key).items()}
+
+    def add_command_throughput(self, command, throughput):
+        try:
+            self.command_profiles[command].add(throughput)
+        except KeyError:
+            self.command_profiles[command] = RunningStats()
+            self.command_profiles[command].add(throughput)
+
+    ## A region runs its commands in a pipeline, so its execution time is the time of its slowest
+    ##   command, i.e., the one with the lowest total throughput (the throughput of a process times
+    ##   the number of its processes). Every command is assumed to process all the input of the region.
+    ##   The measured throughput of that command replaces its estimate in later runs.
+    ##
+    ##   command_counts maps each command of the region to its number of processes and
+    ##   estimated_throughput returns the current estimate of the throughput of a command.
+    def add_region_throughputs(self, command_counts, input_size, exec_time, estimated_throughput):
+        if len(command_counts) == 0 or input_size is None or input_size == 0 or exec_time <= 0:
+            return
+        bottleneck = min(command_counts, 
+                         key=lambda command: estimated_throughput(command) * command_counts[command])
+        throughput = input_size / (exec_time * command_counts[bottleneck])
+        log("Profile store: Measured throughput of:", bottleneck, "is:", throughput)
+        self.add_command_throughput(bottleneck, throughput)
+
+    def get_command_throughputs(self):
+        return {command: profile.mean
+                for command, profile in self.command_profiles.items()}
+
+    def load(self):
+        try:
+            with open(self.store_file) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            log("Profile store: No profiles in:", self.store_file)
+            return
+        except ValueError as e:
+            log("Profile store: Could not load profiles from:", self.store_file, "Exception:", e)
+            return
+
+        if data.get("version") != PROFILE_STORE_VERSION:
+            log("Profile store: Ignoring profiles of version:", data.get("version"))
+            return
+
+        for region_key, region_profiles in data["regions"].items():
+            self.profiles[region_key] = {int(width): RunningStats.from_list(values)
+                                         for width, values in region_profiles.items()}
+        ## Stores that were written before the commands were profiled do not have them
+        for command, values in data.get("commands", {}).items():
+            self.command_profiles[command] = RunningStats.from_list(values)
+        log("Profile store: Loaded profiles of", len(self.profiles), "regions from:", self.store_file)
+
+    def store(self):
+        if self.store_file == "":
+            return
+        data = {"version": PROFILE_STORE_VERSION,
+                "regions": {region_key: {str(width): profile.to_list()
+                                         for width, profile in region_profiles.items()}
+                            for region_key, region_profiles in self.profiles.items()},
+                "commands": {command: profile.to_list()
+                             for command, profile in self.command_profiles.items()}}
+        ## Write to a temporary file and rename so that a concurrent run never reads a partial store
+        tmp_file = f'{self.store_file}.{os.getpid()}'
+        with open(tmp_file, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_file, self.store_file)
+        log("Profile store: Stored profiles of", len(self.profiles), "regions in:", self.store_file)
+
+    def __repr__(self):
+        return f'ProfileStore(Regions:{len(self.profiles)}, File:{self.store_file})'
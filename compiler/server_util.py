@@ -166,9 +166,16 @@ class SocketManager:
     ## In the case of the UnixPipes, we don't have any state management here
     ##   since all reads/writes go to/from the same fifos
     def respond(self, message):
+        self.respond_to(self.take_last_connection(), message)
+
+    ## Removes the connection we last got input from so that it can be responded to later
+    def take_last_connection(self):
+        return self.connections.pop()
+
+    def respond_to(self, connection, message):
         bytes_message = message.encode('utf-8')
-        self.connections[-1].sendall(bytes_message)
-        self.close_last_connection()
+        connection.sendall(bytes_message)
+        connection.close()
 
     ## This method doesn't do anything for unix pipe reader since we always read and write
     ## to and from the same fifos
@@ -177,6 +184,10 @@ class SocketManager:
         last_connection = self.connections.pop()
         last_connection.close()
 
+    ## Allows the manager to be used with select to wait for the next connection
+    def fileno(self):
+        return self.sock.fileno()
+
     def close(self):
         self.sock.close()
         log("SocketManager: Closed")
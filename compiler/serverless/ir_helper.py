@@ -33,12 +33,14 @@ def add_nodes_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, input_fif
     Returns:
         main_graph_script_id: the script id to execute on main shell
         subgraph_script_id_pairs: mapping from subgraph to unique script id
-        main_subgraph_script_id: the script id to execute in the first lambda
+        root_script_ids: the script ids of the lambdas that no other lambda invokes (the first ones)
+        output_keys: the keys of the objects that the last subgraphs write (the outputs of the script)
     """
     # The graph to execute in the main pash_compiler
     main_graph = IR({}, {})
     subgraph_script_id_pairs = {}
-    main_subgraph_script_id = None
+    root_script_ids = []
+    output_keys = []
 
     # Replace output edges and corrosponding input edges with remote read/write
     # with the key as old_edge_id
@@ -65,13 +67,7 @@ def add_nodes_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, input_fif
                     communication_key = str(out_edge.get_resource())
                 if args.sls_output != "":
                     communication_key = os.path.join(args.sls_output, str(communication_key))
-            # Add remote-write node at the end of the subgraph
-            remote_write = serverless_remote_pipe.make_serverless_remote_pipe(local_fifo_id=ephemeral_edge.get_ident(),
-                                                                              is_remote_read=False,
-                                                                              remote_key=communication_key,
-                                                                              output_edge=stdout,
-                                                                              is_tcp=(not last_subgraph))
-            subgraph.add_node(remote_write)
+                output_keys.append(str(communication_key))
 
             # Copy the old output edge resource
             new_edge = file_id_gen.next_file_id()
@@ -80,15 +76,26 @@ def add_nodes_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, input_fif
             if out_edge_id in input_fifo_map and out_edge.is_ephemeral():
                 matching_subgraph = input_fifo_map[out_edge_id][0]
                 matching_subgraph.replace_edge(out_edge.get_ident(), new_edge)
-                # Add invocation node
+                # Add invocation node (with --sls_fanout the main shell invokes all the lambdas instead)
                 if matching_subgraph not in subgraph_script_id_pairs:
                     script_identifier = uuid4()
                     subgraph_script_id_pairs[matching_subgraph] = script_identifier
-                    subgraph.add_node(serverless_lambda_invoke.make_serverless_lambda_invoke(script_identifier))
+                    if not args.sls_fanout:
+                        subgraph.add_node(serverless_lambda_invoke.make_serverless_lambda_invoke(script_identifier))
             else:
                 # Add edge to main graph
                 matching_subgraph = main_graph
                 matching_subgraph.add_edge(new_edge)
+
+            # Add remote-write node at the end of the subgraph
+            # (--edge_compression does not apply: the lambdas do not have the codec commands)
+            remote_write = serverless_remote_pipe.make_serverless_remote_pipe(local_fifo_id=ephemeral_edge.get_ident(),
+                                                                              is_remote_read=False,
+                                                                              remote_key=communication_key,
+                                                                              output_edge=stdout,
+                                                                              is_tcp=(not last_subgraph))
+            subgraph.add_node(remote_write)
+
             remote_read = serverless_remote_pipe.make_serverless_remote_pipe(local_fifo_id=new_edge.get_ident(),
                                                                               is_remote_read=True,
                                                                               remote_key=communication_key,
@@ -99,8 +106,9 @@ def add_nodes_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, input_fif
     # Replace non ephemeral input edges with remote read/write
     for subgraph in subgraphs:
         if subgraph not in subgraph_script_id_pairs:
-            main_subgraph_script_id = uuid4()
-            subgraph_script_id_pairs[subgraph] = main_subgraph_script_id
+            root_script_id = uuid4()
+            subgraph_script_id_pairs[subgraph] = root_script_id
+            root_script_ids.append(root_script_id)
         source_nodes = subgraph.source_nodes()
         for source in source_nodes:
             if isinstance(subgraph.get_node(source), serverless_lambda_invoke.ServerlessLambdaInvoke) or \
@@ -124,10 +132,19 @@ def add_nodes_to_subgraphs(subgraphs:List[IR], file_id_gen: FileIdGen, input_fif
                     continue
     main_graph_script_id = uuid4()
     subgraph_script_id_pairs[main_graph] = main_graph_script_id
-    return main_graph_script_id, subgraph_script_id_pairs, main_subgraph_script_id
+    return main_graph_script_id, subgraph_script_id_pairs, root_script_ids, output_keys
+
+def plan_invocations(main_graph_script_id, subgraph_script_id_pairs: dict, root_script_ids: list, args: argparse.Namespace) -> List[str]:
+    """ Returns the script ids of the lambdas that the main shell invokes: all of them with --sls_fanout
+        (so that they start concurrently, instead of one after the other along the edges), or otherwise
+        the first ones, which invoke the rest.
+    """
+    if args.sls_fanout:
+        return [str(id_) for id_ in subgraph_script_id_pairs.values() if id_ != main_graph_script_id]
+    return [str(id_) for id_ in root_script_ids]
 
 
-def prepare_scripts_for_serverless_exec(ir: IR, shell_vars: dict, args: argparse.Namespace) -> Tuple[str, str, Dict[str, str]]:
+def prepare_scripts_for_serverless_exec(ir: IR, shell_vars: dict, args: argparse.Namespace) -> Tuple[str, List[str], Dict[str, str], List[str]]:
     """
     Reads the complete ir from filename and splits it
     into subgraphs where ony the first subgraph represent a continues
@@ -142,12 +159,14 @@ def prepare_scripts_for_serverless_exec(ir: IR, shell_vars: dict, args: argparse
 
     Returns:
         main_graph_script_id: the script id to execute on main shell
-        main_subgraph_script_id: the script id to execute in the first lambda
+        invoked_script_ids: the script ids of the lambdas that the main shell invokes (see plan_invocations)
         script_id_to_script: mapping from unique script id to script content
+        output_keys: the keys of the objects that the script outputs (the lambdas report each of them when it is written)
     """
     # split IR
     subgraphs, mapping = split_ir(ir)
-    main_graph_script_id, subgraph_script_id_pairs, main_subgraph_script_id = add_nodes_to_subgraphs(subgraphs, ir.get_file_id_gen(), mapping, args)
+    main_graph_script_id, subgraph_script_id_pairs, root_script_ids, output_keys = add_nodes_to_subgraphs(subgraphs, ir.get_file_id_gen(), mapping, args)
+    invoked_script_ids = plan_invocations(main_graph_script_id, subgraph_script_id_pairs, root_script_ids, args)
 
     # save the output scripts
     script_id_to_script = {}
@@ -171,9 +190,9 @@ def prepare_scripts_for_serverless_exec(ir: IR, shell_vars: dict, args: argparse
             f.write(script)
         if id_ == main_graph_script_id:
             log("Script for main shell saved in:"+script_name)
-        elif id_ == main_subgraph_script_id:
+        elif id_ in root_script_ids:
             log("Script for first lambda saved in:"+script_name)
         else:
             log("Script for other lambda saved in:"+script_name)
 
-    return str(main_graph_script_id), str(main_subgraph_script_id), script_id_to_script
+    return str(main_graph_script_id), invoked_script_ids, script_id_to_script, output_keys
@@ -1,69 +1,156 @@
 import argparse
 import copy
 import json
+import math
 import os
-import pickle
 import sys
 import time
-import boto3
-from typing import Any, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Tuple
+from uuid import uuid4
 sys.path.append(os.path.join(os.getenv("PASH_TOP"), "compiler"))
+## The cloud services (see runtime/serverless/aws/provider.py)
+sys.path.append(os.path.join(os.getenv("PASH_TOP"), "runtime/serverless/aws"))
+from provider import SCRIPTS_PREFIX, Provider, make_provider, script_key
 from serverless.ir_helper import prepare_scripts_for_serverless_exec
 from util import log
 from ir import IR
 import config
-
-AWS_ACCOUNT_ID=os.environ.get("AWS_ACCOUNT_ID")
-QUEUE=os.environ.get("AWS_QUEUE")
+import ir_serialization
 
 def exec():
     pass
 
-def wait_msg_done():
-    while True:
-        sqs = boto3.client('sqs')
-        queue_url = f'https://sqs.us-east-1.amazonaws.com/{AWS_ACCOUNT_ID}/{QUEUE}'
-        # Receive message from SQS queue
-        response = sqs.receive_message(
-            QueueUrl=queue_url,
-            AttributeNames=[
-                'SentTimestamp'
-            ],
-            MaxNumberOfMessages=1,
-            MessageAttributeNames=[
-                'All'
-            ],
-            VisibilityTimeout=30,
-            WaitTimeSeconds=20
-        )
-        try:
-            message = response['Messages'][0]
-            receipt_handle = message['ReceiptHandle']
-
-            # Delete received message from queue
-            sqs.delete_message(
-                QueueUrl=queue_url,
-                ReceiptHandle=receipt_handle
-            )
-            log('Received and deleted message: %s' % message)
-            break
-        except:
-            time.sleep(1)
+## The number of messages to receive at once (at most 10 in SQS)
+RECEIVE_BATCH_SIZE = 10
+## The time to wait for messages in one receive (in seconds); it returns as soon as there are any
+RECEIVE_TIMEOUT = 20
+## The time to wait before receiving again when the queue fails (in seconds)
+RECEIVE_RETRY_DELAY = 1
+## The time to wait for the remaining outputs after all lambdas have finished (in seconds),
+##   since the queue does not deliver the messages in the order that they were sent
+MISSING_OUTPUTS_GRACE_PERIOD = 10
+## A lambda whose reader exited early (e.g., head) is killed by SIGPIPE, like in a shell pipeline
+SIGPIPE_RETURN_CODES = [141, -13]
+
+class CompletionTracker:
+    """ Waits for the lambdas of a job to write all the outputs of the script.
+
+    Every lambda reports when it finishes (a "lambda-done" message) and every output object when
+    it is written (a "done" message), both with the id of their job. The messages of other jobs
+    (e.g., the late ones of a previous script) are dropped.
+
+    The job fails if a lambda returns a nonzero code, if all lambdas have finished but some
+    outputs are still missing, or if the outputs are not written within the timeout (if it is set).
+    """
+
+    def __init__(self, provider: Provider, job_id: str, output_keys: List[str], lambda_total: int, timeout: float = 0):
+        self.provider = provider
+        self.job_id = job_id
+        self.pending_keys = set(output_keys)
+        self.start_time = time.time()
+        self.lambda_total = lambda_total
+        self.timeout = timeout
+        self.lambda_count = 0
+        self.failed_script_ids = []
+        self.lambdas_done_time = None
+
+    def handle_message(self, message: dict):
+        if message.get("job") != self.job_id:
+            log(f"Dropped message of another job: {message}")
+            return
+        if message.get("message") == "lambda-done":
+            self.lambda_count += 1
+            log(f"Lambda {message['script_id']} finished with return code {message['return_code']}:",
+                f"started at {message['start_time'] - self.start_time:.3f}s,",
+                f"ran for {message['end_time'] - message['start_time']:.3f}s")
+            if message["return_code"] != 0 and message["return_code"] not in SIGPIPE_RETURN_CODES:
+                self.failed_script_ids.append(message["script_id"])
+            if self.lambda_count == self.lambda_total:
+                self.lambdas_done_time = time.time()
+        elif message.get("message") == "done":
+            key = message["output_file_id"]
+            self.pending_keys.discard(key)
+            log(f"Output {key} written at {message['end_time'] - self.start_time:.3f}s",
+                f"(put in {message['end_time'] - message['start_time']:.3f}s),",
+                f"{len(self.pending_keys)} outputs left")
+        else:
+            log(f"Unknown message: {message}")
+
+    ## Returns why the job failed (or None if it has not failed)
+    def failure(self) -> Optional[str]:
+        now = time.time()
+        if len(self.failed_script_ids) > 0:
+            return f"Lambdas {self.failed_script_ids} returned a nonzero code"
+        if (self.lambdas_done_time is not None 
+            and now - self.lambdas_done_time > MISSING_OUTPUTS_GRACE_PERIOD):
+            return f"All {self.lambda_total} lambdas finished but outputs {sorted(self.pending_keys)} are missing"
+        if self.timeout > 0 and now - self.start_time > self.timeout:
+            return f"Outputs {sorted(self.pending_keys)} were not written within {self.timeout}s"
+        return None
+
+    def receive_timeout(self) -> int:
+        deadlines = []
+        if self.lambdas_done_time is not None:
+            deadlines.append(self.lambdas_done_time + MISSING_OUTPUTS_GRACE_PERIOD)
+        if self.timeout > 0:
+            deadlines.append(self.start_time + self.timeout)
+        if len(deadlines) == 0:
+            return RECEIVE_TIMEOUT
+        return max(1, min(RECEIVE_TIMEOUT, math.ceil(min(deadlines) - time.time())))
+
+    ## Returns whether all outputs were written
+    def wait(self) -> bool:
+        while len(self.pending_keys) > 0:
+            failure = self.failure()
+            if failure is not None:
+                log(f"Job {self.job_id} failed after {time.time() - self.start_time:.3f}s: {failure}")
+                return False
+            try:
+                messages = self.provider.receive_messages(RECEIVE_BATCH_SIZE, self.receive_timeout())
+            except Exception as e:
+                log(f"Could not receive from the completion queue: {e}")
+                time.sleep(RECEIVE_RETRY_DELAY)
+                continue
+            for message in messages:
+                self.handle_message(message)
+        log(f"All outputs written in {time.time() - self.start_time:.3f}s ({self.lambda_count} lambdas finished)")
+        return True
 
 def read_graph(filename):
     with open(filename, "rb") as ir_file:
-        ir, shell_vars, args = pickle.load(ir_file)
+        ir, (shell_vars, args) = ir_serialization.load_graph(ir_file)
     return ir, shell_vars, args
 
-def invoke_lambda(script_id_to_script, script_id):
-    lambda_client = boto3.client("lambda",region_name='us-east-1')
-    response = lambda_client.invoke(
-        FunctionName="lambda",
-        InvocationType="Event",
-        LogType="None",
-        Payload=json.dumps({"data": json.dumps(script_id_to_script) , "id": script_id}),
-    )
-    return response
+## The number of concurrent requests that start a job (puts of its scripts and invocations)
+REQUEST_CONCURRENCY = 32
+
+def invoke_lambda(provider: Provider, script_id_to_script, script_id, job_id, scripts_prefix=None):
+    if scripts_prefix is not None:
+        return provider.invoke(script_id, None, job_id, scripts_prefix)
+    return provider.invoke(script_id, json.dumps(script_id_to_script), job_id)
+
+def ship_scripts(provider: Provider, script_ids, job_id, pool: ThreadPoolExecutor) -> str:
+    """ Stores the scripts of the lambdas in the bucket (from where prepare_scripts_for_serverless_exec saved them)
+    and returns their prefix. """
+    scripts_prefix = f"{SCRIPTS_PREFIX}/{job_id}"
+    list(pool.map(lambda script_id: provider.put_object(script_key(scripts_prefix, script_id),
+                                                        os.path.join(config.PASH_TMP_PREFIX, script_id)),
+                  script_ids))
+    log(f"Stored {len(script_ids)} scripts in {scripts_prefix}")
+    return scripts_prefix
+
+def start_job(provider: Provider, main_graph_script_id, invoked_script_ids, script_id_to_script, job_id, args):
+    """ Invokes the lambdas that the main shell starts, concurrently. """
+    with ThreadPoolExecutor(max_workers=REQUEST_CONCURRENCY) as pool:
+        scripts_prefix = None
+        if args.sls_ship_scripts:
+            lambda_script_ids = [id_ for id_ in script_id_to_script if id_ != main_graph_script_id]
+            scripts_prefix = ship_scripts(provider, lambda_script_ids, job_id, pool)
+        responses = pool.map(lambda script_id: invoke_lambda(provider, script_id_to_script, script_id, job_id, scripts_prefix),
+                             invoked_script_ids)
+        for script_id, response in zip(invoked_script_ids, responses):
+            log(f"Invoked lambda {script_id}: {response}")
 
 def init(ir_filename: str) -> Tuple[IR, argparse.Namespace, dict]:
     # init pash_args, config, logging
@@ -78,13 +165,16 @@ def init(ir_filename: str) -> Tuple[IR, argparse.Namespace, dict]:
 def main(ir_filename: str):
     ir, shell_vars, args = init(ir_filename)
     # prepare scripts
-    main_graph_script_id, main_subgraph_script_id, script_id_to_script = prepare_scripts_for_serverless_exec(ir, shell_vars, args)
+    main_graph_script_id, invoked_script_ids, script_id_to_script, output_keys = prepare_scripts_for_serverless_exec(ir, shell_vars, args)
 
-    # start serverless execution by invoking the first lambda
-    response = invoke_lambda(script_id_to_script, main_subgraph_script_id)
-    log(response)
-    wait_msg_done()
+    # start serverless execution by invoking the first lambdas (or all of them with --sls_fanout)
+    provider = make_provider(args.sls_provider)
+    job_id = str(uuid4())
+    ## All scripts but the main one run in lambdas
+    tracker = CompletionTracker(provider, job_id, output_keys, len(script_id_to_script) - 1, args.sls_timeout)
+    start_job(provider, main_graph_script_id, invoked_script_ids, script_id_to_script, job_id, args)
+    return 0 if tracker.wait() else 1
 
 if __name__ == '__main__':
     ir_filename= args = sys.argv[1:][0]
-    main(ir_filename)
+    sys.exit(main(ir_filename))
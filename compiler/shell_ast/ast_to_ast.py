@@ -1,8 +1,8 @@
 from enum import Enum
 import copy
-import pickle
 
 import config
+import ir_serialization
 
 from env_var_names import *
 from shell_ast.ast_util import *
@@ -551,7 +551,7 @@ def replace_df_region(asts, trans_options, disable_parallel_pipelines=False, ast
 
         ## Serialize the node in a file
         with open(ir_filename, "wb") as ir_file:
-            pickle.dump(asts, ir_file)
+            ir_serialization.dump_df_region(asts, ir_file)
 
         ## Serialize the candidate df_region asts back to shell
         ## so that the sequential script can be run in parallel to the compilation.
@@ -0,0 +1,198 @@
+##
+## A micro-benchmark for the graph traversals of the compiler.
+##
+## It builds a graph that looks like the ones that the compiler produces for a
+## long pipeline with a large width, i.e., a sequence of stages that each split
+## their input in `width` chains of cat nodes of uneven lengths (up to `depth`)
+## and merge them back with a tree of cat nodes that each merge `fan_in` inputs
+## (like the aggregators of a parallel stage), and times the traversals (choosing
+## parallelizers and adding eager nodes) on it. Since the branches are uneven,
+## the previous traversals reach many nodes before all their previous nodes.
+##
+## The baselines are copies of the previous traversals, with the previous
+## get_next_nodes and get_previous_nodes (which go through the nodes' io lists).
+##
+## Run it with: python3 graph_traversal.py --width 64 --depth 8 --stages 16
+## (it also accepts the compiler flags, e.g., --r_split_batch_size)
+##
+
+import argparse
+import atexit
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+
+PASH_TOP = os.environ.get("PASH_TOP", os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+sys.path.append(os.path.join(PASH_TOP, "compiler"))
+## The file id generators create a directory for their fifos (in a directory that is removed at exit)
+os.environ["PASH_TMP_PREFIX"] = tempfile.mkdtemp(prefix="pash_graph_traversal_")
+atexit.register(shutil.rmtree, os.environ["PASH_TMP_PREFIX"], ignore_errors=True)
+os.environ.setdefault("PASH_TIMESTAMP", time.strftime("%y-%m-%d-%T"))
+
+import config
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Times the graph traversals of the compiler")
+    ## The compiler flags (e.g., --width, the number of parallel chains in each stage)
+    config.add_common_arguments(parser)
+    parser.add_argument("--depth", type=int, default=8,
+                        help="the maximum number of nodes in each chain (the chains have from 1 to depth nodes)")
+    parser.add_argument("--fan_in", type=int, default=4,
+                        help="the number of inputs of each merging node")
+    parser.add_argument("--stages", type=int, default=16,
+                        help="the number of stages in the pipeline")
+    parser.add_argument("--repetitions", type=int, default=3,
+                        help="the number of times that each traversal is timed")
+    parser.add_argument("--no_baseline", action="store_true", default=False,
+                        help="do not time the previous (list-based) traversals")
+    return parser.parse_args()
+
+## Builds the graph: input -> split -> width chains of 1 to depth cats -> tree of cats -> ... -> output
+def make_graph(width, depth, stages, fan_in):
+    from ir import IR, FileIdGen
+    from definitions.ir.nodes.cat import make_cat_node
+    from definitions.ir.nodes.pash_split import make_split_file
+
+    fileIdGen = FileIdGen()
+    edges = {}
+    nodes = {}
+
+    def new_edge():
+        fid = fileIdGen.next_ephemeral_file_id()
+        edges[fid.get_ident()] = (fid, None, None)
+        return fid.get_ident()
+
+    def add_node(node):
+        node_id = node.get_id()
+        nodes[node_id] = node
+        for in_id in node.get_input_list():
+            fid, from_node, _to_node = edges[in_id]
+            edges[in_id] = (fid, from_node, node_id)
+        for out_id in node.get_output_list():
+            fid, _from_node, to_node = edges[out_id]
+            edges[out_id] = (fid, node_id, to_node)
+
+    stage_input = new_edge()
+    for _ in range(stages):
+        chain_ends = [new_edge() for _ in range(width)]
+        add_node(make_split_file(stage_input, chain_ends))
+        for chain in range(width):
+            ## The lengths of the chains are spread over 1 to depth (and not in order)
+            for _ in range(1 + (chain * 7) % depth):
+                output = new_edge()
+                add_node(make_cat_node([chain_ends[chain]], output))
+                chain_ends[chain] = output
+        while len(chain_ends) > 1:
+            merged = []
+            for i in range(0, len(chain_ends), fan_in):
+                output = new_edge()
+                add_node(make_cat_node(chain_ends[i:i + fan_in], output))
+                merged.append(output)
+            chain_ends = merged
+        stage_input = chain_ends[0]
+    return IR(nodes, edges)
+
+## The previous get_next_nodes and get_previous_nodes of IR (before the adjacency index)
+def baseline_get_next_nodes(graph, node_id):
+    output_edge_ids = graph.nodes[node_id].get_output_list()
+    next_nodes = []
+    for edge_id in output_edge_ids:
+        _fid, from_node, to_node = graph.edges[edge_id]
+        assert(from_node == node_id)
+        if(not to_node is None):
+            next_nodes.append(to_node)
+    return next_nodes
+
+def baseline_get_previous_nodes(graph, node_id):
+    input_edge_ids = graph.nodes[node_id].get_input_list()
+    previous_nodes = []
+    for edge_id in input_edge_ids:
+        _fid, from_node, to_node = graph.edges[edge_id]
+        assert(to_node == node_id)
+        if(not from_node is None):
+            previous_nodes.append(from_node)
+    return previous_nodes
+
+## The traversals before they used topological_order and get_adjacency
+def baseline_choose_parallelizing_transformations(graph, cost_model):
+    from pash_compiler import choose_parallelizing_transformation
+    source_node_ids = graph.source_nodes()
+    parallelizer_map = {}
+    workset = source_node_ids
+    visited = set()
+    while (len(workset) > 0):
+        curr_id = workset.pop(0)
+        all_previous_nodes_visited = all(prev in visited for prev in baseline_get_previous_nodes(graph, curr_id))
+        if not all_previous_nodes_visited:
+            workset.append(curr_id)
+        elif not curr_id in visited:
+            workset += baseline_get_next_nodes(graph, curr_id)
+            parallelizer_map[curr_id] = choose_parallelizing_transformation(curr_id, cost_model, parallelizer_map)
+            visited.add(curr_id)
+    return parallelizer_map
+
+## The order in which add_eager_nodes visits the nodes (without adding eager nodes)
+def visit_order(graph):
+    _previous_nodes, next_nodes = graph.get_adjacency()
+    workset = deque(node for source_node_id in graph.source_nodes() for node in next_nodes[source_node_id])
+    visited = set(workset)
+    while (len(workset) > 0):
+        curr_id = workset.popleft()
+        for next_id in next_nodes[curr_id]:
+            if (not next_id in visited):
+                visited.add(next_id)
+                workset.append(next_id)
+    return visited
+
+def baseline_visit_order(graph):
+    workset = [node for source_node_id in graph.source_nodes() for node in baseline_get_next_nodes(graph, source_node_id)]
+    visited = set()
+    while (len(workset) > 0):
+        curr_id = workset.pop(0)
+        if (not curr_id in visited):
+            visited.add(curr_id)
+            workset += baseline_get_next_nodes(graph, curr_id)
+    return visited
+
+def time_it(name, repetitions, make_input, function):
+    times = []
+    for _ in range(repetitions):
+        input = make_input()
+        start = time.perf_counter()
+        function(input)
+        times.append(time.perf_counter() - start)
+    print(f'{name:<45} best: {min(times) * 1000:10.2f} ms')
+
+def main():
+    args = parse_args()
+    config.set_config_globals_from_pash_args(args)
+    config.load_config()
+
+    from cost_model import make_cost_model
+    from pash_compiler import choose_parallelizing_transformations, add_eager_nodes
+
+    graph = make_graph(args.width, args.depth, args.stages, args.fan_in)
+    print(f'Graph with {len(graph.nodes)} nodes and {len(graph.edges)} edges')
+
+    def choose(graph):
+        cost_model = make_cost_model("priority", graph, args.width, args.r_split_batch_size)
+        return choose_parallelizing_transformations(graph, cost_model)
+
+    def baseline_choose(graph):
+        cost_model = make_cost_model("priority", graph, args.width, args.r_split_batch_size)
+        return baseline_choose_parallelizing_transformations(graph, cost_model)
+
+    time_it("choose_parallelizing_transformations", args.repetitions, lambda: graph, choose)
+    if not args.no_baseline:
+        time_it("choose_parallelizing_transformations (baseline)", args.repetitions, lambda: graph, baseline_choose)
+    time_it("eager node visit order", args.repetitions, lambda: graph, visit_order)
+    if not args.no_baseline:
+        time_it("eager node visit order (baseline)", args.repetitions, lambda: graph, baseline_visit_order)
+    time_it("add_eager_nodes", args.repetitions, lambda: copy.deepcopy(graph), add_eager_nodes)
+
+if __name__ == "__main__":
+    main()
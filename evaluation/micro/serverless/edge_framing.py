@@ -0,0 +1,167 @@
+##
+## A micro-benchmark for the framing of the edges between lambdas (see runtime/serverless/aws/sendrecv.py).
+##
+## It streams random data through a loopback TCP connection (a stand-in for the connection
+## between two lambdas) from a sender process to a receiver, with:
+##   ints  -- the padded lists of ints of sendrecv.py, converted to and from 4-byte ints on the
+##            wire like the fmi bindings do
+##   bytes -- the length-prefixed frames of framing.py through a socket (SocketChannel), which
+##            no edge between lambdas uses; it is the cost of the framing alone
+##   fmi   -- the same frames as FmiChannel in sendrecv.py sends them: the payloads are turned
+##            into the lists of ints that the fmi bindings take (pack_ints and unpack_ints),
+##            and the bindings' conversion of these lists to and from 4-byte ints on the wire
+##            is done with array. This is what the bytes framing of sendrecv.py costs.
+## and reports the throughput of each one.
+##
+## Run it with: python3 edge_framing.py --size 256
+##
+
+import argparse
+import hashlib
+import io
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from array import array
+
+PASH_TOP = os.environ.get("PASH_TOP", os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+sys.path.append(os.path.join(PASH_TOP, "runtime/serverless/aws"))
+
+from framing import DATA, END, FRAME_HEADER, FRAME_SIZE, SocketChannel, pack_ints, recv_stream, send_stream, unpack_ints
+
+## The batch of sendrecv.py (in ints, i.e., bytes of the stream)
+INTS_BATCH = 1000000
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Times the framings of the edges between lambdas over a loopback connection")
+    parser.add_argument("--size", type=int, default=256,
+                        help="the size of the stream in MB")
+    parser.add_argument("--frame_size", type=int, default=FRAME_SIZE,
+                        help="the maximum payload of the frames of the bytes and fmi framings")
+    parser.add_argument("--repetitions", type=int, default=3,
+                        help="the number of times that each framing is timed")
+    parser.add_argument("--no_baseline", action="store_true", default=False,
+                        help="do not time the ints framing (it is slow for large sizes)")
+    return parser.parse_args()
+
+class Sink:
+    """ A file that only hashes what is written to it. """
+
+    def __init__(self):
+        self.hash = hashlib.sha1()
+        self.length = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.length += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+def recv_exactly(sock, length):
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("The connection closed in the middle of a batch")
+        received += n
+    return data
+
+## The framing of sendrecv.py: every batch is a list of ints of the bytes padded with -1,
+##   and a batch of -1 ends the stream
+def send_ints(infile, sock):
+    while True:
+        x = infile.read(INTS_BATCH)
+        if not x:
+            sock.sendall(array("i", INTS_BATCH * [-1]).tobytes())
+            break
+        data = list(x) + (INTS_BATCH - len(x)) * [-1]
+        sock.sendall(array("i", data).tobytes())
+
+def recv_ints(sock, outfile):
+    while True:
+        x = array("i", recv_exactly(sock, 4 * INTS_BATCH)).tolist()
+        if x[0] == -1:
+            break
+        write = [item for item in x if item != -1]
+        outfile.write(bytes(write))
+        outfile.flush()
+
+class FmiLoopbackChannel(SocketChannel):
+    """ The frames of FmiChannel (in sendrecv.py), with a socket instead of fmi. """
+
+    def send_frame(self, frame_type, payload=b""):
+        ints = pack_ints(payload) if len(payload) > 0 else []
+        ## What the fmi bindings send for the int and the list of ints
+        self.sock.sendall(FRAME_HEADER.pack(frame_type, len(payload)))
+        if len(ints) > 0:
+            self.sock.sendall(array("i", ints).tobytes())
+
+    def recv_frame(self):
+        self.recv_exactly(memoryview(self.header))
+        frame_type, length = FRAME_HEADER.unpack(self.header)
+        if frame_type == END:
+            return END, b""
+        wire = bytearray((length + 3) // 4 * 4)
+        self.recv_exactly(memoryview(wire))
+        ## What the fmi bindings return for the list of ints
+        ints = array("i", wire).tolist()
+        return DATA, unpack_ints(ints, length)
+
+def send_bytes(infile, sock, frame_size):
+    send_stream(infile, SocketChannel(sock, frame_size), frame_size)
+
+def recv_bytes(sock, outfile, frame_size):
+    recv_stream(SocketChannel(sock, frame_size), outfile)
+
+def sender(framing, port, data, frame_size):
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        if framing == "ints":
+            send_ints(io.BytesIO(data), sock)
+        elif framing == "fmi":
+            send_stream(io.BytesIO(data), FmiLoopbackChannel(sock, frame_size), frame_size)
+        else:
+            send_bytes(io.BytesIO(data), sock, frame_size)
+
+def time_framing(framing, data, frame_size):
+    """ Returns the seconds that the framing takes to stream the data, and the hash of what was received. """
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        port = server.getsockname()[1]
+        process = multiprocessing.Process(target=sender, args=(framing, port, data, frame_size))
+        start_time = time.perf_counter()
+        process.start()
+        sock, _ = server.accept()
+        sink = Sink()
+        with sock:
+            if framing == "ints":
+                recv_ints(sock, sink)
+            elif framing == "fmi":
+                recv_stream(FmiLoopbackChannel(sock, frame_size), sink)
+            else:
+                recv_bytes(sock, sink, frame_size)
+        elapsed = time.perf_counter() - start_time
+        process.join()
+    return elapsed, sink.hash.hexdigest()
+
+def main():
+    args = parse_args()
+    data = os.urandom(args.size * 1024 * 1024)
+    expected_hash = hashlib.sha1(data).hexdigest()
+    framings = ["fmi", "bytes"] if args.no_baseline else ["ints", "fmi", "bytes"]
+    print(f"Streaming {args.size} MB over loopback ({args.repetitions} repetitions)")
+    for framing in framings:
+        times = []
+        for _ in range(args.repetitions):
+            elapsed, received_hash = time_framing(framing, data, args.frame_size)
+            assert received_hash == expected_hash, f"{framing}: the received data differ"
+            times.append(elapsed)
+        best = min(times)
+        print(f"{framing:>6}: {best:.3f} s (best), {args.size / best:.1f} MB/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import struct
+from array import array
+
+##
+## The framing of the edges between lambdas (see sendrecv.py).
+##
+## A stream is a sequence of DATA frames with its bytes, in order, and an END frame. Every frame
+## is a header with its type and the length of its payload, followed by the payload, so the
+## receiver never has to look at the bytes themselves (there is no padding or marker to filter).
+## The payloads are memoryviews of one buffer on both ends, so the framing itself never handles
+## the bytes one by one.
+##
+## A channel sends and receives whole frames:
+##   send_frame(frame_type, payload)
+##   recv_frame() -> (frame_type, payload)
+## SocketChannel sends them through a connected socket (e.g., a loopback one for benchmarks, see
+## evaluation/micro/serverless/edge_framing.py) and FmiChannel (in sendrecv.py) through fmi.
+##
+## The python bindings of fmi only send typed values (ints, lists of ints, ...), not buffers, so
+## FmiChannel still has to give them a python list: pack_ints turns a payload into a list with
+## an int for every 4 bytes (in C, with array), and unpack_ints turns it back. The list still has
+## a python int for every 4 bytes, which bounds the throughput of FmiChannel.
+##
+
+DATA = 0
+END = 1
+
+## The type and the length of the payload of a frame
+FRAME_HEADER = struct.Struct("!BI")
+
+## The maximum payload of a frame
+FRAME_SIZE = 1024 * 1024
+
+def pack_ints(payload):
+    """ Returns the payload as a list of 4-byte ints (padded with zeros to a multiple of 4 bytes). """
+    ints = array("i")
+    full = len(payload) - len(payload) % 4
+    ints.frombytes(payload[:full])
+    if full < len(payload):
+        ints.frombytes(bytes(payload[full:]) + bytes(4 - len(payload) % 4))
+    return ints.tolist()
+
+def unpack_ints(ints, length):
+    """ Returns the first length bytes of the list of 4-byte ints of pack_ints. """
+    return memoryview(array("i", ints).tobytes())[:length]
+
+def send_stream(infile, channel, frame_size=FRAME_SIZE):
+    """ Sends the contents of the (binary) file through the channel and returns their length. """
+    buffer = bytearray(frame_size)
+    view = memoryview(buffer)
+    sent = 0
+    while True:
+        length = infile.readinto(buffer)
+        if not length:
+            break
+        channel.send_frame(DATA, view[:length])
+        sent += length
+    channel.send_frame(END)
+    return sent
+
+def recv_stream(channel, outfile):
+    """ Writes the frames of the channel to the (binary) file until the end of the stream and returns their length. """
+    received = 0
+    while True:
+        frame_type, payload = channel.recv_frame()
+        if frame_type == END:
+            break
+        outfile.write(payload)
+        outfile.flush()
+        received += len(payload)
+    return received
+
+class SocketChannel:
+    """ Frames through a connected stream socket. """
+
+    def __init__(self, sock, frame_size=FRAME_SIZE):
+        self.sock = sock
+        self.header = bytearray(FRAME_HEADER.size)
+        self.buffer = bytearray(frame_size)
+
+    def send_frame(self, frame_type, payload=b""):
+        self.sock.sendall(FRAME_HEADER.pack(frame_type, len(payload)))
+        if len(payload) > 0:
+            self.sock.sendall(payload)
+
+    ## The payload is a view of the buffer of the channel, valid until the next frame
+    def recv_frame(self):
+        self.recv_exactly(memoryview(self.header))
+        frame_type, length = FRAME_HEADER.unpack(self.header)
+        if length > len(self.buffer):
+            self.buffer = bytearray(length)
+        payload = memoryview(self.buffer)[:length]
+        self.recv_exactly(payload)
+        return frame_type, payload
+
+    def recv_exactly(self, view):
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError("The connection closed in the middle of a frame")
+            received += n
@@ -1,16 +1,11 @@
-import boto3
+import os
 import sys
-import json
+from provider import make_provider
 id_, data_path = sys.argv[1:]
 print("[invoke-lambda.py] Invoke lambda", id_)
 with open(data_path, "r") as f:
     data = f.read()
 
-lambda_client = boto3.client("lambda")
-
-response = lambda_client.invoke(
-    FunctionName="lambda",
-    InvocationType="Event",
-    LogType="None",
-    Payload=json.dumps({"id": id_, "data": data}),
-)
+# the invoked lambda belongs to the same job as this one (and gets its script from the same place)
+scripts_prefix = os.environ.get("PASH_SLS_SCRIPTS") or None
+make_provider().invoke(id_, None if scripts_prefix else data, os.environ.get("PASH_SLS_JOB_ID"), scripts_prefix)
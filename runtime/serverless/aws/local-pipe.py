@@ -0,0 +1,23 @@
+import sys
+import time
+
+from provider import make_provider
+
+## The edges between lambdas (instead of sendrecv.py) for the local provider (see provider.py).
+## Usage: local-pipe.py send <key> < input
+##        local-pipe.py recv <key> > output
+
+direction, key = sys.argv[1:]
+provider = make_provider("local")
+path = provider.pipe_path(key)
+
+print(f"[local-pipe.py] Start {direction} {key}", file=sys.stderr)
+start_time = time.time()
+if direction == "send":
+    with open(path, "wb") as f:
+        copied = provider.tcp.copy(sys.stdin.buffer, f)
+else:
+    with open(path, "rb") as f:
+        copied = provider.tcp.copy(f, sys.stdout.buffer)
+total_time = round(time.time() - start_time, 3)
+print(f"[local-pipe.py] Finish {direction} {key}: {copied} bytes in {total_time} seconds", file=sys.stderr)
@@ -0,0 +1,389 @@
+import collections
+import fcntl
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+##
+## The cloud services that the serverless runtime uses: invoking lambdas, getting and
+## putting objects, and the queue through which the lambdas tell the main shell that they
+## are done (and which outputs they wrote). The messages of a script carry the id of its job,
+## which the lambdas pass on to the lambdas they invoke (see PASH_SLS_JOB_ID in lambda-function.py).
+##
+## The provider is chosen with the PASH_SLS_PROVIDER environment variable (aws by default):
+##   aws    -- Lambda, S3 and SQS (see README.md)
+##   local  -- emulates them on this machine, so that the serverless backend can be tested
+##             and benchmarked without an AWS account. The lambdas are processes, the bucket
+##             and the queue are directories under PASH_SLS_LOCAL_DIR, and the concurrency,
+##             the cold starts and the network of the lambdas are configured in local.json
+##             (or the file in PASH_SLS_LOCAL_CONFIG).
+##
+
+SERVERLESS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+## Objects are read with ranged requests of this size, up to READ_CONCURRENCY of them at a time ahead of the
+##   reader, and written in parts of this size (at least 5MB in S3), up to WRITE_CONCURRENCY of them at a time.
+##   So a get or a put holds at most (concurrency + 1) * size bytes in memory, however large the object is.
+RANGE_SIZE = 8 * 1024 * 1024
+READ_CONCURRENCY = 4
+PART_SIZE = 8 * 1024 * 1024
+WRITE_CONCURRENCY = 4
+
+## The maximum number of messages that SQS returns at once
+SQS_BATCH_SIZE = 10
+
+## With --sls_ship_scripts, the scripts of a job are stored once in the bucket under
+##   <SCRIPTS_PREFIX>/<job id>/ and the invocations only carry this prefix instead of the scripts
+SCRIPTS_PREFIX = "pash-scripts"
+
+def script_key(scripts_prefix, script_id):
+    return f"{scripts_prefix}/{script_id}.sh"
+
+class Provider:
+    def invoke(self, script_id, data, job_id=None, scripts_prefix=None):
+        """ Starts a lambda that executes the script with the id (asynchronously).
+        The data is the json of all the scripts by id, or None if they are stored under the scripts prefix. """
+        raise NotImplementedError()
+
+    def get_object(self, key, outfile):
+        """ Writes the object to the file (e.g., a fifo) in order, while its next ranges are read concurrently. """
+        size = self.object_size(key)
+        with open(outfile, "wb") as f, ThreadPoolExecutor(max_workers=READ_CONCURRENCY) as pool:
+            pending = collections.deque()
+            for start in range(0, size, RANGE_SIZE):
+                pending.append(pool.submit(self.get_range, key, start, min(start + RANGE_SIZE, size)))
+                if len(pending) > READ_CONCURRENCY:
+                    f.write(pending.popleft().result())
+                    f.flush()
+            while len(pending) > 0:
+                f.write(pending.popleft().result())
+                f.flush()
+
+    def put_object(self, key, infile):
+        """ Writes the file (e.g., a fifo) to the object while it is read, uploading its parts concurrently. """
+        with open(infile, "rb") as f:
+            part = read_part(f)
+            next_part = read_part(f) if len(part) == PART_SIZE else b""
+            ## Small objects are put at once
+            if len(next_part) == 0:
+                self.put_bytes(key, part)
+                return
+            upload = self.start_upload(key)
+            try:
+                with ThreadPoolExecutor(max_workers=WRITE_CONCURRENCY) as pool:
+                    uploaded = []
+                    pending = collections.deque()
+                    number = 1
+                    while len(part) > 0:
+                        pending.append(pool.submit(self.upload_part, upload, number, part))
+                        ## Waits for the oldest part before reading more of the file
+                        if len(pending) >= WRITE_CONCURRENCY:
+                            uploaded.append(pending.popleft().result())
+                        part, next_part = next_part, read_part(f)
+                        number += 1
+                    uploaded.extend(future.result() for future in pending)
+                self.complete_upload(upload, uploaded)
+            except BaseException:
+                self.abort_upload(upload)
+                raise
+
+    ## The requests of get_object and put_object
+
+    def object_size(self, key) -> int:
+        raise NotImplementedError()
+
+    def get_range(self, key, start, end) -> bytes:
+        """ Returns the bytes of the object from start up to (not including) end. """
+        raise NotImplementedError()
+
+    def put_bytes(self, key, data):
+        raise NotImplementedError()
+
+    def start_upload(self, key):
+        """ Starts a multipart upload to the object and returns it. """
+        raise NotImplementedError()
+
+    def upload_part(self, upload, number, data):
+        """ Uploads the part with the number (from 1) and returns what complete_upload needs for it. """
+        raise NotImplementedError()
+
+    def complete_upload(self, upload, parts):
+        """ Makes the object from the uploaded parts (in order). """
+        raise NotImplementedError()
+
+    def abort_upload(self, upload):
+        raise NotImplementedError()
+
+    def send_message(self, message: dict):
+        """ Sends a message to the completion queue. """
+        raise NotImplementedError()
+
+    def receive_messages(self, max_messages, timeout) -> list:
+        """ Returns (and removes) up to max_messages messages of the completion queue as soon as there are any,
+        or none after the timeout (in seconds). """
+        raise NotImplementedError()
+
+## Reads a part of the file (fewer bytes only at its end)
+def read_part(f):
+    chunks = []
+    remaining = PART_SIZE
+    while remaining > 0:
+        chunk = f.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+class AwsProvider(Provider):
+    def __init__(self):
+        import boto3
+        self.boto3 = boto3
+        self.bucket = os.environ.get("AWS_BUCKET")
+        self.queue_url = f'https://sqs.us-east-1.amazonaws.com/{os.environ.get("AWS_ACCOUNT_ID")}/{os.environ.get("AWS_QUEUE")}'
+        ## The clients are created once (they set up their connections) and shared by the threads of get/put_object
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    def client(self, service):
+        with self.clients_lock:
+            if service not in self.clients:
+                self.clients[service] = self.boto3.client(service, region_name='us-east-1')
+            return self.clients[service]
+
+    def invoke(self, script_id, data, job_id=None, scripts_prefix=None):
+        return self.client("lambda").invoke(
+            FunctionName="lambda",
+            InvocationType="Event",
+            LogType="None",
+            Payload=json.dumps({"id": script_id, "data": data, "job": job_id, "scripts": scripts_prefix}),
+        )
+
+    def object_size(self, key):
+        return self.client("s3").head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+
+    def get_range(self, key, start, end):
+        response = self.client("s3").get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}")
+        return response["Body"].read()
+
+    def put_bytes(self, key, data):
+        self.client("s3").put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def start_upload(self, key):
+        response = self.client("s3").create_multipart_upload(Bucket=self.bucket, Key=key)
+        return key, response["UploadId"]
+
+    def upload_part(self, upload, number, data):
+        key, upload_id = upload
+        response = self.client("s3").upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                 PartNumber=number, Body=data)
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def complete_upload(self, upload, parts):
+        key, upload_id = upload
+        self.client("s3").complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                    MultipartUpload={"Parts": parts})
+
+    def abort_upload(self, upload):
+        key, upload_id = upload
+        self.client("s3").abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+    def send_message(self, message):
+        self.client("sqs").send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+
+    def receive_messages(self, max_messages, timeout):
+        sqs = self.client("sqs")
+        response = sqs.receive_message(
+            QueueUrl=self.queue_url,
+            AttributeNames=['SentTimestamp'],
+            MaxNumberOfMessages=max(1, min(SQS_BATCH_SIZE, max_messages)),
+            MessageAttributeNames=['All'],
+            VisibilityTimeout=30,
+            ## Long polling returns as soon as there are messages, and waits for at most 20 seconds
+            WaitTimeSeconds=max(0, min(20, int(timeout)))
+        )
+        messages = response.get('Messages', [])
+        if len(messages) == 0:
+            return []
+        sqs.delete_message_batch(QueueUrl=self.queue_url,
+                                 Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                                          for i, message in enumerate(messages)])
+        return [json.loads(message['Body']) for message in messages]
+
+
+class Link:
+    """ A network link with a bandwidth per request (in MB/s, 0 for unlimited) and a latency per request (in seconds). """
+
+    def __init__(self, config):
+        self.bandwidth = config.get("bandwidth", 0) * 1024 * 1024
+        self.latency = config.get("latency", 0)
+
+    ## Copies src (up to size bytes, if given) to dst no faster than the bandwidth
+    def copy(self, src, dst, size=None):
+        time.sleep(self.latency)
+        start_time = time.time()
+        copied = 0
+        while size is None or copied < size:
+            data = src.read(COPY_CHUNK_SIZE if size is None else min(COPY_CHUNK_SIZE, size - copied))
+            if not data:
+                break
+            dst.write(data)
+            dst.flush()
+            copied += len(data)
+            if self.bandwidth > 0:
+                ahead = copied / self.bandwidth - (time.time() - start_time)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return copied
+
+
+class LocalProvider(Provider):
+    def __init__(self):
+        self.root = os.environ.get("PASH_SLS_LOCAL_DIR", "/tmp/pash-sls-local")
+        self.config_path = os.environ.get("PASH_SLS_LOCAL_CONFIG", os.path.join(SERVERLESS_DIR, "local.json"))
+        with open(self.config_path) as f:
+            self.config = json.load(f)
+        self.s3 = Link(self.config.get("s3", {}))
+        self.tcp = Link(self.config.get("tcp", {}))
+        for directory in ["bucket", "uploads", "queue", "pipes", "slots", "invocations"]:
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+
+    def object_path(self, key):
+        return os.path.join(self.root, "bucket", str(key).lstrip("/"))
+
+    def invoke(self, script_id, data, job_id=None, scripts_prefix=None):
+        invocation_path = os.path.join(self.root, "invocations", f"{uuid.uuid4()}.json")
+        with open(invocation_path, "w") as f:
+            json.dump({"id": script_id, "data": data, "job": job_id, "scripts": scripts_prefix}, f)
+        env = dict(os.environ, PASH_SLS_PROVIDER="local", PASH_SLS_LOCAL_DIR=self.root,
+                   PASH_SLS_LOCAL_CONFIG=self.config_path)
+        ## Like an asynchronous (Event) invocation, it does not wait for the lambda
+        subprocess.Popen([sys.executable, os.path.join(SERVERLESS_DIR, "local-lambda.py"), invocation_path],
+                         cwd=SERVERLESS_DIR, env=env, start_new_session=True)
+
+    def object_size(self, key):
+        time.sleep(self.s3.latency)
+        return os.path.getsize(self.object_path(key))
+
+    def get_range(self, key, start, end):
+        with open(self.object_path(key), "rb") as src:
+            src.seek(start)
+            dst = io.BytesIO()
+            self.s3.copy(src, dst, end - start)
+            return dst.getvalue()
+
+    ## The object appears at once when it is complete, like in S3
+    def put_bytes(self, key, data):
+        path = self.object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{uuid.uuid4()}.partial"
+        with open(partial_path, "wb") as dst:
+            self.s3.copy(io.BytesIO(data), dst)
+        os.rename(partial_path, path)
+
+    ## The parts of an upload are files in a directory of uploads
+    def start_upload(self, key):
+        upload_dir = os.path.join(self.root, "uploads", str(uuid.uuid4()))
+        os.makedirs(upload_dir)
+        return key, upload_dir
+
+    def upload_part(self, upload, number, data):
+        _key, upload_dir = upload
+        with open(os.path.join(upload_dir, str(number)), "wb") as dst:
+            self.s3.copy(io.BytesIO(data), dst)
+        return number
+
+    def complete_upload(self, upload, parts):
+        key, upload_dir = upload
+        path = self.object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{uuid.uuid4()}.partial"
+        with open(partial_path, "wb") as dst:
+            for number in parts:
+                with open(os.path.join(upload_dir, str(number)), "rb") as src:
+                    shutil.copyfileobj(src, dst)
+        os.rename(partial_path, path)
+        shutil.rmtree(upload_dir)
+
+    def abort_upload(self, upload):
+        _key, upload_dir = upload
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+    def send_message(self, message):
+        queue_dir = os.path.join(self.root, "queue")
+        partial_path = os.path.join(queue_dir, f".{uuid.uuid4()}")
+        with open(partial_path, "w") as f:
+            json.dump(message, f)
+        os.rename(partial_path, os.path.join(queue_dir, f"{time.time():.6f}-{uuid.uuid4()}.json"))
+
+    def receive_messages(self, max_messages, timeout):
+        queue_dir = os.path.join(self.root, "queue")
+        deadline = time.time() + timeout
+        while True:
+            messages = []
+            for name in sorted(os.listdir(queue_dir)):
+                if name.startswith("."):
+                    continue
+                path = os.path.join(queue_dir, name)
+                try:
+                    with open(path) as f:
+                        messages.append(json.load(f))
+                    os.unlink(path)
+                except FileNotFoundError:
+                    ## Another receiver took it
+                    continue
+                if len(messages) == max_messages:
+                    break
+            if len(messages) > 0 or time.time() >= deadline:
+                return messages
+            time.sleep(0.01)
+
+    ## The edges between lambdas (see local-pipe.py) are named pipes
+    def pipe_path(self, key):
+        path = os.path.join(self.root, "pipes", str(key))
+        try:
+            os.mkfifo(path)
+        except FileExistsError:
+            pass
+        return path
+
+    ## Waits for one of the concurrency slots of the lambdas and returns its (locked) file
+    ##   and whether it is warm, i.e., a lambda already ran in it
+    def acquire_slot(self):
+        concurrency = self.config.get("concurrency", 1000)
+        while True:
+            for slot in range(concurrency):
+                slot_path = os.path.join(self.root, "slots", str(slot))
+                slot_file = open(slot_path, "a+")
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    slot_file.close()
+                    continue
+                warm = os.path.getsize(slot_path) > 0
+                if not warm:
+                    slot_file.write("warm\n")
+                    slot_file.flush()
+                return slot_file, warm
+            time.sleep(0.05)
+
+
+PROVIDERS = {
+    "aws": AwsProvider,
+    "local": LocalProvider,
+}
+
+def make_provider(name=None) -> Provider:
+    if name is None:
+        name = os.environ.get("PASH_SLS_PROVIDER", "aws")
+    return PROVIDERS[name]()
@@ -1,27 +1,15 @@
-import boto3
-import sys
-import json
 import os
+import sys
 import time
+from provider import make_provider
 
-AWS_ACCOUNT_ID=os.environ.get("AWS_ACCOUNT_ID")
-BUCKET=os.environ.get("AWS_BUCKET")
-QUEUE=os.environ.get("AWS_QUEUE")
 object_key, infile = sys.argv[1:]
 
 print(f"[s3-put-object.py] Start putting {object_key}")
 start_time = time.time()
 
-session = boto3.Session()
-s3 = session.client("s3")
-
-
-# Prepare the data to be stored in the S3 object
-with open(infile, "rb") as file:
-    object_data = file.read()
-
-# Upload the object to S3
-s3.put_object(Bucket=BUCKET, Key=object_key, Body=object_data)
+provider = make_provider()
+provider.put_object(object_key, infile)
 
 end_time = time.time()
 total_time = end_time - start_time
@@ -30,11 +18,9 @@ total_time = round(total_time, 3)
 print(f"[s3-put-object.py] Finish putting {object_key} in {total_time} seconds")
 
 # notify the main shell that job is done
-sqs_client = boto3.client("sqs")
-message_body = {"message": "done","output_file_id":object_key}
+message_body = {"message": "done", "job": os.environ.get("PASH_SLS_JOB_ID"), "output_file_id": object_key,
+                "start_time": start_time, "end_time": end_time}
 try:
-    response = sqs_client.send_message(
-        QueueUrl=f"https://sqs.us-east-1.amazonaws.com/{AWS_ACCOUNT_ID}/{QUEUE}", MessageBody=json.dumps(message_body)
-    )
+    provider.send_message(message_body)
 except Exception as e:
     print(e)
@@ -3,8 +3,14 @@ import sys
 sys.path.append("/opt/python")
 
 import fmi
+from framing import DATA, END, FRAME_SIZE, pack_ints, recv_stream, send_stream, unpack_ints
 
-key, fifo, node_id = sys.argv[1:]
+## Usage: sendrecv.py <key> <fifo> <node id: 0 sends, 1 receives> [framing]
+## The framing (the same on both ends) is either:
+##   ints  -- (default) every byte is an element of a padded list of ints of the batch size
+##   bytes -- length-prefixed frames (see framing.py)
+key, fifo, node_id = sys.argv[1:4]
+framing = sys.argv[4] if len(sys.argv) > 4 else "ints"
 
 node_id = int(node_id)
 
@@ -33,7 +39,60 @@ def try_receive(comm):
         except Exception as e:
             print(f"Failed to receive, trying re-receiving: {e}", flush=True)
 
-if node_id == 0:
+class FmiChannel:
+    """ Frames through fmi, which only sends typed values: a frame is the length of its payload as an int
+    (-1 for the end of the stream) and then its payload as a list of 4-byte ints (see pack_ints in framing.py). """
+
+    def __init__(self, comm, peer):
+        self.comm = comm
+        self.peer = peer
+
+    def send(self, value, datatype):
+        while True:
+            try:
+                self.comm.send(value, self.peer, datatype)
+                return
+            except Exception as e:
+                print(f"Failed to send, trying re-sending: {e}", flush=True)
+
+    def recv(self, datatype):
+        while True:
+            try:
+                return self.comm.recv(self.peer, datatype)
+            except Exception as e:
+                print(f"Failed to receive, trying re-receiving: {e}", flush=True)
+
+    def send_frame(self, frame_type, payload=b""):
+        length = -1 if frame_type == END else len(payload)
+        self.send(length, fmi.types(fmi.datatypes.int))
+        if length > 0:
+            ints = pack_ints(payload)
+            self.send(ints, fmi.types(fmi.datatypes.int_list, len(ints)))
+
+    def recv_frame(self):
+        length = self.recv(fmi.types(fmi.datatypes.int))
+        if length < 0:
+            return END, b""
+        if length == 0:
+            return DATA, b""
+        ints = self.recv(fmi.types(fmi.datatypes.int_list, (length + 3) // 4))
+        return DATA, unpack_ints(ints, length)
+
+if framing == "bytes":
+    channel = FmiChannel(comm, 1 - node_id)
+    if node_id == 0:
+        # an empty frame, so that the edge is connected before the fifo is opened
+        channel.send_frame(DATA)
+        with open(fifo, "rb") as f:
+            sent = send_stream(f, channel, FRAME_SIZE)
+        print(f"{key}: sent {sent} bytes", flush=True)
+    elif node_id == 1:
+        channel.recv_frame()
+        with open(fifo, "wb") as f:
+            received = recv_stream(channel, f)
+        print(f"{key}: received {received} bytes", flush=True)
+
+elif node_id == 0:
     # dummy send
     try_send([1]*batch, comm)
     with open(fifo, "rb") as f:
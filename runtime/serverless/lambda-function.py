@@ -1,17 +1,39 @@
+import os
 import subprocess
+import sys
 import json
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "aws"))
+from provider import make_provider, script_key
 
 def lambda_handler(event, context):
-    data = event["data"]
+    start_time = time.time()
     id_ = event["id"]
-    scripts_dict = json.loads(data)
+    ## The job of the script, which the lambdas that this one invokes and the messages to the main shell carry
+    job_id = event.get("job") or ""
+    ## Either all the scripts are in the event, or they are stored in the bucket under this prefix
+    scripts_prefix = event.get("scripts") or ""
+    data = event.get("data") or ""
     with open(f"/tmp/data-{id_}", "w") as f:
         f.write(data)
     print("[lambda-function.py] Executing script ID", id_, flush=True)
-    with open(f"/tmp/script-{id_}.sh", "w") as f:
-        f.write(scripts_dict[id_])
+    if scripts_prefix:
+        make_provider().get_object(script_key(scripts_prefix, id_), f"/tmp/script-{id_}.sh")
+    else:
+        scripts_dict = json.loads(data)
+        with open(f"/tmp/script-{id_}.sh", "w") as f:
+            f.write(scripts_dict[id_])
     # print(f"Script: {scripts_dict[id_]}", flush=True)
     process = subprocess.run(
-        ["/bin/bash", f"/tmp/script-{id_}.sh", f"/tmp/data-{id_}"]
+        ["/bin/bash", f"/tmp/script-{id_}.sh", f"/tmp/data-{id_}"],
+        env=dict(os.environ, PASH_SLS_JOB_ID=job_id, PASH_SLS_SCRIPTS=scripts_prefix)
     )
+    end_time = time.time()
     print(f"[lambda-function.py] script {id_} execution return code: {process.returncode}")
+    # report the timing of the lambda to the main shell
+    try:
+        make_provider().send_message({"message": "lambda-done", "job": job_id, "script_id": id_,
+                                      "start_time": start_time, "end_time": end_time,
+                                      "return_code": process.returncode})
+    except Exception as e:
+        print(e)
@@ -0,0 +1,28 @@
+import importlib.util
+import json
+import os
+import sys
+import time
+
+## Runs an invocation of the lambda (see lambda-function.py) as a process of this machine
+## for the local provider (see aws/provider.py). Usage: local-lambda.py <invocation json>
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "aws"))
+from provider import LocalProvider
+
+invocation_path = sys.argv[1]
+provider = LocalProvider()
+
+## The lambda holds its slot until it exits
+slot, warm = provider.acquire_slot()
+if not warm:
+    time.sleep(provider.config.get("cold_start", 0))
+
+with open(invocation_path) as f:
+    event = json.load(f)
+os.unlink(invocation_path)
+
+spec = importlib.util.spec_from_file_location("lambda_function", "lambda-function.py")
+lambda_function = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(lambda_function)
+lambda_function.lambda_handler(event, None)